@@ -0,0 +1,223 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+from multirouter.ssh_handler import SSHManager
+from multirouter.async_ssh_handler import AsyncSSHManager
+from multirouter.host import HostMap
+from multirouter.iptables_manager import IPTablesManager
+from multirouter.monitor import HitMonitor
+from multirouter.snapshot import SnapshotStore
+from multirouter.analyze import analyze_tables
+from multirouter.optimize import optimize_tables
+from multirouter.harness import FakeFleet, synthetic_save
+
+import argparse, contextlib, io, json, statistics, sys, tempfile, time
+
+SIZES = (1, 10, 100, 500)
+
+# The old && chain is sent this many rules per command, since SSH servers
+# cap the size of an exec request well below 10k rules
+CHAIN_CHUNK = 200
+
+
+def timed(func, repeat):
+    # Median seconds over repeat runs, with all output swallowed
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            with contextlib.redirect_stderr(io.StringIO()):
+                start = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def build_manager(fleet, backend, store):
+    hosts = fleet.hosts()
+    hostnames = [h.host for h in hosts]
+    config = [h.build_host_config() for h in hosts]
+    if backend == "asyncio":
+        ssh_manager = AsyncSSHManager(hostnames, config)
+    else:
+        ssh_manager = SSHManager(hostnames, config)
+    iptables_manager = IPTablesManager(ssh_manager, HostMap(hostnames, hosts))
+    iptables_manager.store = SnapshotStore(store)
+    iptables_manager.answers = {"COMMIT"}
+    return iptables_manager
+
+
+def close(m):
+    if isinstance(m.ssh_manager, AsyncSSHManager):
+        m.ssh_manager.close()
+    else:
+        m.ssh_manager.sessions.disconnect_all()
+
+
+def fleet_bench(n, a):
+    """Times each operation against n fake routers
+
+    Args:
+        n (int): Number of routers
+        a (Namespace): Parsed arguments
+
+    Returns:
+        {str: float}: Median seconds per operation
+    """
+    results = {}
+    with FakeFleet(n, port=a.port, rules=a.rules, latency=a.latency) as fleet:
+        with tempfile.TemporaryDirectory() as store:
+            m = build_manager(fleet, a.backend, store)
+            start = time.perf_counter()
+            errors = m.ssh_manager.connect()
+            results["connect"] = time.perf_counter() - start
+            if len(errors) != 0:
+                raise RuntimeError(
+                    f"{len(errors)} fake routers unreachable: {errors[0]!r}"
+                )
+            results["list"] = timed(lambda: m.list_rules(False), a.repeat)
+            names = iter(range(a.repeat))
+            results["save"] = timed(
+                lambda: m.save_snapshot(f"bench{next(names)}"), a.repeat
+            )
+            saves = m.store.load("bench0")
+            results["load"] = timed(lambda: m.load(saves), a.repeat)
+            rule = "-A INPUT -s 192.0.2.1/32 -j DROP"
+            results["iptables"] = timed(lambda: m.run_iptables(rule), a.repeat)
+
+            def context():
+                for _ in range(100):
+                    m.change_context_select(["group:g0", "&tag:t0"])
+                    m.reset_context()
+                    m.change_context_indices(list(range(0, n, 2)))
+                    m.reset_context()
+
+            results["context x100"] = timed(context, a.repeat)
+
+            # One watch poll once every host has had its full fetch
+            monitor = HitMonitor(m.tables)
+            m.poll_counters(monitor, m.ssh_manager.hosts)
+            results["watch poll"] = timed(
+                lambda: m.poll_counters(monitor, m.ssh_manager.hosts), a.repeat
+            )
+            close(m)
+    return results
+
+
+def chain_command(tables):
+    # What load used to send: one iptables call per rule, joined with &&
+    c = []
+    for table, rules in tables.items():
+        c.append(f"iptables -t {table} -F")
+        c += [f"iptables -t {table} {r}" for r in rules]
+    return [" && ".join(c[i : i + CHAIN_CHUNK]) for i in range(0, len(c), CHAIN_CHUNK)]
+
+
+def restore_bench(a):
+    """Times one 10k rule load as an && chain and as iptables-restore, and analyzing it
+
+    Args:
+        a (Namespace): Parsed arguments
+
+    Returns:
+        {str: float}: Seconds per path
+    """
+    text = synthetic_save(a.restore_rules)
+    tables = IPTablesManager.split_tables(text)
+    results = {}
+    with FakeFleet(1, port=a.port) as fleet:
+        with tempfile.TemporaryDirectory() as store:
+            m = build_manager(fleet, a.backend, store)
+            m.ssh_manager.connect()
+            host = fleet.addresses()[0]
+
+            def chain():
+                for c in chain_command(tables):
+                    output = m.run(c, [host], sudo=True)
+                    m.join(output)
+
+            def restore():
+                payload = m.build_restore(tables)
+                m.join(m.push_restore([host], {host: payload}))
+
+            results[f"&& chain ({a.restore_rules} rules)"] = timed(chain, 1)
+            results[f"iptables-restore ({a.restore_rules} rules)"] = timed(restore, 1)
+            live = IPTablesManager.parse_tables(text)
+            results[f"analyze ({a.restore_rules} rules)"] = timed(
+                lambda: analyze_tables(live, m.tables), 1
+            )
+            # Every 20th rule hot, hotter further down the chain
+            rules = [r for t in live.values() for r in t.all_rules()]
+            weights = {id(r): n for n, r in enumerate(rules) if n % 20 == 0}
+            results[f"optimize ({a.restore_rules} rules)"] = timed(
+                lambda: optimize_tables(live, m.tables, weights), 1
+            )
+            failed = [h for h, s in m.status.items() if s["status"] != "ok"]
+            if len(failed) != 0:
+                raise RuntimeError(
+                    f"Restore benchmark failed: {m.status[failed[0]]['error']}"
+                )
+            close(m)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Lists every timing more than tolerance slower than the baseline
+    regressions = []
+    for name, ops in results.items():
+        for op, t in ops.items():
+            base = baseline.get(name, {}).get(op)
+            if base is not None and t > base * (1 + tolerance):
+                regressions.append(f"{name} {op}: {t:.3f}s (baseline {base:.3f}s)")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark multirouter against fake routers"
+    )
+    parser.add_argument("--backend", choices=("gevent", "asyncio"), default="gevent")
+    parser.add_argument(
+        "--sizes", default=",".join(map(str, SIZES)), help="Fleet sizes"
+    )
+    parser.add_argument("--rules", type=int, default=50, help="Rules per router")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds per command"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--port", type=int, default=2222)
+    parser.add_argument("--restore-rules", type=int, default=10000)
+    parser.add_argument("--skip-restore", action="store_true")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument(
+        "--baseline", help="Fail on regressions against this results file"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    a = parser.parse_args()
+
+    results = {}
+    for n in [int(s) for s in a.sizes.split(",")]:
+        results[f"{n} hosts"] = fleet_bench(n, a)
+    if not a.skip_restore:
+        results["restore"] = restore_bench(a)
+
+    for name, ops in results.items():
+        print(f"\n{name}:\n")
+        for op, t in ops.items():
+            print(f"{op:<40}{t:>10.3f}s")
+    print()
+    if a.json is not None:
+        with open(a.json, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if a.baseline is not None:
+        with open(a.baseline, "r") as f:
+            regressions = compare(results, json.load(f), a.tolerance)
+        for r in regressions:
+            print(f"Regression: {r}")
+        sys.exit(1 if len(regressions) != 0 else 0)
@@ -0,0 +1,593 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+import ipaddress
+import shlex
+import socket
+
+from colorama import Fore, Style
+
+from .ruleset import Rule, Table
+
+# Targets that end a packet's trip through the chain, so nothing after a rule
+# with one of them sees the packets it matches
+TERMINAL = {
+    "ACCEPT",
+    "DROP",
+    "REJECT",
+    "RETURN",
+    "DNAT",
+    "SNAT",
+    "MASQUERADE",
+    "REDIRECT",
+    "NETMAP",
+}
+
+# Ports one multiport match can hold (a range takes two)
+MULTIPORT_SLOTS = 15
+
+# Matches that don't change what a rule matches
+IGNORED = {("-m", "comment"), ("-m", "tcp"), ("-m", "udp"), ("-m", "multiport")}
+
+ANY = (0, 0)
+
+
+class RuleMatch(object):
+    """What a rule matches, split into the parts the indexes understand
+
+    Sources and destinations are (network, prefix length) pairs and ports
+    are tuples of (low, high) intervals. Every other match goes into extras
+    as one clause per option, and a rule matches at least everything another
+    does when its clauses are a subset of the other's.
+    """
+
+    def __init__(self, rule, position):
+        """Initializes RuleMatch
+
+        Args:
+            rule (Rule): Rule to parse
+            position (int): Rule number in its chain, from 1
+        """
+        self.rule = rule
+        self.position = position
+        self.src = ANY
+        self.dst = ANY
+        self.proto = None
+        self.sports = None
+        self.dports = None
+        self.extras = set()
+        self.target = ""
+        # Token positions used to rewrite the rule when merging
+        self.src_pos = None
+        self.dst_pos = None
+        self.port_pos = None
+        spec = rule.spec
+        self.tokens = shlex.split(spec) if '"' in spec or "'" in spec else spec.split()
+        self._parse()
+        self.extras = frozenset(self.extras)
+        verb = self.target.split(" ", 1)[0]
+        self.terminal = verb in TERMINAL or self.target.startswith("-g ")
+
+    def _parse(self):
+        tokens = self.tokens
+        module = None
+        port_module = None
+        i = 0
+        while i < len(tokens):
+            opt = tokens[i]
+            args = []
+            j = i + 1
+            while (
+                j < len(tokens) and not tokens[j].startswith("-") and tokens[j] != "!"
+            ):
+                args.append(tokens[j])
+                j += 1
+            value = args[0] if len(args) != 0 else None
+            if opt == "!":
+                # Negated matches are only compared as they're written
+                end = j + 1
+                while (
+                    end < len(tokens)
+                    and not tokens[end].startswith("-")
+                    and tokens[end] != "!"
+                ):
+                    end += 1
+                self.extras.add(" ".join(tokens[i:end]))
+                i = end
+                continue
+            if opt in ("-j", "-g"):
+                self.target = " ".join(tokens[i + 1 :] if opt == "-j" else tokens[i:])
+                break
+            if opt in ("-s", "--source") and value is not None:
+                self.src = parse_net(value)
+                self.src_pos = i + 1
+            elif opt in ("-d", "--destination") and value is not None:
+                self.dst = parse_net(value)
+                self.dst_pos = i + 1
+            elif opt in ("-p", "--protocol") and value is not None:
+                self.proto = None if value == "all" else value.lower()
+            elif opt == "-m" and value is not None:
+                module = value
+                if (opt, value) in IGNORED:
+                    if value in ("tcp", "udp", "multiport"):
+                        port_module = i
+                else:
+                    self.extras.add(f"-m {value}")
+            elif opt == "--comment" and module == "comment":
+                pass
+            elif opt in (
+                "--dport",
+                "--destination-port",
+                "--dports",
+                "--destination-ports",
+            ):
+                self.dports = parse_ports(value)
+                # Only `-m tcp --dport 22` on its own can be rewritten as a
+                # multiport match; tcp options after it need the tcp module
+                alone = j == len(tokens) or not tokens[j].startswith("--")
+                if port_module is not None and j - port_module == 4 and alone:
+                    self.port_pos = port_module
+            elif opt in ("--sport", "--source-port", "--sports", "--source-ports"):
+                self.sports = parse_ports(value)
+            else:
+                self.extras.add(" ".join(tokens[i:j]))
+            i = j
+
+    def covers(self, other):
+        """Checks whether this rule matches every packet other does
+
+        Args:
+            other (RuleMatch): Rule later in the chain
+
+        Returns:
+            bool: Whether other is covered
+        """
+        return (
+            net_contains(self.src, other.src)
+            and net_contains(self.dst, other.dst)
+            and (self.proto is None or self.proto == other.proto)
+            and ports_contain(self.dports, other.dports)
+            and ports_contain(self.sports, other.sports)
+            and self.extras <= other.extras
+        )
+
+
+class PrefixIndex(object):
+    """Finds entries whose prefix contains an address, one hash per prefix length
+
+    A lookup tries each prefix length in use, longest first, so it costs at
+    most 33 hash lookups whatever the number of entries.
+    """
+
+    def __init__(self):
+        self.lengths = []
+        self.tables = {}
+
+    def add(self, net, value):
+        """Stores value under a prefix
+
+        Args:
+            net ((int, int)): (network, prefix length)
+            value (object): Value to store
+        """
+        network, length = net
+        if length not in self.tables:
+            self.tables[length] = {}
+            self.lengths = sorted(self.tables.keys(), reverse=True)
+        self.tables[length].setdefault(network, []).append(value)
+
+    def get(self, net, default=None):
+        # The value stored under exactly this prefix
+        return self.tables.get(net[1], {}).get(net[0], [default])[0]
+
+    def containing(self, net):
+        """Gets every value stored under a prefix containing net
+
+        Args:
+            net ((int, int)): (network, prefix length)
+
+        Returns:
+            [object]: Values, most specific prefix first
+        """
+        network, length = net
+        found = []
+        for l in self.lengths:
+            if l > length:
+                continue
+            values = self.tables[l].get(network if l == 33 else network & mask(l))
+            if values is not None:
+                found += values
+        return found
+
+
+class PortIndex(object):
+    """Earlier rules sharing a source and destination, looked up by port
+
+    Rules on a single destination port are hashed by it. Rules on every
+    port, several ports or a range go in a list, which stays short in
+    practice.
+    """
+
+    def __init__(self):
+        self.single = {}
+        self.wide = []
+
+    def add(self, m):
+        if (
+            m.dports is not None
+            and len(m.dports) == 1
+            and m.dports[0][0] == m.dports[0][1]
+        ):
+            self.single.setdefault(m.dports[0][0], []).append(m)
+        else:
+            self.wide.append(m)
+
+    def candidates(self, m):
+        if (
+            m.dports is not None
+            and len(m.dports) == 1
+            and m.dports[0][0] == m.dports[0][1]
+        ):
+            return self.single.get(m.dports[0][0], []) + self.wide
+        return self.wide
+
+
+class ShadowIndex(object):
+    """Terminal rules seen so far in a chain, indexed for cover lookups
+
+    Rules are bucketed by protocol, then by source prefix and destination
+    prefix, then by port, so finding the rules that could cover a new one
+    doesn't scan the chain.
+    """
+
+    def __init__(self):
+        self.protocols = {}
+
+    def add(self, m):
+        sources = self.protocols.setdefault(m.proto, PrefixIndex())
+        destinations = sources.get(m.src)
+        if destinations is None:
+            destinations = PrefixIndex()
+            sources.add(m.src, destinations)
+        ports = destinations.get(m.dst)
+        if ports is None:
+            ports = PortIndex()
+            destinations.add(m.dst, ports)
+        ports.add(m)
+
+    def covering(self, m):
+        """Finds the first earlier rule that covers m
+
+        Args:
+            m (RuleMatch): Rule to check
+
+        Returns:
+            RuleMatch: Covering rule, or None
+        """
+        best = None
+        for proto in {m.proto, None}:
+            sources = self.protocols.get(proto)
+            if sources is None:
+                continue
+            for destinations in sources.containing(m.src):
+                for ports in destinations.containing(m.dst):
+                    for c in ports.candidates(m):
+                        if (best is None or c.position < best.position) and c.covers(m):
+                            best = c
+        return best
+
+
+class Finding(object):
+    """One problem found in a chain"""
+
+    def __init__(self, kind, table, chain, rules, by=None, merged=None):
+        """Initializes Finding
+
+        Args:
+            kind (str): "duplicate", "redundant", "shadowed" or "mergeable"
+            table (str): Table name
+            chain (str): Chain name
+            rules ([RuleMatch]): The rule found (or the run of rules that can merge)
+            by (RuleMatch, optional): Earlier rule that covers it. Defaults to None.
+            merged ([Rule], optional): What a mergeable run becomes. Defaults to None.
+        """
+        self.kind = kind
+        self.table = table
+        self.chain = chain
+        self.rules = rules
+        self.by = by
+        self.merged = merged
+
+    @property
+    def removes(self):
+        # Rules the cleanup plan takes out of the chain
+        if self.kind == "mergeable":
+            return len(self.rules) - len(self.merged)
+        return 1 if self.kind != "duplicate" or self.rules[0].terminal else 0
+
+    def line(self):
+        first = self.rules[0]
+        if self.kind == "mergeable":
+            positions = [m.position for m in self.rules]
+            if positions[-1] - positions[0] == len(positions) - 1:
+                where = f"#{positions[0]}-{positions[-1]}"
+            else:
+                where = ", ".join(f"#{p}" for p in positions)
+            merged = "; ".join(str(r) for r in self.merged)
+            return f"{Fore.CYAN}{where} mergeable into {len(self.merged)}: {merged}{Style.RESET_ALL}"
+        where = f"#{first.position}"
+        if self.kind == "duplicate":
+            color = Fore.YELLOW
+            note = f"duplicate of #{self.by.position}"
+            if self.removes == 0:
+                note += " (kept, target doesn't end the chain)"
+        elif self.kind == "redundant":
+            color = Fore.YELLOW
+            note = f"redundant, covered by #{self.by.position}"
+        else:
+            color = Fore.RED
+            note = f"shadowed by #{self.by.position} ({self.by.target})"
+        return f"{color}{where} {note}: {first.rule}{Style.RESET_ALL}"
+
+    def record(self):
+        return {
+            "kind": self.kind,
+            "table": self.table,
+            "chain": self.chain,
+            "positions": [m.position for m in self.rules],
+            "rules": [str(m.rule) for m in self.rules],
+            "by": None if self.by is None else self.by.position,
+            "merged": None if self.merged is None else [str(r) for r in self.merged],
+        }
+
+
+def analyze_chain(table, chain, rules):
+    """Finds duplicate, covered and mergeable rules in one chain
+
+    Args:
+        table (str): Table name
+        chain (str): Chain name
+        rules ([Rule]): Rules in order
+
+    Returns:
+        ([Finding], [Rule]): Findings, and the chain with covered rules removed and runs merged
+    """
+    findings = []
+    index = ShadowIndex()
+    seen = {}
+    kept = []
+    for position, rule in enumerate(rules, 1):
+        m = RuleMatch(rule, position)
+        by = index.covering(m)
+        first = seen.get(rule)
+        if by is not None:
+            if first is not None and first.position <= by.position:
+                kind = "duplicate"
+                by = first
+            else:
+                kind = "redundant" if by.target == m.target else "shadowed"
+            findings.append(Finding(kind, table, chain, [m], by))
+            continue
+        if first is not None:
+            findings.append(Finding("duplicate", table, chain, [m], first))
+        else:
+            seen[rule] = m
+        if m.terminal:
+            index.add(m)
+        kept.append(m)
+    merges = find_merges(table, chain, kept)
+    findings += merges
+    findings.sort(key=lambda f: f.rules[0].position)
+    cleaned = []
+    runs = {f.rules[0].position: f for f in merges}
+    skip = set(m.position for f in merges for m in f.rules)
+    for m in kept:
+        if m.position in runs:
+            cleaned += runs[m.position].merged
+        elif m.position not in skip:
+            cleaned.append(m.rule)
+    return (findings, cleaned)
+
+
+def find_merges(table, chain, kept):
+    """Finds runs of adjacent rules that differ only in source or destination ports
+
+    Only rules with a terminal target are merged, so a packet is still
+    handled once whichever of the run's rules it matched before.
+
+    Args:
+        table (str): Table name
+        chain (str): Chain name
+        kept ([RuleMatch]): Rules left once covered ones are removed
+
+    Returns:
+        [Finding]: Mergeable runs
+    """
+    findings = []
+    used = set()
+    for key_of, merge in ((source_key, merge_sources), (port_key, merge_ports)):
+        run = []
+        key = None
+        for m in kept + [None]:
+            k = (
+                key_of(m)
+                if m is not None and m.terminal and m.position not in used
+                else None
+            )
+            if k is not None and k == key:
+                run.append(m)
+                continue
+            if len(run) > 1:
+                merged = merge(run)
+                if merged is not None:
+                    findings.append(
+                        Finding("mergeable", table, chain, run, merged=merged)
+                    )
+                    used.update(r.position for r in run)
+            run = [m] if k is not None else []
+            key = k
+    return findings
+
+
+def source_key(m):
+    # Hostnames can't be merged or put in a set
+    if m.src_pos is None or m.src[1] == 33:
+        return None
+    tokens = list(m.tokens)
+    tokens[m.src_pos] = None
+    return tuple(tokens)
+
+
+def destination_key(m):
+    if m.dst_pos is None or m.dst[1] == 33:
+        return None
+    tokens = list(m.tokens)
+    tokens[m.dst_pos] = None
+    return tuple(tokens)
+
+
+def port_key(m):
+    if m.port_pos is None or m.sports is not None:
+        return None
+    if any(hi is None for _, hi in m.dports):
+        return None
+    return (m.proto,) + tuple(m.tokens[: m.port_pos] + m.tokens[m.port_pos + 4 :])
+
+
+def merge_sources(run):
+    nets = [ipaddress.IPv4Network((n, l)) for n, l in (m.src for m in run)]
+    collapsed = list(ipaddress.collapse_addresses(nets))
+    if len(collapsed) >= len(run):
+        return None
+    first = run[0]
+    merged = []
+    for net in collapsed:
+        tokens = list(first.tokens)
+        tokens[first.src_pos] = str(net)
+        merged.append(Rule(first.rule.chain, join(tokens)))
+    return merged
+
+
+def merge_ports(run):
+    intervals = sorted(i for m in run for i in m.dports)
+    ports = []
+    for lo, hi in intervals:
+        if len(ports) != 0 and lo <= ports[-1][1] + 1:
+            ports[-1] = (ports[-1][0], max(ports[-1][1], hi))
+        else:
+            ports.append((lo, hi))
+    # Pack intervals into as few multiport matches as fit
+    groups = [[]]
+    slots = 0
+    for lo, hi in ports:
+        size = 1 if lo == hi else 2
+        if slots + size > MULTIPORT_SLOTS:
+            groups.append([])
+            slots = 0
+        groups[-1].append((lo, hi))
+        slots += size
+    if len(groups) >= len(run):
+        return None
+    first = run[0]
+    merged = []
+    for group in groups:
+        if len(group) == 1:
+            match = ["-m", first.proto, "--dport", format_ports(group)]
+        else:
+            match = ["-m", "multiport", "--dports", format_ports(group)]
+        tokens = (
+            first.tokens[: first.port_pos] + match + first.tokens[first.port_pos + 4 :]
+        )
+        merged.append(Rule(first.rule.chain, join(tokens)))
+    return merged
+
+
+def analyze_tables(tables, names):
+    """Analyzes every chain of the given tables
+
+    Args:
+        tables ({str: Table}): Tables from a host
+        names ([str]): Tables to analyze
+
+    Returns:
+        ([Finding], {str: Table}): Findings, and the cleaned tables
+    """
+    findings = []
+    cleaned = {}
+    for name in names:
+        if name not in tables:
+            continue
+        t = tables[name]
+        c = Table(name)
+        for chain in t.chains:
+            c.add_chain(chain, t.policies.get(chain))
+            f, rules = analyze_chain(name, chain, t.rules[chain])
+            findings += f
+            for r in rules:
+                c.add_rule(r)
+        cleaned[name] = c
+    return (findings, cleaned)
+
+
+def parse_net(s):
+    address, _, length = s.partition("/")
+    try:
+        network = int.from_bytes(socket.inet_aton(address), "big")
+    except OSError:
+        # Hostnames and IPv6 never cover anything but themselves
+        return (hash(s), 33)
+    length = int(length) if length != "" else 32
+    return (network & mask(length), length)
+
+
+def mask(length):
+    return (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF
+
+
+def net_contains(a, b):
+    if a[1] == 33 or b[1] == 33:
+        return a == b
+    return a[1] <= b[1] and (b[0] & mask(a[1])) == a[0]
+
+
+def parse_ports(s):
+    if s is None:
+        return None
+    ports = []
+    for part in s.split(","):
+        lo, _, hi = part.partition(":")
+        try:
+            lo = int(lo) if lo != "" else 0
+            hi = int(hi) if hi != "" else (lo if ":" not in part else 65535)
+        except ValueError:
+            # Service names are compared as written
+            return ((hash(s), None),)
+        ports.append((lo, hi))
+    return tuple(sorted(ports))
+
+
+def ports_contain(a, b):
+    # None means every port
+    if a is None:
+        return True
+    if b is None:
+        return False
+    if any(hi is None for _, hi in a + b):
+        return a == b
+    return all(any(alo <= lo and hi <= ahi for alo, ahi in a) for lo, hi in b)
+
+
+def format_ports(intervals):
+    return ",".join(str(lo) if lo == hi else f"{lo}:{hi}" for lo, hi in intervals)
+
+
+def join(tokens):
+    # iptables -S double quotes arguments with spaces (e.g. comments)
+    return " ".join(f'"{t}"' if " " in t else t for t in tokens)
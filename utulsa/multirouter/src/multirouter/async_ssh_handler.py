@@ -0,0 +1,586 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+import asyncio
+import concurrent.futures
+import queue
+import threading
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+import time
+
+from .ratelimit import ConnectLimiter
+from .ssh_handler import (
+    KEEPALIVE_SECONDS,
+    POOL_SIZE,
+    SUDO_REFRESH,
+    SUDO_VALIDATE,
+    FanoutOutput,
+    HostTimeout,
+    ProbeException,
+    ShellException,
+    ShellOutput,
+    SSHManager,
+    SudoException,
+    read_frame,
+    shell_frame,
+    sudo_command,
+    sudo_validate_command,
+)
+
+
+class AsyncHostOutput(object):
+    """Output of one host's command, filled in by the event loop
+
+    Mirrors the parts of pssh's HostOutput the rest of multirouter uses, so
+    IPTablesManager doesn't care which backend produced it.
+    """
+
+    def __init__(self, host, loop, notify):
+        """Initializes AsyncHostOutput
+
+        Args:
+            host (str): Host name
+            loop (asyncio.AbstractEventLoop): Loop the command runs on
+            notify (queue.Queue): Gets this object every time new output arrives
+        """
+        self.host = host
+        self.loop = loop
+        self.client = None
+        self.exception = None
+        self.exit_code = None
+        self.future = None
+        self.process = None
+        self._stdout = queue.Queue()
+        self._stderr = queue.Queue()
+        self._notify = notify
+
+    @property
+    def stdout(self):
+        return AsyncHostOutput._read(self._stdout)
+
+    @property
+    def stderr(self):
+        return AsyncHostOutput._read(self._stderr)
+
+    def finish(self):
+        """Marks the command as over, however it ended"""
+        if self.future.cancelled() and self.exception is None:
+            self.exception = HostTimeout("Cancelled")
+        self.put(1, None)
+        self.put(2, None)
+
+    def put(self, stream, line):
+        (self._stdout if stream == 1 else self._stderr).put(line)
+        self._notify.put(self)
+
+    @staticmethod
+    def _read(q):
+        while True:
+            line = q.get()
+            if line is None:
+                q.put(None)
+                return
+            yield line
+
+
+class AsyncRemoteShell(object):
+    """One long lived `sh` on a host, driven from the event loop"""
+
+    def __init__(self, host, process):
+        """Initializes AsyncRemoteShell
+
+        Args:
+            host (str): Host name
+            process (asyncssh.SSHClientProcess): The shell process
+        """
+        self.host = host
+        self.process = process
+        self.count = 0
+        self.sudo = 0
+        self.lock = asyncio.Lock()
+
+    async def run(self, command, lines):
+        async with self.lock:
+            self.count += 1
+            marker = f"__MR_{self.count}__"
+            self.process.stdin.write(shell_frame(command, marker))
+            async for line in self.process.stdout:
+                exit_code = read_frame(line.rstrip("\r\n"), marker, lines)
+                if exit_code is not None:
+                    return exit_code
+            raise ShellException(f"Shell on {self.host} exited")
+
+    def close(self):
+        self.process.close()
+
+
+class TimedClient(asyncssh.SSHClient if asyncssh is not None else object):
+    """Notes when the TCP connection is up, so connect and auth can be timed apart"""
+
+    def __init__(self):
+        self.connected = None
+
+    def connection_made(self, conn):
+        self.connected = time.time()
+
+
+class AsyncSessionPool(object):
+    """One asyncssh connection per host, owned by the event loop thread"""
+
+    def __init__(self, host_configs, loop, keepalive_seconds=KEEPALIVE_SECONDS):
+        """Initializes AsyncSessionPool
+
+        Args:
+            host_configs ({str: HostConfig}): Host config for each host name
+            loop (asyncio.AbstractEventLoop): Loop the connections live on
+            keepalive_seconds (int, optional): Keepalive interval. Defaults to KEEPALIVE_SECONDS.
+        """
+        self.host_configs = dict(host_configs)
+        self.loop = loop
+        self.keepalive_seconds = keepalive_seconds
+        self.clients = {}
+        # host -> task opening its connection, shared by every command that
+        # needs the host meanwhile
+        self.connecting = {}
+        self.sudo = {}
+        self.shells = {}
+        self.limiter = ConnectLimiter()
+
+    def __contains__(self, host):
+        return host in self.host_configs
+
+    def sudo_valid(self, host):
+        return time.time() - self.sudo.get(host, 0) < SUDO_REFRESH
+
+    def add(self, host, host_config):
+        self.drop(host)
+        self.host_configs[host] = host_config
+
+    def remove(self, host):
+        self.drop(host)
+        self.host_configs.pop(host, None)
+
+    def drop(self, host):
+        self.sudo.pop(host, None)
+        self.close_shell(host)
+        task = self.connecting.pop(host, None)
+        if task is not None:
+            self.loop.call_soon_threadsafe(task.cancel)
+        conn = self.clients.pop(host, None)
+        if conn is not None:
+            self.loop.call_soon_threadsafe(conn.close)
+
+    async def shell(self, host, timings=None):
+        shell = self.shells.get(host)
+        if shell is None:
+            conn = await self.get(host, timings)
+            process = await conn.create_process("exec sh", encoding="utf-8")
+            shell = AsyncRemoteShell(host, process)
+            self.shells[host] = shell
+        return shell
+
+    def close_shell(self, host):
+        shell = self.shells.pop(host, None)
+        if shell is not None:
+            self.loop.call_soon_threadsafe(shell.close)
+
+    def is_connected(self, host):
+        return host in self.clients
+
+    def disconnect_all(self):
+        for host in list(self.clients.keys()):
+            self.drop(host)
+
+    async def get(self, host, timings=None):
+        """Gets the host's connection, connecting if needed (loop thread only)
+
+        Commands that need a host while it's connecting wait for that one
+        connection rather than opening their own.
+
+        Args:
+            host (str): Host name
+            timings (Timings, optional): Gets connect and auth if a connection is opened. Defaults to None.
+
+        Returns:
+            asyncssh.SSHClientConnection: Connection
+        """
+        conn = self.clients.get(host)
+        if conn is not None:
+            return conn
+        task = self.connecting.get(host)
+        if task is None:
+            task = self.loop.create_task(self._open(host, timings))
+            self.connecting[host] = task
+            task.add_done_callback(lambda t: self._opened(host, t))
+        # A command that gives up waiting doesn't cancel the others' connection
+        return await asyncio.shield(task)
+
+    async def _open(self, host, timings):
+        start = time.time()
+        client = TimedClient()
+        conn = await self.connect(host, lambda: client)
+        self.clients[host] = conn
+        if timings is not None:
+            connected = client.connected if client.connected is not None else start
+            timings.add(host, "connect", connected - start)
+            timings.add(host, "auth", time.time() - connected)
+        return conn
+
+    def _opened(self, host, task):
+        if self.connecting.get(host) is task:
+            del self.connecting[host]
+        # Read here, so a failure nobody was left waiting for isn't logged
+        if not task.cancelled():
+            task.exception()
+
+    async def connect(self, host, client_factory=None, keepalive_seconds=None):
+        """Opens a new connection to a host, outside the pool
+
+        Paced and retried like SessionPool.connect.
+
+        Args:
+            host (str): Host name
+            client_factory (function, optional): asyncssh client factory. Defaults to None.
+            keepalive_seconds (int, optional): Keepalive interval, 0 for none. Defaults to self.keepalive_seconds.
+
+        Returns:
+            asyncssh.SSHClientConnection: Connection
+        """
+        if keepalive_seconds is None:
+            keepalive_seconds = self.keepalive_seconds
+        config = self.host_configs[host]
+        keys = {}
+        if config.private_key is not None:
+            keys["client_keys"] = [config.private_key]
+        elif config.password is not None:
+            # Only try the password, so a host never sees failed key logins
+            keys["client_keys"] = []
+            keys["agent_path"] = None
+        attempt = 1
+        while True:
+            await asyncio.sleep(self.limiter.reserve())
+            try:
+                conn = await asyncssh.connect(
+                    host,
+                    port=config.port if config.port else 22,
+                    username=config.user,
+                    password=config.password,
+                    known_hosts=None,
+                    keepalive_interval=keepalive_seconds,
+                    client_factory=client_factory,
+                    **keys,
+                )
+            except asyncssh.PermissionDenied:
+                raise
+            except (OSError, asyncssh.ConnectionLost, asyncssh.DisconnectError):
+                self.limiter.failure()
+                if attempt >= self.limiter.attempts:
+                    raise
+                await asyncio.sleep(self.limiter.delay(attempt))
+                attempt += 1
+                continue
+            self.limiter.success()
+            return conn
+
+
+class AsyncSSHManager(SSHManager):
+    """SSHManager backed by asyncssh on a single event loop thread
+
+    Every host's command is a coroutine on one loop, so hundreds of hosts
+    don't need a greenlet or thread each, and several commands can be in
+    flight at once from different threads (see MultirouterShell jobs).
+    """
+
+    concurrent = True
+
+    def __init__(self, hosts, host_config, pool_size=POOL_SIZE, command_timeout=None):
+        if asyncssh is None:
+            raise ImportError("The asyncio backend needs asyncssh installed")
+        self.local = threading.local()
+        self.hosts = sorted(hosts)
+        self.all_hosts = list(self.hosts)
+        self.context_changed = False
+        self.pool_size = pool_size
+        self.command_timeout = command_timeout
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.sessions = AsyncSessionPool(dict(zip(hosts, host_config)), self.loop)
+        self._limit = None
+
+    def set_concurrency(self, size):
+        # Coroutines already waiting keep the old semaphore
+        self.pool_size = size
+        self._limit = None
+
+    def spawn(self, func, *args):
+        thread = threading.Thread(target=func, args=args, daemon=True)
+        thread.start()
+        return thread
+
+    def sleep(self, seconds):
+        # Commands are issued from their own threads, so blocking one is fine
+        time.sleep(seconds)
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def connect(self):
+        hosts = [h for h in self.all_hosts if not self.sessions.is_connected(h)]
+        return self.submit(self._connect(hosts)).result()
+
+    async def _connect(self, hosts):
+        results = await asyncio.gather(
+            *[self._limited(self.sessions.get(h)) for h in hosts],
+            return_exceptions=True,
+        )
+        return [(h, e) for h, e in zip(hosts, results) if isinstance(e, Exception)]
+
+    async def _limited(self, coro):
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(self.pool_size)
+        async with self._limit:
+            return await coro
+
+    def run_command(
+        self, command, commands=None, sudo=False, hosts=None, timeout=None, stdin=None
+    ):
+        if hosts is None:
+            hosts = self.all_hosts
+        if commands is None:
+            cmds = [command] * len(hosts)
+        else:
+            cmds = [command % c for c in commands]
+        if timeout is None:
+            timeout = self.command_timeout
+        notify = queue.Queue()
+        output = FanoutOutput()
+        for h, c in zip(hosts, cmds):
+            if h not in self.sessions:
+                continue
+            host_out = AsyncHostOutput(h, self.loop, notify)
+            data = self.stdin_data(h, sudo, stdin)
+            host_out.future = self.submit(
+                self._run_host(host_out, c, sudo, timeout, output.timings, data)
+            )
+            host_out.future.add_done_callback(lambda f, o=host_out: o.finish())
+            output.append(host_out)
+        return output
+
+    async def _run_host(self, host_out, command, sudo, timeout, timings, data):
+        try:
+            await asyncio.wait_for(
+                self._limited(self._exec(host_out, command, sudo, timings, data)),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            host_out.exception = HostTimeout(f"No result after {timeout}s")
+        except Exception as e:
+            host_out.exception = e
+        finally:
+            if host_out.process is not None:
+                host_out.process.close()
+            timings.finish(host_out.host)
+
+    async def _exec(self, host_out, command, sudo, timings, data):
+        host = host_out.host
+        try:
+            conn, process = await self._exec_session(host, command, sudo, timings)
+        except (asyncssh.ChannelOpenError, asyncssh.DisconnectError, OSError):
+            # The pooled connection died, so reconnect just this host once
+            self.sessions.clients.pop(host, None)
+            self.sessions.sudo.pop(host, None)
+            conn, process = await self._exec_session(host, command, sudo, timings)
+        host_out.client = conn
+        host_out.process = process
+        if data is not None:
+            process.stdin.write(data)
+            process.stdin.write_eof()
+        await asyncio.gather(
+            AsyncSSHManager._pump(process.stdout, host_out, 1),
+            AsyncSSHManager._pump(process.stderr, host_out, 2),
+        )
+        await process.wait_closed()
+        host_out.exit_code = process.exit_status
+
+    async def _exec_session(self, host, command, sudo, timings):
+        conn = await self.sessions.get(host, timings)
+        if sudo:
+            if self.sudo_session:
+                with timings.timed(host, "sudo"):
+                    await self._validate_sudo(host, conn)
+            command = sudo_command(command, self.sudo_session)
+        with timings.timed(host, "channel"):
+            process = await conn.create_process(command, encoding="utf-8")
+        timings.start(host)
+        return (conn, process)
+
+    async def _validate_sudo(self, host, conn):
+        if self.sessions.sudo_valid(host):
+            return
+        result = await conn.run(SUDO_VALIDATE, input=f"{self.password(host)}\n")
+        if result.exit_status != 0:
+            raise SudoException(f"sudo -v failed on {host}")
+        self.sessions.sudo[host] = time.time()
+
+    def run_shell(self, command, sudo=False, hosts=None, timeout=None, deadline=None):
+        if hosts is None:
+            hosts = self.all_hosts
+        if timeout is None:
+            timeout = self.command_timeout
+        output = FanoutOutput([ShellOutput(h) for h in hosts if h in self.sessions])
+        futures = [
+            self.submit(
+                self._shell_host(host_out, command, sudo, timeout, output.timings)
+            )
+            for host_out in output
+        ]
+        done, pending = concurrent.futures.wait(futures, deadline)
+        for host_out, f in zip(output, futures):
+            if f in pending:
+                f.cancel()
+                host_out.exception = HostTimeout(f"Cut off after {deadline}s")
+                self.sessions.close_shell(host_out.host)
+        return output
+
+    async def _shell_host(self, host_out, command, sudo, timeout, timings):
+        try:
+            await asyncio.wait_for(
+                self._limited(self._shell_run(host_out, command, sudo, timings)),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            host_out.exception = HostTimeout(f"Cut off after {timeout}s")
+            self.sessions.close_shell(host_out.host)
+        except Exception as e:
+            host_out.exception = e
+            self.sessions.close_shell(host_out.host)
+        finally:
+            host_out.finished = time.time()
+            timings.finish(host_out.host)
+
+    async def _shell_run(self, host_out, command, sudo, timings):
+        host = host_out.host
+        try:
+            shell = await self.sessions.shell(host, timings)
+        except (asyncssh.ChannelOpenError, asyncssh.DisconnectError, OSError):
+            self.sessions.clients.pop(host, None)
+            self.sessions.sudo.pop(host, None)
+            shell = await self.sessions.shell(host, timings)
+        host_out.client = shell
+        if sudo:
+            if time.time() - shell.sudo >= SUDO_REFRESH:
+                lines = []
+                validate = sudo_validate_command(self.password(host))
+                with timings.timed(host, "sudo"):
+                    code = await shell.run(validate, lines)
+                if code != 0:
+                    host_out.lines += lines
+                    raise SudoException(f"sudo -v failed on {host}")
+                shell.sudo = time.time()
+            command = sudo_command(command, True)
+        timings.start(host)
+        host_out.exit_code = await shell.run(command, host_out.lines)
+
+    @staticmethod
+    async def _pump(reader, host_out, stream):
+        async for line in reader:
+            host_out.put(stream, line.rstrip("\r\n"))
+
+    def join(self, output, timeout=None):
+        futures = {host_out.future: host_out for host_out in output}
+        done, pending = concurrent.futures.wait(list(futures.keys()), timeout)
+        for f in pending:
+            f.cancel()
+        concurrent.futures.wait(pending)
+        return [futures[f].host for f in pending]
+
+    def probe(self, hosts, timeout=None, command="true", sudo=False):
+        return self.submit(self._probe(hosts, timeout, command, sudo)).result()
+
+    async def _probe(self, hosts, timeout, command, sudo):
+        results = await asyncio.gather(
+            *[self._limited(self._probe_host(h, timeout, command, sudo)) for h in hosts]
+        )
+        return {h: e for h, e in zip(hosts, results) if e is not None}
+
+    async def _probe_host(self, host, timeout, command, sudo):
+        try:
+            conn = await asyncio.wait_for(
+                self.sessions.connect(host, keepalive_seconds=0), timeout
+            )
+            try:
+                stdin = None
+                if sudo:
+                    command = sudo_command(command)
+                    stdin = f"{self.password(host)}\n"
+                result = await asyncio.wait_for(conn.run(command, input=stdin), timeout)
+                if result.exit_status != 0:
+                    return ProbeException(f"Exit code {result.exit_status}")
+            finally:
+                conn.close()
+        except asyncio.TimeoutError:
+            return HostTimeout(f"No login after {timeout}s")
+        except Exception as e:
+            return e
+
+    def wait_host(self, host_out):
+        concurrent.futures.wait([host_out.future])
+
+    def cancel(self, output):
+        for host_out in output:
+            host_out.future.cancel()
+
+    def iter_lines(self, output, stderr=False, timeout=None):
+        # Every bit of output pushes its host onto the shared notify queue, so
+        # one blocking get wakes us for whichever host has something new.
+        # Each host's stdout is drained before its stderr.
+        if len(output) == 0:
+            return
+        notify = output[0]._notify
+        pending = {}
+        for host_out in output:
+            pending[host_out] = [host_out._stdout]
+            if stderr:
+                pending[host_out].append(host_out._stderr)
+        deadline = None if timeout is None else time.time() + timeout
+        while len(pending) != 0:
+            try:
+                wait = None if deadline is None else max(0, deadline - time.time())
+                host_out = notify.get(timeout=wait)
+            except queue.Empty:
+                # Cancelling runs each host's finish(), which ends its streams
+                self.cancel(list(pending.keys()))
+                deadline = None
+                continue
+            if host_out not in pending:
+                continue
+            queues = pending[host_out]
+            while len(queues) != 0:
+                try:
+                    line = queues[0].get_nowait()
+                except queue.Empty:
+                    break
+                if line is None:
+                    queues.pop(0).put(None)
+                    continue
+                yield (host_out, line)
+            if len(queues) == 0:
+                del pending[host_out]
+                yield (host_out, None)
+
+    def close(self):
+        self.sessions.disconnect_all()
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,280 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+from colorama import Fore, Style
+
+from .monitor import counters_command, parse_counters
+from .ruleset import parse_save
+
+# Prints which firewall a host runs: nftables when nft is installed and
+# iptables is missing or only the nf_tables shim, iptables otherwise
+DETECT_COMMAND = (
+    "if command -v nft >/dev/null 2>&1 && "
+    "{ ! command -v iptables >/dev/null 2>&1 || iptables -V 2>/dev/null | grep -q nf_tables; }; "
+    "then echo nftables; else echo iptables; fi"
+)
+
+# Values of the firewall setting
+FIREWALLS = ("auto", "iptables", "nftables")
+
+
+class FirewallBackend(object):
+    """The commands one kind of host firewall is read and changed with
+
+    IPTablesManager works on iptables rule specs (Table and Rule) whatever
+    the host runs. A backend turns them into the host's own commands and
+    payloads, and the host's output back into them.
+    """
+
+    # Name shown for hosts using the backend
+    name = None
+    # Whether the host takes delta (positional --noflush) restores
+    delta = False
+
+    def list_command(self, tables, verbose):
+        """Builds the command that lists tables for people to read
+
+        Args:
+            tables ([str]): Table names
+            verbose (bool): Show counters
+
+        Returns:
+            str: Command
+        """
+        raise NotImplementedError
+
+    def save_command(self, tables):
+        """Builds the command whose output parse_saves takes
+
+        Args:
+            tables ([str]): Table names
+
+        Returns:
+            str: Command
+        """
+        raise NotImplementedError
+
+    def parse_saves(self, lines, tables):
+        """Turns save_command output into `save` text (`iptables -S` per table)
+
+        Args:
+            lines ([str]): Output lines
+            tables ([str]): Table names
+
+        Returns:
+            str: Saved rules text
+        """
+        raise NotImplementedError
+
+    def fetch_command(self, tables):
+        """Builds the command whose output parse_fetch takes
+
+        Args:
+            tables ([str]): Table names
+
+        Returns:
+            str: Command
+        """
+        raise NotImplementedError
+
+    def parse_fetch(self, lines, tables):
+        """Parses fetch_command output, counters included
+
+        Args:
+            lines ([str]): Output lines
+            tables ([str]): Table names
+
+        Returns:
+            {str: Table}: Tables by name
+        """
+        raise NotImplementedError
+
+    def counters_command(self, tables):
+        return self.fetch_command(tables)
+
+    def parse_counters(self, lines, tables):
+        """Parses counters_command output like monitor.parse_counters
+
+        Args:
+            lines ([str]): Output lines
+            tables ([str]): Table names
+
+        Returns:
+            {str: ([str], [(int, int)])}: table -> (chain of each rule, (packets, bytes) of each rule)
+        """
+        counts = {}
+        for name, table in self.parse_fetch(lines, tables).items():
+            rules = table.all_rules()
+            counts[name] = (
+                [r.chain for r in rules],
+                [(r.packets or 0, r.bytes or 0) for r in rules],
+            )
+        return counts
+
+    def restore_command(self, delta=False, counters=False):
+        """Builds the command that loads a restore payload from stdin
+
+        Args:
+            delta (bool, optional): The payload is a delta. Defaults to False.
+            counters (bool, optional): The payload carries counters. Defaults to False.
+
+        Returns:
+            str: Command
+        """
+        raise NotImplementedError
+
+    def restore_payload(self, payload, delta=False, counters=False):
+        """Turns an iptables-restore payload into what restore_command takes
+
+        Args:
+            payload (str): iptables-restore payload
+            delta (bool, optional): The payload is a delta. Defaults to False.
+            counters (bool, optional): Keep the payload's counters. Defaults to False.
+
+        Returns:
+            str: Payload
+        """
+        raise NotImplementedError
+
+    def iptables_command(self, arg):
+        """Builds the command an `iptables` change runs as
+
+        Args:
+            arg (str): iptables arguments
+
+        Returns:
+            str: Command
+        """
+        raise NotImplementedError
+
+    def backup_command(self, tables):
+        """Builds the command whose output backup takes
+
+        Args:
+            tables ([str]): Table names
+
+        Returns:
+            str: Command
+        """
+        raise NotImplementedError
+
+    def backup(self, lines):
+        """Turns backup_command output into what backup_restore_command takes
+
+        Args:
+            lines ([str]): Output lines
+
+        Returns:
+            str: Payload
+        """
+        raise NotImplementedError
+
+    def backup_restore_command(self):
+        raise NotImplementedError
+
+    def save_to(self, path):
+        """Builds the command that saves the whole firewall to a file on the host
+
+        Args:
+            path (str): File
+
+        Returns:
+            str: Command
+        """
+        raise NotImplementedError
+
+    def restore_from(self, path):
+        """Builds the command that puts back a file from save_to
+
+        Args:
+            path (str): File
+
+        Returns:
+            str: Command
+        """
+        raise NotImplementedError
+
+
+class IPTablesBackend(FirewallBackend):
+    """Hosts managed with the iptables commands"""
+
+    name = "iptables"
+    delta = True
+
+    def list_command(self, tables, verbose):
+        return "&&".join(
+            [
+                f'printf "\\n{Fore.YELLOW + table + Style.RESET_ALL}\\n" && iptables -L -t{table} --line-numbers{" -v" if verbose else ""}'
+                for table in tables
+            ]
+        )
+
+    def save_command(self, tables):
+        return "&&".join(
+            [f'printf "\\n{table}\\n" && iptables -S -t{table}' for table in tables]
+        )
+
+    def parse_saves(self, lines, tables):
+        return "".join([f"{line}\n" for line in lines])
+
+    def fetch_command(self, tables):
+        return " && ".join([f"iptables-save -c -t {table}" for table in tables])
+
+    def parse_fetch(self, lines, tables):
+        return parse_save(lines)
+
+    def counters_command(self, tables):
+        # Only counters and chains, so polls don't transfer rule text
+        return counters_command(tables)
+
+    def parse_counters(self, lines, tables):
+        return parse_counters(lines)
+
+    def restore_command(self, delta=False, counters=False):
+        return (
+            "iptables-restore"
+            + (" --noflush" if delta else "")
+            + (" -c" if counters else "")
+        )
+
+    def restore_payload(self, payload, delta=False, counters=False):
+        return payload
+
+    def iptables_command(self, arg):
+        return f"iptables {arg}"
+
+    def backup_command(self, tables):
+        return self.fetch_command(tables)
+
+    def backup(self, lines):
+        return "".join([f"{line}\n" for line in lines])
+
+    def backup_restore_command(self):
+        return "iptables-restore -c"
+
+    def save_to(self, path):
+        return f"iptables-save > {path}"
+
+    def restore_from(self, path):
+        return f"iptables-restore < {path}"
+
+
+def detected(lines):
+    """Reads DETECT_COMMAND output
+
+    Args:
+        lines ([str]): Output lines
+
+    Returns:
+        str: "nftables" or "iptables"
+    """
+    return (
+        "nftables" if any(line.strip() == "nftables" for line in lines) else "iptables"
+    )
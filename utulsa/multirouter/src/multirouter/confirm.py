@@ -0,0 +1,88 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+import os
+import time
+
+# Where each host keeps the rules and timer pid of a pending change
+CONFIRM_DIR = "/var/tmp/multirouter"
+
+# These all run under `sudo $SHELL -c '...'`, so they can't hold single quotes
+
+
+def new_token():
+    """Makes a name for one change's files on the hosts
+
+    Returns:
+        str: Token, unique per change
+    """
+    return f"{int(time.time())}-{os.getpid()}"
+
+
+def arm_command(token, seconds, backend):
+    """Saves the live rules and starts a timer that restores them
+
+    The timer is detached from the SSH session, so it still fires if the
+    change cuts the session off.
+
+    Args:
+        token (str): Token from new_token
+        seconds (int): Seconds until the rules are restored
+        backend (FirewallBackend): Host's firewall
+
+    Returns:
+        str: Command
+    """
+    d, rules, pid = _paths(token)
+    return (
+        f"umask 077 && mkdir -p {d} && {backend.save_to(rules)} && "
+        f'{{ nohup sh -c "sleep {int(seconds)} && {backend.restore_from(rules)} && '
+        f'rm -f {rules} {pid}" </dev/null >/dev/null 2>&1 & echo $! > {pid}; }}'
+    )
+
+
+def cancel_command(token):
+    """Stops the timer, keeping the change
+
+    Fails if the timer already fired.
+
+    Args:
+        token (str): Token from new_token
+
+    Returns:
+        str: Command
+    """
+    d, rules, pid = _paths(token)
+    return f"kill $(cat {pid}) && rm -f {rules} {pid}"
+
+
+def revert_command(token, backend):
+    """Stops the timer and restores the saved rules right away
+
+    Args:
+        token (str): Token from new_token
+        backend (FirewallBackend): Host's firewall
+
+    Returns:
+        str: Command
+    """
+    d, rules, pid = _paths(token)
+    return (
+        f"kill $(cat {pid}) 2>/dev/null; "
+        f"{backend.restore_from(rules)} && rm -f {rules} {pid}"
+    )
+
+
+def _paths(token):
+    return (
+        CONFIRM_DIR,
+        f"{CONFIRM_DIR}/{token}.rules",
+        f"{CONFIRM_DIR}/{token}.pid",
+    )
@@ -0,0 +1,231 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+from colorama import Fore, Style
+
+from .ruleset import Table, subtract
+
+# Past this many edits in one chain a delta isn't worth it over a full restore
+MAX_EDITS = 1000
+
+
+class ChainDiff(object):
+    """Rules to add and delete to turn one chain into another"""
+
+    def __init__(self, table, chain, added, removed, policy=None, status=None):
+        """Initializes ChainDiff
+
+        Args:
+            table (str): Table name
+            chain (str): Chain name
+            added ([Rule]): Rules only in the new chain
+            removed ([Rule]): Rules only in the old chain
+            policy ((str, str), optional): (old, new) policy if it changed. Defaults to None.
+            status (str, optional): "new" or "deleted" if the chain only exists on one side. Defaults to None.
+        """
+        self.table = table
+        self.chain = chain
+        self.added = added
+        self.removed = removed
+        self.policy = policy
+        self.status = status
+
+    def __len__(self):
+        return len(self.added) + len(self.removed)
+
+    def lines(self):
+        """Formats the diff with + and - markers
+
+        Returns:
+            [str]: Colorized lines
+        """
+        header = f"{self.table} {self.chain}"
+        if self.status is not None:
+            header += f" ({self.status})"
+        lines = [Fore.YELLOW + header + Style.RESET_ALL]
+        if self.policy is not None:
+            lines.append(f"  policy {self.policy[0]} -> {self.policy[1]}")
+        lines += [f"{Fore.RED}- {r}{Style.RESET_ALL}" for r in self.removed]
+        lines += [f"{Fore.GREEN}+ {r}{Style.RESET_ALL}" for r in self.added]
+        return lines
+
+
+def diff_tables(new, old, tables=None):
+    """Diffs two sets of tables chain by chain
+
+    Rules are matched by hash, so the cost is linear in the number of rules.
+
+    Args:
+        new ({str: Table}): Tables being compared
+        old ({str: Table}): Baseline tables
+        tables ([str], optional): Only diff these tables. Defaults to every table on either side.
+
+    Returns:
+        [ChainDiff]: Chains that differ
+    """
+    if tables is None:
+        tables = list(new.keys()) + [t for t in old.keys() if t not in new]
+    diffs = []
+    for name in tables:
+        if name not in new and name not in old:
+            continue
+        nt = new.get(name, Table(name))
+        ot = old.get(name, Table(name))
+        chains = nt.chains + [c for c in ot.chains if c not in nt.rules]
+        for chain in chains:
+            n = nt.rules.get(chain, [])
+            o = ot.rules.get(chain, [])
+            status = None
+            if chain not in ot.rules:
+                status = "new"
+            elif chain not in nt.rules:
+                status = "deleted"
+            policy = None
+            if nt.policies.get(chain) != ot.policies.get(chain) and status is None:
+                policy = (ot.policies.get(chain), nt.policies.get(chain))
+            d = ChainDiff(name, chain, subtract(n, o), subtract(o, n), policy, status)
+            if len(d) != 0 or policy is not None or status is not None:
+                diffs.append(d)
+    return diffs
+
+
+def edit_script(a, b, max_edits=None):
+    """Shortest sequence of deletes and inserts turning a into b
+
+    Uses Myers' O((N + M) * D) algorithm after trimming the common prefix and
+    suffix, so small edits to long chains stay cheap.
+
+    Args:
+        a ([Rule]): Current rules
+        b ([Rule]): Wanted rules
+        max_edits (int, optional): Give up past this many edits. Defaults to None.
+
+    Returns:
+        [(str, Rule)]: ("=", rule), ("-", rule) or ("+", rule) steps in order, or None if over max_edits
+    """
+    n = len(a)
+    m = len(b)
+    start = 0
+    while start < n and start < m and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < n - start and end < m - start and a[n - 1 - end] == b[m - 1 - end]:
+        end += 1
+    middle = _myers(a[start : n - end], b[start : m - end], max_edits)
+    if middle is None:
+        return None
+    head = [("=", r) for r in a[:start]]
+    tail = [("=", r) for r in a[n - end :]]
+    return head + middle + tail
+
+
+def _myers(a, b, max_edits):
+    n = len(a)
+    m = len(b)
+    max_d = n + m if max_edits is None else min(max_edits, n + m)
+    v = {1: 0}
+    trace = []
+    for d in range(max_d + 1):
+        trace.append(dict(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                return _backtrack(a, b, trace)
+    return None
+
+
+def _backtrack(a, b, trace):
+    x = len(a)
+    y = len(b)
+    script = []
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            script.append(("=", a[x - 1]))
+            x -= 1
+            y -= 1
+        if d > 0:
+            if x == prev_x:
+                script.append(("+", b[y - 1]))
+            else:
+                script.append(("-", a[x - 1]))
+        x = prev_x
+        y = prev_y
+    script.reverse()
+    return script
+
+
+def delta_restore(live, target, tables, max_edits=MAX_EDITS):
+    """Builds an `iptables-restore --noflush` payload with only the changes
+
+    Each chain gets the deletes and positional inserts from edit_script,
+    applied in order so the positions line up. New chains are declared
+    first and chains missing from target are flushed and deleted last,
+    after any rules jumping to them are gone.
+
+    Args:
+        live ({str: Table}): Tables currently on the host
+        target ({str: Table}): Tables to end up with
+        tables ([str]): Tables to touch
+        max_edits (int, optional): Per chain edit limit. Defaults to MAX_EDITS.
+
+    Returns:
+        str: Payload ("" if nothing changed), or None if a chain needs more than max_edits
+    """
+    payload = []
+    for name in tables:
+        if name not in target:
+            continue
+        lt = live.get(name, Table(name))
+        tt = target[name]
+        header = []
+        ops = []
+        for chain in tt.chains:
+            policy = tt.policies.get(chain)
+            if chain not in lt.rules:
+                header.append(f":{chain} {policy if policy else '-'} [0:0]")
+            elif policy is not None and policy != lt.policies.get(chain):
+                header.append(f":{chain} {policy} [0:0]")
+        for chain in tt.chains:
+            script = edit_script(lt.rules.get(chain, []), tt.rules[chain], max_edits)
+            if script is None:
+                return None
+            pos = 1
+            for op, r in script:
+                if op == "=":
+                    pos += 1
+                elif op == "-":
+                    ops.append(f"-D {chain} {pos}")
+                else:
+                    ops.append(f"-I {chain} {pos} {r.spec}".rstrip())
+                    pos += 1
+        removed = [c for c in lt.chains if c not in tt.rules]
+        ops += [f"-F {c}" for c in removed]
+        ops += [f"-X {c}" for c in removed]
+        if len(header) != 0 or len(ops) != 0:
+            payload += [f"*{name}"] + header + ops + ["COMMIT"]
+    if len(payload) == 0:
+        return ""
+    return "\n".join(payload) + "\n"
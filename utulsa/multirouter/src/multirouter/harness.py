@@ -0,0 +1,951 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+import argparse
+import asyncio
+import copy
+import os
+import random
+import re
+import shlex
+import subprocess
+import sys
+import threading
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+from .backend import DETECT_COMMAND
+from .host import Credential, Host
+from .ruleset import Rule, Table
+
+# Port every fake router listens on; each gets its own loopback address
+FLEET_PORT = 2222
+
+# Seconds each emulated iptables process costs (spawn, xtables lock, commit)
+EXEC_DELAY = 0.002
+
+BUILTIN_CHAINS = {
+    "filter": ["INPUT", "FORWARD", "OUTPUT"],
+    "nat": ["PREROUTING", "INPUT", "OUTPUT", "POSTROUTING"],
+    "mangle": ["PREROUTING", "INPUT", "FORWARD", "OUTPUT", "POSTROUTING"],
+    "raw": ["PREROUTING", "OUTPUT"],
+}
+
+# sudo's flags, then either a command for $SHELL or -v. Every sudo command
+# multirouter sends has one of these two shapes.
+SUDO = re.compile(r"sudo ((?:\S+ )*?)(?:\$SHELL -c '(.*)'|-v)$", re.S)
+
+# The commands commit confirm sends (see confirm.py) for iptables hosts:
+# arming saves the rules and starts the timer, cancelling kills it and
+# reverting kills it and restores the rules
+ARM = re.compile(
+    r"umask 077 && mkdir -p \S+ && iptables-save > (\S+) && "
+    r'\{ nohup sh -c "sleep (\d+) && .* & echo \$! > (\S+); \}$',
+    re.S,
+)
+CANCEL = re.compile(r"kill \$\(cat (\S+)\) && rm -f (\S+) \S+$", re.S)
+REVERT = re.compile(
+    r"kill \$\(cat (\S+)\) 2>/dev/null; iptables-restore < (\S+) && .*$", re.S
+)
+
+NOT_ROOT = (
+    "iptables v1.8.7 (legacy): can't initialize iptables table `filter': "
+    "Permission denied (you must be root)\n"
+)
+
+
+class HarnessException(Exception):
+    pass
+
+
+class IPTablesError(Exception):
+    pass
+
+
+class FakeRouter(object):
+    """Emulates one router's sudo, shell and iptables over SSH
+
+    Commands are parsed rather than run: `&&` and `;` lists of true, false,
+    echo, printf, iptables, iptables-save and iptables-restore are
+    understood, anything else fails like a missing command. Interactive
+    shells and redirections aren't emulated, other than in the commands
+    commit confirm and firewall detection send.
+    """
+
+    def __init__(
+        self,
+        user,
+        password,
+        rules=0,
+        latency=0.0,
+        exec_delay=EXEC_DELAY,
+        fail_rate=0.0,
+        drop_rate=0.0,
+        sudo_delay=0.0,
+        seed=None,
+    ):
+        """Initializes FakeRouter
+
+        Args:
+            user (str): Login user
+            password (str): Login and sudo password
+            rules (int, optional): Synthetic rules in filter INPUT. Defaults to 0.
+            latency (float, optional): Seconds added before every command. Defaults to 0.0.
+            exec_delay (float, optional): Seconds each iptables process costs. Defaults to EXEC_DELAY.
+            fail_rate (float, optional): Chance a command fails outright. Defaults to 0.0.
+            drop_rate (float, optional): Chance a command drops the connection. Defaults to 0.0.
+            sudo_delay (float, optional): Seconds sudo takes to answer. Defaults to 0.0.
+            seed (int, optional): Seed for counters and failures. Defaults to None.
+        """
+        self.user = user
+        self.password = password
+        self.latency = latency
+        self.exec_delay = exec_delay
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self.sudo_delay = sudo_delay
+        self.random = random.Random(seed)
+        self.tables = {name: builtin_table(name) for name in ("filter", "nat")}
+        for line in synthetic_rules(rules, seed if seed is not None else 0):
+            self.tables["filter"].add_rule(parse_rule(line[len("-A ") :]))
+        # Connections that have run `sudo -v`, like sudo's per-parent timestamps
+        self.validated = set()
+        # Commit confirm's saved rules and timers, by file
+        self.files = {}
+        self.timers = {}
+        self.commands = 0
+
+    async def handle(self, process):
+        # asyncssh process_factory: runs one exec request to completion
+        conn = process.get_extra_info("connection")
+        command = process.command
+        if command is None:
+            process.stderr.write("fake router: interactive shells aren't emulated\n")
+            process.exit(127)
+            return
+        self.commands += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        if self.random.random() < self.drop_rate:
+            conn.abort()
+            return
+        if self.random.random() < self.fail_rate:
+            process.stderr.write("fake router: injected failure\n")
+            process.exit(1)
+            return
+        out = []
+        err = []
+        code = await self.execute(command, process.stdin, conn, out, err)
+        process.stdout.write("".join(out))
+        process.stderr.write("".join(err))
+        process.exit(code)
+
+    async def execute(self, command, stdin, conn, out, err):
+        """Runs a command line as the login user
+
+        Args:
+            command (str): Command line
+            stdin (SSHReader): Command's stdin
+            conn (SSHServerConnection): Connection it came in on
+            out ([str]): Collects stdout
+            err ([str]): Collects stderr
+
+        Returns:
+            int: Exit code
+        """
+        m = SUDO.match(command)
+        if m is None:
+            return await self.shell(command, stdin, False, out, err)
+        if self.sudo_delay > 0:
+            await asyncio.sleep(self.sudo_delay)
+        flags = m.group(1).split()
+        if "-n" in flags and conn not in self.validated:
+            err.append("sudo: a password is required\n")
+            return 1
+        elif "-S" in flags:
+            password = await stdin.readline()
+            if password.rstrip("\n") != self.password:
+                err.append("Sorry, try again.\nsudo: 1 incorrect password attempt\n")
+                return 1
+            if m.group(2) is None and "-k" not in flags:
+                self.validated.add(conn)
+        if m.group(2) is None:
+            return 0
+        if m.group(2) == DETECT_COMMAND:
+            # Fake routers only run iptables
+            out.append("iptables\n")
+            return 0
+        code = self.confirm(m.group(2), err)
+        if code is not None:
+            return code
+        return await self.shell(m.group(2), stdin, True, out, err)
+
+    def confirm(self, command, err):
+        """Runs a commit confirm command as root
+
+        Args:
+            command (str): Command line
+            err ([str]): Collects stderr
+
+        Returns:
+            int: Exit code, or None if it isn't a commit confirm command
+        """
+        m = ARM.match(command)
+        if m is not None:
+            rules, seconds, pid = m.groups()
+            self.files[rules] = copy.deepcopy(self.tables)
+            self.timers[pid] = asyncio.get_event_loop().call_later(
+                int(seconds), self.restore, rules, pid
+            )
+            return 0
+        m = CANCEL.match(command)
+        if m is not None:
+            pid, rules = m.groups()
+            timer = self.timers.pop(pid, None)
+            if timer is None:
+                err.append(f"cat: {pid}: No such file or directory\n")
+                return 1
+            timer.cancel()
+            self.files.pop(rules, None)
+            return 0
+        m = REVERT.match(command)
+        if m is not None:
+            pid, rules = m.groups()
+            timer = self.timers.pop(pid, None)
+            if timer is not None:
+                timer.cancel()
+            if rules not in self.files:
+                err.append(f"sh: 1: cannot open {rules}: No such file\n")
+                return 2
+            self.restore(rules, pid)
+            return 0
+        return None
+
+    def restore(self, rules, pid):
+        # The timer firing, or a revert
+        self.tables = self.files.pop(rules)
+        self.timers.pop(pid, None)
+
+    async def shell(self, command, stdin, root, out, err):
+        try:
+            lexer = shlex.shlex(command, posix=True, punctuation_chars=";&|<>")
+            lexer.whitespace_split = True
+            tokens = list(lexer)
+        except ValueError as e:
+            err.append(f"sh: 1: Syntax error: {e}\n")
+            return 2
+        code = 0
+        args = []
+        for token in tokens + [";"]:
+            if token not in ("&&", ";"):
+                args.append(token)
+                continue
+            if len(args) != 0:
+                code = await self.pipeline(args, stdin, root, out, err)
+            args = []
+            if token == "&&" and code != 0:
+                return code
+        return code
+
+    async def pipeline(self, args, stdin, root, out, err):
+        # Only filters (sed) are emulated after the first command of a pipe
+        stages = [[]]
+        for a in args:
+            if a == "|":
+                stages.append([])
+            else:
+                stages[-1].append(a)
+        if any(len(stage) == 0 for stage in stages):
+            err.append('sh: 1: Syntax error: "|" unexpected\n')
+            return 2
+        piped = []
+        code = await self.run(
+            stages[0], stdin, root, piped if len(stages) > 1 else out, err
+        )
+        for i, stage in enumerate(stages[1:], 1):
+            if stage[0] != "sed":
+                err.append(f"sh: 1: {stage[0]}: not found\n")
+                return 127
+            try:
+                lines = sed(stage[1:], "".join(piped))
+            except HarnessException as e:
+                err.append(f"sed: {e}\n")
+                return 1
+            piped = []
+            (out if i == len(stages) - 1 else piped).extend(lines)
+            code = 0
+        return code
+
+    async def run(self, args, stdin, root, out, err):
+        name = args[0]
+        if any(a[0] in "<>" for a in args):
+            err.append("sh: 1: pipes and redirections aren't emulated\n")
+            return 2
+        if name == "true":
+            return 0
+        if name == "false":
+            return 1
+        if name == "echo":
+            out.append(" ".join(args[1:]) + "\n")
+            return 0
+        if name == "printf":
+            out.append(printf(args[1], args[2:]) if len(args) > 1 else "")
+            return 0
+        if name not in ("iptables", "iptables-save", "iptables-restore"):
+            err.append(f"sh: 1: {name}: not found\n")
+            return 127
+        if not root:
+            err.append(NOT_ROOT)
+            return 4
+        if self.exec_delay > 0:
+            await asyncio.sleep(self.exec_delay)
+        try:
+            if name == "iptables":
+                out += self.iptables(args[1:])
+            elif name == "iptables-save":
+                out += self.iptables_save(args[1:])
+            else:
+                self.iptables_restore(args[1:], await stdin.read())
+        except IPTablesError as e:
+            err.append(f"{e}\n")
+            return 1
+        return 0
+
+    def iptables(self, args):
+        """Emulates `iptables`
+
+        Args:
+            args ([str]): Arguments
+
+        Returns:
+            [str]: Output
+        """
+        name, args = pop_table(args)
+        table = self.table(name)
+        args = [
+            a for a in args if a not in ("-w", "--wait", "-n", "-v", "--line-numbers")
+        ]
+        if len(args) == 0:
+            raise IPTablesError("iptables v1.8.7 (legacy): no command specified")
+        op = args[0]
+        if op in ("-S", "--list-rules"):
+            lines = table.to_lines()
+            if len(args) > 1:
+                self.chain(table, args[1])
+                lines = [l for l in lines if l.split()[1] == args[1]]
+            return [f"{l}\n" for l in lines]
+        if op in ("-L", "--list"):
+            chains = table.chains if len(args) == 1 else [self.chain(table, args[1])]
+            return list_table(table, chains)
+        if op in ("-Z", "--zero"):
+            for r in table.all_rules():
+                r.packets = 0
+                r.bytes = 0
+            return []
+        apply_line(table, " ".join(quote(a) for a in args))
+        return []
+
+    def iptables_save(self, args):
+        """Emulates `iptables-save`, ticking counters to fake traffic
+
+        Args:
+            args ([str]): Arguments
+
+        Returns:
+            [str]: Output
+        """
+        name, args = pop_table(args)
+        counters = "-c" in args or "--counters" in args
+        names = list(self.tables.keys()) if name is None else [name]
+        out = ["# Generated by multirouter fake router\n"]
+        for name in names:
+            table = self.table(name)
+            out.append(f"*{name}\n")
+            for chain in table.chains:
+                out.append(f":{chain} {table.policies.get(chain, '-')} [0:0]\n")
+            for r in table.all_rules():
+                if counters:
+                    r.packets += self.random.randrange(0, 100)
+                    r.bytes += r.packets * 64
+                    out.append(f"[{r.packets}:{r.bytes}] {r}\n")
+                else:
+                    out.append(f"{r}\n")
+            out.append("COMMIT\n")
+        return out
+
+    def iptables_restore(self, args, payload):
+        """Emulates `iptables-restore`, committing all tables or none
+
+        Args:
+            args ([str]): Arguments
+            payload (str): Restore file from stdin
+        """
+        noflush = "-n" in args or "--noflush" in args
+        counters = "-c" in args or "--counters" in args
+        tables = {}
+        table = None
+        for n, line in enumerate(payload.split("\n"), 1):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            try:
+                if line.startswith("*"):
+                    name = line[1:]
+                    if noflush:
+                        table = copy.deepcopy(self.table(name))
+                    else:
+                        table = builtin_table(name, self.tables.get(name))
+                elif table is None:
+                    raise IPTablesError("no table")
+                elif line == "COMMIT":
+                    tables[table.name] = table
+                    table = None
+                elif line.startswith(":"):
+                    declare_chain(table, line[1:].split(), noflush)
+                else:
+                    packets = 0
+                    bytes = 0
+                    if line.startswith("["):
+                        c, line = line[1:].split("]", 1)
+                        if counters:
+                            packets, bytes = (int(x) for x in c.split(":"))
+                        line = line.strip()
+                    apply_line(table, line, packets, bytes)
+            except (IPTablesError, ValueError):
+                raise IPTablesError(f"iptables-restore: line {n} failed")
+        if table is not None:
+            raise IPTablesError("iptables-restore: COMMIT expected at end of input")
+        self.tables.update(tables)
+
+    def table(self, name):
+        if name is None:
+            name = "filter"
+        if name not in self.tables:
+            if name not in BUILTIN_CHAINS:
+                raise IPTablesError(
+                    f"iptables v1.8.7 (legacy): can't initialize iptables table `{name}': "
+                    "Table does not exist (do you need to insmod?)"
+                )
+            self.tables[name] = builtin_table(name)
+        return self.tables[name]
+
+    @staticmethod
+    def chain(table, chain):
+        if chain not in table.rules:
+            raise IPTablesError("iptables: No chain/target/match by that name.")
+        return chain
+
+
+class FakeServer(asyncssh.SSHServer if asyncssh is not None else object):
+    """One SSH connection to a FakeRouter"""
+
+    def __init__(self, router):
+        self.router = router
+        self.conn = None
+
+    def connection_made(self, conn):
+        self.conn = conn
+
+    def connection_lost(self, exc):
+        self.router.validated.discard(self.conn)
+
+    def begin_auth(self, username):
+        return True
+
+    def password_auth_supported(self):
+        return True
+
+    def validate_password(self, username, password):
+        return username == self.router.user and password == self.router.password
+
+
+class FakeFleet(object):
+    """A set of fake routers listening on loopback addresses
+
+    Router i listens on address(i) at the same port, so each looks like its
+    own host. By default the routers run in a subprocess, so their CPU time
+    isn't charged to the client being measured.
+    """
+
+    def __init__(
+        self,
+        count,
+        port=FLEET_PORT,
+        user="admin",
+        password="password",
+        rules=0,
+        latency=0.0,
+        exec_delay=EXEC_DELAY,
+        fail_rate=0.0,
+        drop_rate=0.0,
+        sudo_delay=0.0,
+        in_process=False,
+    ):
+        """Initializes FakeFleet
+
+        Args:
+            count (int): Number of routers
+            port (int, optional): Port they listen on. Defaults to FLEET_PORT.
+            user (str, optional): Login user. Defaults to "admin".
+            password (str, optional): Login and sudo password. Defaults to "password".
+            rules (int, optional): Synthetic rules per router. Defaults to 0.
+            latency (float, optional): Seconds added before every command. Defaults to 0.0.
+            exec_delay (float, optional): Seconds each iptables process costs. Defaults to EXEC_DELAY.
+            fail_rate (float, optional): Chance a command fails outright. Defaults to 0.0.
+            drop_rate (float, optional): Chance a command drops the connection. Defaults to 0.0.
+            sudo_delay (float, optional): Seconds sudo takes to answer. Defaults to 0.0.
+            in_process (bool, optional): Serve from a thread instead of a subprocess. Defaults to False.
+        """
+        self.count = count
+        self.port = port
+        self.user = user
+        self.password = password
+        self.rules = rules
+        self.latency = latency
+        self.exec_delay = exec_delay
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self.sudo_delay = sudo_delay
+        self.in_process = in_process
+        self.process = None
+        self.loop = None
+        self.routers = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def addresses(self):
+        return [address(i) for i in range(self.count)]
+
+    def hosts(self):
+        """Builds a Host for each router
+
+        Router i is in group g(i % 10) and tagged t(i % 3), so selections
+        have something to work with.
+
+        Returns:
+            [Host]: Hosts
+        """
+        cred = Credential(self.user, self.password)
+        return [
+            Host(a, cred, port=self.port, groups=[f"g{i % 10}"], tags=[f"t{i % 3}"])
+            for i, a in enumerate(self.addresses())
+        ]
+
+    def load_file(self):
+        """Builds a load file for run.py
+
+        Returns:
+            dict: Load file contents
+        """
+        return {
+            "hosts": [
+                {
+                    "host": h.host,
+                    "user": self.user,
+                    "password": self.password,
+                    "port": self.port,
+                    "groups": sorted(h.groups),
+                    "tags": sorted(h.tags),
+                }
+                for h in self.hosts()
+            ]
+        }
+
+    def start(self):
+        if self.in_process:
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, daemon=True).start()
+            future = asyncio.run_coroutine_threadsafe(self.serve(), self.loop)
+            self.routers = future.result()
+            return
+        src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [src] + env.get("PYTHONPATH", "").split(os.pathsep)
+        )
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "multirouter.harness"] + self.args(),
+            stdout=subprocess.PIPE,
+            env=env,
+            universal_newlines=True,
+        )
+        if self.process.stdout.readline().strip() != "ready":
+            self.stop()
+            raise HarnessException("Fake routers didn't start")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+
+    def args(self):
+        return [
+            str(self.count),
+            f"--port={self.port}",
+            f"--user={self.user}",
+            f"--password={self.password}",
+            f"--rules={self.rules}",
+            f"--latency={self.latency}",
+            f"--exec-delay={self.exec_delay}",
+            f"--fail-rate={self.fail_rate}",
+            f"--drop-rate={self.drop_rate}",
+            f"--sudo-delay={self.sudo_delay}",
+        ]
+
+    async def serve(self):
+        """Starts every router's SSH server on the running loop
+
+        Returns:
+            [FakeRouter]: Routers, in address order
+        """
+        if asyncssh is None:
+            raise ImportError("The fake router harness needs asyncssh installed")
+        key = asyncssh.generate_private_key("ssh-ed25519")
+        routers = []
+        for i, a in enumerate(self.addresses()):
+            router = FakeRouter(
+                self.user,
+                self.password,
+                self.rules,
+                self.latency,
+                self.exec_delay,
+                self.fail_rate,
+                self.drop_rate,
+                self.sudo_delay,
+                seed=i,
+            )
+            await asyncssh.create_server(
+                lambda router=router: FakeServer(router),
+                a,
+                self.port,
+                server_host_keys=[key],
+                process_factory=router.handle,
+                encoding="utf-8",
+            )
+            routers.append(router)
+        return routers
+
+
+def address(i):
+    # 127.0.0.0/8 is all loopback on Linux, so every router gets its own IP
+    if i >= 250 * 250:
+        raise HarnessException("At most 62500 fake routers")
+    return f"127.0.{1 + i // 250}.{1 + i % 250}"
+
+
+def synthetic_rules(count, seed=0):
+    """Makes distinct, realistic looking filter INPUT rules
+
+    Args:
+        count (int): Number of rules
+        seed (int, optional): Seed. Defaults to 0.
+
+    Returns:
+        [str]: Rules as `iptables -S` lines
+    """
+    r = random.Random(seed)
+    rules = []
+    for i in range(count):
+        src = f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+        port = r.choice([22, 53, 80, 123, 443, 3306, 5432, 8080])
+        proto = "udp" if port in (53, 123) else "tcp"
+        target = r.choice(["ACCEPT", "ACCEPT", "DROP"])
+        rules.append(
+            f"-A INPUT -s {src}/32 -p {proto} -m {proto} --dport {port} -j {target}"
+        )
+    return rules
+
+
+def synthetic_save(count, seed=0):
+    """Makes a saved ruleset in the format `save` writes
+
+    Args:
+        count (int): Number of filter rules
+        seed (int, optional): Seed. Defaults to 0.
+
+    Returns:
+        str: Saved rules text
+    """
+    filter_lines = [f"-P {c} ACCEPT" for c in BUILTIN_CHAINS["filter"]]
+    nat_lines = [f"-P {c} ACCEPT" for c in BUILTIN_CHAINS["nat"]]
+    filter_lines += synthetic_rules(count, seed)
+    return (
+        "\nfilter\n"
+        + "\n".join(filter_lines)
+        + "\n\nnat\n"
+        + "\n".join(nat_lines)
+        + "\n"
+    )
+
+
+def builtin_table(name, current=None):
+    # A flushed table: just the built in chains, keeping current policies
+    table = Table(name)
+    for chain in BUILTIN_CHAINS.get(name, []):
+        policy = "ACCEPT"
+        if current is not None:
+            policy = current.policies.get(chain, policy)
+        table.add_chain(chain, policy)
+    return table
+
+
+def pop_table(args):
+    # Pulls -t/--table out of args, returning (table or None, rest)
+    name = None
+    rest = []
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a in ("-t", "--table") and i + 1 < len(args):
+            name = args[i + 1]
+            i += 2
+            continue
+        if a.startswith("-t") and len(a) > 2 and not a.startswith("--"):
+            name = a[2:]
+        else:
+            rest.append(a)
+        i += 1
+    return (name, rest)
+
+
+def parse_rule(line, packets=0, bytes=0):
+    chain, _, spec = line.partition(" ")
+    return Rule(chain, spec, packets, bytes)
+
+
+def declare_chain(table, args, noflush):
+    # `:chain policy [p:b]` from a restore file. Declaring an existing user
+    # chain flushes it, even with --noflush.
+    chain = args[0]
+    policy = args[1] if len(args) > 1 else "-"
+    builtin = chain in BUILTIN_CHAINS.get(table.name, [])
+    if builtin and policy == "-":
+        raise IPTablesError("Built in chain needs a policy")
+    if not builtin and policy != "-":
+        raise IPTablesError("User chains can't have a policy")
+    if not builtin and chain in table.rules and noflush:
+        table.rules[chain] = []
+    table.add_chain(chain, policy)
+
+
+def apply_line(table, line, packets=0, bytes=0):
+    """Applies one rule change to a table
+
+    Args:
+        table (Table): Table to change
+        line (str): -A, -I, -D, -P, -N, -F or -X line
+        packets (int, optional): Counter for added rules. Defaults to 0.
+        bytes (int, optional): Counter for added rules. Defaults to 0.
+    """
+    op, _, rest = line.partition(" ")
+    chain, _, rest = rest.partition(" ")
+    builtin = BUILTIN_CHAINS.get(table.name, [])
+    if op in ("-N", "--new-chain"):
+        if chain in table.rules:
+            raise IPTablesError("iptables: Chain already exists.")
+        table.add_chain(chain)
+        return
+    if op in ("-F", "--flush", "-X", "--delete-chain") and chain == "":
+        chains = (
+            table.chains
+            if op in ("-F", "--flush")
+            else [c for c in table.chains if c not in builtin]
+        )
+        for c in list(chains):
+            apply_line(table, f"{op} {c}")
+        return
+    if chain not in table.rules:
+        raise IPTablesError("iptables: No chain/target/match by that name.")
+    rules = table.rules[chain]
+    if op in ("-A", "--append"):
+        rules.append(Rule(chain, rest, packets, bytes))
+    elif op in ("-I", "--insert"):
+        pos, _, spec = rest.partition(" ")
+        if not pos.isdigit():
+            pos, spec = "1", rest
+        if int(pos) < 1 or int(pos) > len(rules) + 1:
+            raise IPTablesError("iptables: Index of insertion too big.")
+        rules.insert(int(pos) - 1, Rule(chain, spec, packets, bytes))
+    elif op in ("-D", "--delete"):
+        if rest.isdigit():
+            if int(rest) < 1 or int(rest) > len(rules):
+                raise IPTablesError("iptables: Index of deletion too big.")
+            del rules[int(rest) - 1]
+        else:
+            try:
+                rules.remove(Rule(chain, rest))
+            except ValueError:
+                raise IPTablesError(
+                    "iptables: Bad rule (does a matching rule exist in that chain?)."
+                )
+    elif op in ("-P", "--policy"):
+        if chain not in builtin:
+            raise IPTablesError("iptables: Bad built-in chain name.")
+        table.policies[chain] = rest
+    elif op in ("-F", "--flush"):
+        table.rules[chain] = []
+    elif op in ("-X", "--delete-chain"):
+        if chain in builtin:
+            raise IPTablesError("iptables: Can't delete built-in chain.")
+        if len(rules) != 0:
+            raise IPTablesError("iptables: Directory not empty.")
+        table.chains.remove(chain)
+        del table.rules[chain]
+    else:
+        raise IPTablesError(f'iptables v1.8.7 (legacy): unknown option "{op}"')
+
+
+def list_table(table, chains):
+    # Rough `iptables -L -n` output
+    out = []
+    for chain in chains:
+        if chain in table.policies:
+            out.append(f"Chain {chain} (policy {table.policies[chain]})\n")
+        else:
+            out.append(f"Chain {chain} (0 references)\n")
+        out.append(f"{'target':<10} {'prot':<4} opt {'source':<20} destination\n")
+        for r in table.rules[chain]:
+            args = r.spec.split()
+            target = option(args, "-j", "")
+            proto = option(args, "-p", "all")
+            src = option(args, "-s", "0.0.0.0/0")
+            dst = option(args, "-d", "0.0.0.0/0")
+            out.append(f"{target:<10} {proto:<4} --  {src:<20} {dst}\n")
+        out.append("\n")
+    return out
+
+
+def option(args, flag, default):
+    if flag in args and args.index(flag) + 1 < len(args):
+        return args[args.index(flag) + 1]
+    return default
+
+
+def printf(fmt, args):
+    # Just enough printf for %s and the usual escapes
+    out = fmt.replace("\\n", "\n").replace("\\t", "\t")
+    for a in args:
+        out = out.replace("%s", a, 1)
+    return out.replace("%s", "")
+
+
+def sed(args, text):
+    """Emulates the `sed -n -e /re/p -e s/re/repl/p` subset that polls use
+
+    Args:
+        args ([str]): Arguments
+        text (str): Input
+
+    Returns:
+        [str]: Output lines
+    """
+    quiet = False
+    scripts = []
+    i = 0
+    while i < len(args):
+        if args[i] == "-n":
+            quiet = True
+        elif args[i] == "-e" and i + 1 < len(args):
+            i += 1
+            scripts.append(args[i])
+        else:
+            scripts.append(args[i])
+        i += 1
+    commands = [sed_command(script) for script in scripts]
+    out = []
+    for line in text.splitlines():
+        for pattern, repl in commands:
+            m = pattern.search(line)
+            if m is None:
+                continue
+            if repl is not None:
+                line = pattern.sub(repl, line, count=1)
+            out.append(f"{line}\n")
+        if not quiet:
+            out.append(f"{line}\n")
+    return out
+
+
+def sed_command(script):
+    # /re/p or s/re/repl/p, with the regex in basic (BRE) syntax
+    if script.startswith("/") and script.endswith("/p"):
+        return (re.compile(bre(script[1:-2])), None)
+    if script.startswith("s/") and script.endswith("/p"):
+        parts = re.split(r"(?<!\\)/", script[2:-2])
+        if len(parts) == 2:
+            return (re.compile(bre(parts[0])), parts[1])
+    raise HarnessException(f"-e expression #1: unsupported command {script}")
+
+
+def bre(pattern):
+    # Basic regex to Python: \( \) group, bare ( ) + ? { } | are literal
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\" and i + 1 < len(pattern):
+            n = pattern[i + 1]
+            out.append(n if n in "(){}|+?" else c + n)
+            i += 2
+            continue
+        out.append("\\" + c if c in "(){}|+?" else c)
+        i += 1
+    return "".join(out)
+
+
+def quote(arg):
+    # iptables -S double quotes arguments with spaces (e.g. comments)
+    return f'"{arg}"' if " " in arg else arg
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve fake routers until killed")
+    parser.add_argument("count", type=int)
+    parser.add_argument("--port", type=int, default=FLEET_PORT)
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--rules", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--exec-delay", type=float, default=EXEC_DELAY)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--sudo-delay", type=float, default=0.0)
+    a = parser.parse_args()
+    fleet = FakeFleet(
+        a.count,
+        a.port,
+        a.user,
+        a.password,
+        a.rules,
+        a.latency,
+        a.exec_delay,
+        a.fail_rate,
+        a.drop_rate,
+        a.sudo_delay,
+    )
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(fleet.serve())
+    print("ready", flush=True)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
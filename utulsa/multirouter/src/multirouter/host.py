@@ -44,17 +44,21 @@ class Credential(object):
 class Host(object):
     """Holds the Host information"""
 
-    def __init__(self, host, cred, port=22):
+    def __init__(self, host, cred, port=22, groups=None, tags=None):
         """Initializes Host
 
         Args:
             host (str): Host name / address
             cred (Credential): Credentials object to log in
             port (int, optional): Port to connect to via SSH. Defaults to 22.
+            groups ([str], optional): Groups the host is in. Defaults to None.
+            tags ([str], optional): Tags on the host. Defaults to None.
         """
         self.host = host
         self.cred = cred
         self.port = port
+        self.groups = set(groups) if groups is not None else set()
+        self.tags = set(tags) if tags is not None else set()
 
     def build_host_config(self):
         """Builds Host config for Parallel SSH
@@ -84,16 +88,30 @@ class Host(object):
 
 
 class HostMap(object):
-    """Maps host name to the rest of the information"""
+    """Maps host name to the rest of the information
+
+    Every host gets an integer ID that never changes or gets reused, and
+    group and tag membership is indexed, so selecting hosts costs time in
+    the size of the selection rather than scanning every host.
+    """
 
     def __init__(self, hostnames, hosts):
         """Initializes hostmap
 
+        IDs are handed out in sorted host name order.
+
         Args:
             hostnames ([str]): List of hostnames
             hosts ([Host]): List of Host objects
         """
-        self.hostmap = dict(zip(hostnames, hosts))
+        self.hostmap = {}
+        self.ids = {}
+        self.by_id = {}
+        self.next_id = 0
+        self.groups = {}
+        self.tags = {}
+        for hostname, host in sorted(zip(hostnames, hosts), key=lambda h: h[0]):
+            self[hostname] = host
 
     def __len__(self):
         """Gets the number of items in host map
@@ -121,7 +139,20 @@ class HostMap(object):
             hostname (str): Host name
             host (Host): Host object
         """
+        if hostname in self.hostmap:
+            self._unindex(hostname)
+        else:
+            self.ids[hostname] = self.next_id
+            self.by_id[self.next_id] = hostname
+            self.next_id += 1
         self.hostmap[hostname] = host
+        for g in host.groups:
+            self.groups.setdefault(g, set()).add(hostname)
+        for t in host.tags:
+            self.tags.setdefault(t, set()).add(hostname)
+
+    def __contains__(self, hostname):
+        return hostname in self.hostmap
 
     def keys(self):
         """Gets a list of hostnames
@@ -148,7 +179,93 @@ class HostMap(object):
         Args:
             hosts ([str]): List of host names to remove
         """
-        self.hostmap = dict(filter(lambda h: h[0] not in hosts, self.hostmap.items()))
+        for hostname in set(hosts):
+            if hostname not in self.hostmap:
+                continue
+            self._unindex(hostname)
+            del self.by_id[self.ids.pop(hostname)]
+            del self.hostmap[hostname]
+
+    def _unindex(self, hostname):
+        host = self.hostmap[hostname]
+        for index, names in ((self.groups, host.groups), (self.tags, host.tags)):
+            for name in names:
+                index[name].discard(hostname)
+                if len(index[name]) == 0:
+                    del index[name]
+
+    def hosts_by_ids(self, ids):
+        """Gets host names from IDs
+
+        Args:
+            ids ([int]): Host IDs
+
+        Returns:
+            [str]: Host names, or None if any ID is unknown
+        """
+        if any(i not in self.by_id for i in ids):
+            return None
+        return [self.by_id[i] for i in ids]
+
+    def select(self, terms):
+        """Selects hosts with a set expression
+
+        Terms are host names, IDs, `group:name`, `tag:name` or `all`, and are
+        combined left to right: a plain term adds its hosts, `&term` keeps
+        only hosts also in term and `!term` drops term's hosts.
+
+        Args:
+            terms ([str]): Terms
+
+        Returns:
+            {str}: Host names
+        """
+        selected = set()
+        for term in terms:
+            op = term[0] if term[0] in "&!" else None
+            hosts = self._term(term[1:] if op is not None else term)
+            if op == "&":
+                selected &= hosts
+            elif op == "!":
+                selected -= hosts
+            else:
+                selected |= hosts
+        return selected
+
+    def _term(self, term):
+        if term == "all":
+            return set(self.hostmap.keys())
+        if term.startswith("group:"):
+            return self._index_term(self.groups, "Group", term[len("group:") :])
+        if term.startswith("tag:"):
+            return self._index_term(self.tags, "Tag", term[len("tag:") :])
+        try:
+            i = int(term)
+            if i not in self.by_id:
+                raise HostMap.SelectionException(f"No host with ID {i}")
+            return {self.by_id[i]}
+        except ValueError:
+            pass
+        if term not in self.hostmap:
+            raise HostMap.SelectionException(f"Host {term} not in host list")
+        return {term}
+
+    @staticmethod
+    def _index_term(index, kind, name):
+        if name not in index:
+            raise HostMap.SelectionException(f"{kind} {name} doesn't exist")
+        return set(index[name])
+
+    def sorted_ids(self):
+        """Gets (ID, host name) pairs ordered by ID
+
+        Returns:
+            [(int, str)]: Pairs
+        """
+        return sorted(self.by_id.items())
+
+    class SelectionException(Exception):
+        pass
 
     def print_hosts(self):
         """Prints the host names"""
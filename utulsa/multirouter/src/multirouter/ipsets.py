@@ -0,0 +1,283 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+import hashlib
+import ipaddress
+
+from colorama import Fore, Style
+
+from .analyze import RuleMatch, destination_key, join, port_key, source_key
+from .ruleset import Rule, Table
+
+# Runs shorter than this stay as separate rules
+IPSET_MIN_RUN = 8
+
+# Set the block command keeps, and the chains it's matched in
+BLOCKLIST = "mr-block"
+BLOCK_CHAINS = ("INPUT", "FORWARD")
+
+# kind -> (ipset type, set match direction)
+SET_TYPES = {
+    "src": ("hash:net family inet", "src"),
+    "dst": ("hash:net family inet", "dst"),
+    "port": ("bitmap:port range 0-65535", "dst"),
+}
+
+
+class IPSetException(Exception):
+    pass
+
+
+class SetRun(object):
+    """A run of rules that differ only in one address or port, as one set"""
+
+    def __init__(self, kind, table, chain, rules):
+        """Initializes SetRun
+
+        Args:
+            kind (str): "src", "dst" or "port"
+            table (str): Table name
+            chain (str): Chain name
+            rules ([RuleMatch]): Adjacent rules in the run
+        """
+        self.kind = kind
+        self.table = table
+        self.chain = chain
+        self.rules = rules
+        first = rules[0]
+        self.elements = run_elements(kind, rules)
+        # Hosts with the same run get the same set name, so one set name
+        # means the same rule across the fleet. The entries are hashed too,
+        # so two runs of the same rule in a chain get a set each.
+        key = {"src": source_key, "dst": destination_key, "port": port_key}[kind](first)
+        run = repr((table, chain, key, self.elements))
+        self.name = f"mr-{kind}-{hashlib.sha1(run.encode()).hexdigest()[:10]}"
+        self.rule = Rule(chain, join(set_tokens(kind, first, self.name)))
+
+    def create(self):
+        """Builds the ipset restore lines that fill the set
+
+        The set is filled under a temporary name and swapped in, so a set
+        that already exists is replaced in one step.
+
+        Returns:
+            [str]: Lines
+        """
+        kind, _ = SET_TYPES[self.kind]
+        new = f"{self.name}-new"
+        lines = [f"create {new} {kind} -exist", f"flush {new}"]
+        lines += [f"add {new} {e}" for e in self.elements]
+        lines += [
+            f"create {self.name} {kind} -exist",
+            f"swap {new} {self.name}",
+            f"destroy {new}",
+        ]
+        return lines
+
+    def line(self):
+        first = self.rules[0].position
+        last = self.rules[-1].position
+        return (
+            f"{Fore.CYAN}#{first}-{last} ({len(self.rules)} rules) -> {self.name} "
+            f"({len(self.elements)} entries): {self.rule}{Style.RESET_ALL}"
+        )
+
+    def record(self):
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "table": self.table,
+            "chain": self.chain,
+            "positions": [m.position for m in self.rules],
+            "entries": len(self.elements),
+            "rule": str(self.rule),
+        }
+
+
+def find_runs(table, chain, rules, min_run=IPSET_MIN_RUN):
+    """Finds runs of adjacent rules that can become one set backed rule
+
+    Only rules whose target ends the chain are used, so a packet is still
+    handled once whichever rule of the run matched it before.
+
+    Args:
+        table (str): Table name
+        chain (str): Chain name
+        rules ([Rule]): Rules in order
+        min_run (int, optional): Shortest run worth a set. Defaults to IPSET_MIN_RUN.
+
+    Returns:
+        [SetRun]: Runs, in chain order
+    """
+    matches = [RuleMatch(r, position) for position, r in enumerate(rules, 1)]
+    runs = []
+    used = set()
+    for kind, key_of in (
+        ("src", source_key),
+        ("dst", destination_key),
+        ("port", port_key),
+    ):
+        run = []
+        key = None
+        for m in matches + [None]:
+            k = (
+                key_of(m)
+                if m is not None and m.terminal and m.position not in used
+                else None
+            )
+            if k is not None and k == key:
+                run.append(m)
+                continue
+            if len(run) >= min_run:
+                runs.append(SetRun(kind, table, chain, run))
+                used.update(r.position for r in run)
+            run = [m] if k is not None else []
+            key = k
+    runs.sort(key=lambda r: r.rules[0].position)
+    return runs
+
+
+def consolidate_tables(tables, names, min_run=IPSET_MIN_RUN):
+    """Replaces every run in the given tables with its set backed rule
+
+    Args:
+        tables ({str: Table}): Tables from a host
+        names ([str]): Tables to consolidate
+        min_run (int, optional): Shortest run worth a set. Defaults to IPSET_MIN_RUN.
+
+    Returns:
+        ([SetRun], {str: Table}): Runs, and the consolidated tables
+    """
+    runs = []
+    consolidated = {}
+    for name in names:
+        if name not in tables:
+            continue
+        t = tables[name]
+        c = Table(name)
+        for chain in t.chains:
+            c.add_chain(chain, t.policies.get(chain))
+            chain_runs = find_runs(name, chain, t.rules[chain], min_run)
+            runs += chain_runs
+            starts = {r.rules[0].position: r for r in chain_runs}
+            skip = set(m.position for r in chain_runs for m in r.rules)
+            for position, rule in enumerate(t.rules[chain], 1):
+                if position in starts:
+                    c.add_rule(starts[position].rule)
+                elif position not in skip:
+                    c.add_rule(rule)
+        consolidated[name] = c
+    return (runs, consolidated)
+
+
+def restore_payload(runs):
+    """Builds the ipset restore payload that creates every run's set
+
+    Args:
+        runs ([SetRun]): Runs
+
+    Returns:
+        str: Payload
+    """
+    lines = []
+    done = set()
+    for r in runs:
+        if r.name not in done:
+            done.add(r.name)
+            lines += r.create()
+    return "\n".join(lines) + "\n"
+
+
+def run_elements(kind, rules):
+    if kind == "port":
+        elements = []
+        for m in rules:
+            elements += [str(lo) if lo == hi else f"{lo}-{hi}" for lo, hi in m.dports]
+        return sorted(set(elements), key=lambda e: int(e.split("-")[0]))
+    nets = set()
+    for m in rules:
+        network, length = m.src if kind == "src" else m.dst
+        nets.add(ipaddress.IPv4Network((network, length)))
+    return [address(n) for n in sorted(nets)]
+
+
+def set_tokens(kind, m, name):
+    match = ["-m", "set", "--match-set", name, SET_TYPES[kind][1]]
+    if kind == "port":
+        return m.tokens[: m.port_pos] + match + m.tokens[m.port_pos + 4 :]
+    pos = m.src_pos if kind == "src" else m.dst_pos
+    tokens = m.tokens[: pos - 1] + m.tokens[pos + 1 :]
+    # iptables -S lists matches after -s/-d/-i/-o/-p, before the target
+    i = 0
+    while i < len(tokens) and tokens[i] not in ("-m", "-j", "-g"):
+        if tokens[i] == "!" and i + 1 < len(tokens) and tokens[i + 1] == "-m":
+            break
+        i += 1
+    return tokens[:i] + match + tokens[i:]
+
+
+def address(net):
+    # ipset takes single addresses without the /32
+    return str(net.network_address) if net.prefixlen == 32 else str(net)
+
+
+def parse_addresses(args):
+    """Checks addresses given to block
+
+    Args:
+        args ([str]): Addresses or networks
+
+    Returns:
+        [str]: Addresses as ipset takes them
+    """
+    out = []
+    for a in args:
+        a = a.rstrip(",")
+        if a == "":
+            continue
+        try:
+            out.append(address(ipaddress.IPv4Network(a, strict=False)))
+        except ValueError:
+            raise IPSetException(f"{a} isn't an IPv4 address or network")
+    return out
+
+
+def block_payload(action, addresses):
+    """Builds the ipset restore payload for a block change
+
+    Args:
+        action (str): "add" or "remove"
+        addresses ([str]): Addresses, from parse_addresses
+
+    Returns:
+        str: Payload
+    """
+    op = "add" if action == "add" else "del"
+    lines = [f"create {BLOCKLIST} hash:net family inet -exist"]
+    lines += [f"{op} {BLOCKLIST} {a} -exist" for a in addresses]
+    return "\n".join(lines) + "\n"
+
+
+def block_command():
+    """Builds the command that loads a block payload from stdin
+
+    The DROP rules matching the set are added to the top of BLOCK_CHAINS
+    the first time, so blocking works on hosts that never had them.
+
+    Returns:
+        str: Command
+    """
+    c = ["ipset restore"]
+    rule = f"-m set --match-set {BLOCKLIST} src -j DROP"
+    for chain in BLOCK_CHAINS:
+        c.append(
+            f"(iptables -C {chain} {rule} 2>/dev/null || iptables -I {chain} 1 {rule})"
+        )
+    return " && ".join(c)
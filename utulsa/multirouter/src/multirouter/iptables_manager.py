@@ -9,252 +9,1523 @@
 ##################################################################
 
 import os
+import sys
+import time
 
 from colorama import Fore, Back, Style
 
+from .analyze import analyze_tables
+from .backend import DETECT_COMMAND, IPTablesBackend, detected
+from .confirm import arm_command, cancel_command, new_token, revert_command
+from .diff import delta_restore, diff_tables
+from .ipsets import block_command, block_payload, consolidate_tables, parse_addresses
+from .ipsets import restore_payload as ipset_payload
+from .metrics import merge, open_sink, phase_stats
+from .monitor import WATCH_INTERVAL, WATCH_TOP, HitMonitor, human
+from .nftables import NftablesBackend, NftablesException, command_script
+from .optimize import OPTIMIZE_WINDOW, optimize_tables
+from .records import RecordWriter, diff_record, host_record, tables_record
+from .rollout import RolloutPlan, parse_probe, probe_ports
+from .ruleset import RuleCache, Ruleset, parse_rules
+from .snapshot import SnapshotStore
+from .ssh_handler import HostTimeout
+
+BACKENDS = {"iptables": IPTablesBackend(), "nftables": NftablesBackend()}
+
 
 class IPTablesManager(object):
     def __init__(self, ssh_manager, host_map, tables=["filter", "nat"]):
         self.ssh_manager = ssh_manager
         self.host_map = host_map
         self.tables = tables
-
-    def send_sudo_password(self, output):
-        for host_out in output:
-            host_out.stdin.write(self.host_map.get_password(host_out.host) + "\n")
-            host_out.stdin.flush()
+        self.stream = False
+        self.cache = RuleCache()
+        self.store = SnapshotStore()
+        # Seconds each host gets, and seconds the whole fan-out gets
+        # (None for no limit). Hosts past either are cut off and listed.
+        self.host_timeout = None
+        self.deadline = None
+        # Run `cmd` on one long lived shell per host instead of a new channel
+        self.interactive = False
+        # Answers given to confirmation prompts in batch mode (e.g. {"yes"}),
+        # or None to prompt
+        self.answers = None
+        # Per host results of every command run, for batch mode's report
+        self.status = {}
+        # "text", or "json"/"ndjson" for one record per host
+        self.format = "text"
+        self.rollout_plan = RolloutPlan()
+        # Seconds before an unconfirmed load or iptables change is reverted
+        # on the host itself (None to apply changes without a revert timer)
+        self.confirm_timeout = None
+        # Print per phase timings after each command, and where to send them
+        self.show_timings = False
+        self.metrics = None
+        self.metrics_spec = None
+        # "auto" to detect each host's firewall, or "iptables"/"nftables",
+        # with per host overrides from the load file
+        self.firewall = "auto"
+        self.firewalls = {}
+        # host -> backend (see backend.py), iptables until detected
+        self.backends = {}
 
     def add_host(self, host):
         self.ssh_manager.add_host(host)
         self.host_map[host.host] = host
+        # Detected along with its first command
+        self.backends.pop(host.host, None)
+
+    def backend(self, host):
+        return self.backends.get(host, BACKENDS["iptables"])
+
+    def detect_backends(self, hosts=None):
+        """Works out which firewall each host runs
+
+        Hosts set to iptables or nftables (per host or with the firewall
+        setting) aren't asked. A host that can't be asked is treated as
+        iptables, and asked again before its next command (see
+        detect_pending).
+
+        Args:
+            hosts ([str], optional): Host names. Defaults to every host.
+        """
+        if hosts is None:
+            hosts = self.ssh_manager.all_hosts
+        ask = []
+        for h in hosts:
+            firewall = self.firewalls.get(h, self.firewall)
+            if firewall == "auto":
+                ask.append(h)
+            else:
+                self.backends[h] = BACKENDS[firewall]
+        if len(ask) == 0:
+            return
+        output = self.run(DETECT_COMMAND, ask, sudo=True)
+        # Not a command of the user's, so it isn't tallied into self.status
+        self.ssh_manager.join(output, timeout=self.time_left(output))
+        errors = IPTablesManager.failures(output)
+        for host_out in output:
+            if host_out.host not in errors:
+                self.backends[host_out.host] = BACKENDS[detected(host_out.stdout)]
+        self.cache.invalidate(ask)
+
+    def detect_pending(self, hosts):
+        # Asks the hosts whose firewall isn't known yet (added since startup,
+        # or unreachable when last asked), all in one round trip
+        pending = [h for h in hosts if h not in self.backends]
+        if len(pending) != 0:
+            self.detect_backends(pending)
+
+    def set_firewall(self, firewall):
+        self.firewall = firewall
+        self.backends = {}
+        self.detect_backends()
+
+    def split_backends(self, hosts, command):
+        # Hosts that can run a command that only works with iptables, noting
+        # the ones left out
+        self.detect_pending(hosts)
+        skipped = [h for h in hosts if not self.backend(h).delta]
+        if len(skipped) != 0:
+            self.message(
+                f"\n{command} needs iptables, skipping nftables hosts: {', '.join(skipped)}"
+            )
+        return [h for h in hosts if self.backend(h).delta]
+
+    def run_each(self, hosts, command, *args):
+        # Runs each host's backend's version of a command (see FirewallBackend)
+        self.detect_pending(hosts)
+        commands = [getattr(self.backend(h), command)(*args) for h in hosts]
+        return self.run("%s", hosts, sudo=True, commands=commands)
+
+    def fail(self, errors):
+        """Reports hosts a command couldn't be sent to, failing them in self.status
+
+        Args:
+            errors ({str: str}): Error for each host
+        """
+        for h in sorted(errors.keys()):
+            s = self.host_status(h)
+            s["commands"] += 1
+            s["failed"] += 1
+            s["status"] = "failed"
+            s["error"] = errors[h]
+            self.message(f"{Fore.RED}{h}: {errors[h]}{Style.RESET_ALL}")
 
     def remove_hosts(self, hosts):
+        self.cache.remove(hosts)
         self.host_map.remove(hosts)
+        for h in hosts:
+            self.backends.pop(h, None)
         self.ssh_manager.remove_hosts(hosts)
 
     def remove_hosts_indices(self, indices):
-        shosts = sorted(self.host_map.keys())
-        rhosts = list(
-            map(lambda x: x[1], filter(lambda x: x[0] in indices, enumerate(shosts)))
+        # Host IDs are stable, so removing hosts never renumbers the rest
+        self.remove_hosts(
+            [self.host_map.by_id[i] for i in indices if i in self.host_map.by_id]
         )
-        self.remove_hosts(rhosts)
 
-    def save(self, d):
-        c = "&&".join(
-            [
-                f'printf "\\n{table}\\n" && iptables -S -t{table}'
-                for table in self.tables
-            ]
-        )
-        hosts = self.ssh_manager.hosts
-        if not self.ssh_manager.context_changed:
-            output = self.ssh_manager.run_command(c, sudo=True)
-        else:
-            ahosts = self.ssh_manager.all_hosts
-            cs = [c if h in hosts else "" for h in ahosts]
-            output = self.ssh_manager.run_command("%s", commands=cs, sudo=True)
-        self.send_sudo_password(output)
-        self.ssh_manager.join(output)
-        out = []
+    def fetch_saves(self, hosts):
+        output = self.run_each(hosts, "save_command", self.tables)
+        timed_out = self.join(output)
+        saves = {}
         for host_out in output:
-            if host_out.host not in hosts:
+            if host_out.exception is not None:
+                self.message(f"\nNot saving {host_out.host}: {host_out.exception!r}")
+                continue
+            backend = self.backend(host_out.host)
+            try:
+                saves[host_out.host] = backend.parse_saves(host_out.stdout, self.tables)
+            except NftablesException as e:
+                self.message(f"\nNot saving {host_out.host}: {e}")
+        self.print_timed_out(timed_out)
+        return saves
+
+    def save(self, d):
+        for host, text in self.fetch_saves(self.ssh_manager.hosts).items():
+            with open(os.path.join(d, f"{host}.txt"), "w") as f:
+                f.write(text)
+
+    def save_snapshot(self, name):
+        saves = self.fetch_saves(self.ssh_manager.hosts)
+        if len(saves) == 0:
+            print("\nNothing to save\n")
+            return
+        written = self.store.save(name, saves)
+        print(f"\nSaved {len(saves)} hosts to {name} ({written} changed)\n")
+
+    def print_snapshots(self):
+        snapshots = self.store.snapshots()
+        if len(snapshots) == 0:
+            print("\nNo snapshots\n")
+            return
+        print("\nSnapshots:\n")
+        for name, created, hosts in snapshots:
+            t = time.strftime("%b-%d-%Y %H:%M:%S", time.localtime(created))
+            print(f"{name}\t{t}\t{hosts} hosts")
+        print()
+
+    @staticmethod
+    def read_saves(d):
+        saves = {}
+        for f in os.listdir(d):
+            if f.endswith(".txt"):
+                with open(os.path.join(d, f), "r") as fp:
+                    saves[f[:-4]] = fp.read()
+        return saves
+
+    @staticmethod
+    def read_tables(fn):
+        with open(fn, "r") as f:
+            return IPTablesManager.split_tables(f.read())
+
+    @staticmethod
+    def split_tables(s):
+        tables = {}
+        for t in s.split("\n\n"):
+            lines = list(filter(lambda line: line.strip() != "", t.split("\n")))
+            if len(lines) != 0:
+                tables[lines[0]] = lines[1:]
+        return tables
+
+    def build_restore(self, tables):
+        # iptables-restore flushes every chain of each table it is given and
+        # commits the whole table at once, so only emit tables we manage
+        payload = []
+        for table in self.tables:
+            if table not in tables:
                 continue
-            lines = [f"{line}\n" for line in host_out.stdout]
-            with open(os.path.join(d, f"{host_out.host}.txt"), "w") as f:
-                f.writelines(lines)
+            payload.append(f"*{table}")
+            rules = []
+            for r in tables[table]:
+                args = r.split()
+                if args[0] == "-P":
+                    payload.append(f":{args[1]} {args[2]} [0:0]")
+                elif args[0] == "-N":
+                    payload.append(f":{args[1]} - [0:0]")
+                else:
+                    rules.append(r)
+            payload += rules
+            payload.append("COMMIT")
+        return "\n".join(payload) + "\n"
 
-    def read_commands(self, fn):
+    def read_restore(self, fn):
+        return self.build_restore(IPTablesManager.read_tables(fn))
+
+    @staticmethod
+    def load_tables(fn):
         with open(fn, "r") as f:
-            s = f.read()
+            return IPTablesManager.parse_tables(f.read())
 
-        tables = list(
-            map(
-                lambda t: list(filter(lambda line: line.strip() != "", t.split("\n"))),
-                s.split("\n\n"),
-            )
+    @staticmethod
+    def parse_tables(s):
+        tables = IPTablesManager.split_tables(s)
+        return {name: parse_rules(name, lines) for name, lines in tables.items()}
+
+    def run(self, cmd, hosts, sudo=False, commands=None, stdin=None):
+        # Without a sudo session, the SSH manager sends the password first
+        output = self.ssh_manager.run_command(
+            cmd,
+            commands=commands,
+            sudo=sudo,
+            hosts=hosts,
+            timeout=self.limit(),
+            stdin=stdin,
         )
-        # print(tables)
-        c = []
+        self.track(output)
+        return output
 
-        for t in tables:
-            table = t[0]
-            c.append(f"iptables -t {table} -F")
-            c.append(" && ".join([f"iptables -t {table} {r}" for r in t[1:]]))
+    def track(self, output):
+        # Each job (greenlet or thread) collects the timings of the commands
+        # it runs, so a background job's hosts don't show up in another's
+        local = self.ssh_manager.local
+        if getattr(local, "timings", None) is None:
+            local.timings = []
+        local.timings.append(output.timings)
 
-        return " && ".join(c)
+    def report_timings(self, command):
+        """Hands the timings of everything a command ran to the display and sink
 
-    def run_command(self, cmd, sudo=False):
-        hosts = self.ssh_manager.hosts
-        if not self.ssh_manager.context_changed:
-            output = self.ssh_manager.run_command(cmd, sudo=sudo)
+        Args:
+            command (str): Command name
+        """
+        local = self.ssh_manager.local
+        timings = getattr(local, "timings", None)
+        local.timings = None
+        if not timings:
+            return
+        # Output that was only joined (not printed) is done with by now
+        for t in timings:
+            for host in list(t.finished.keys()):
+                t.collect(host)
+        hosts = merge(timings)
+        if len(hosts) == 0:
+            return
+        if self.metrics is not None:
+            self.metrics.observe(command, hosts)
+        if self.show_timings:
+            self.print_timings(hosts)
+
+    def set_metrics(self, spec):
+        """Sends timings to a sink, replacing the current one
+
+        Args:
+            spec (str): kind:path (see open_sink), or None for no sink
+        """
+        sink = open_sink(spec) if spec is not None else None
+        if self.metrics is not None:
+            self.metrics.close()
+        self.metrics = sink
+        self.metrics_spec = spec
+
+    def print_timings(self, hosts):
+        lines = [f"\nTimings ({len(hosts)} hosts):\n", "phase\tp50\tp95\tmax"]
+        for phase, p50, p95, most, slowest in phase_stats(hosts):
+            lines.append(f"{phase}\t{p50:.3f}s\t{p95:.3f}s\t{most:.3f}s ({slowest})")
+        self.message("\n".join(lines) + "\n")
+
+    def message(self, text):
+        # Notes that aren't host output go to stderr when writing records,
+        # so stdout stays parseable
+        print(text, file=sys.stdout if self.format == "text" else sys.stderr)
+
+    def ask(self, prompt, answer):
+        """Asks for confirmation, or answers from self.answers in batch mode
+
+        Args:
+            prompt (str): Question
+            answer (str): The answer that proceeds
+
+        Returns:
+            str: The answer
+        """
+        if self.answers is None:
+            return input(prompt)
+        ans = answer if answer in self.answers else "no"
+        print(prompt + ans)
+        return ans
+
+    def host_status(self, host):
+        """Gets a host's entry in self.status, adding it if needed
+
+        Args:
+            host (str): Host name
+
+        Returns:
+            dict: The host's status
+        """
+        return self.status.setdefault(
+            host, {"status": "ok", "commands": 0, "failed": 0, "error": None}
+        )
+
+    def record(self, output):
+        """Tallies finished output into self.status
+
+        Args:
+            output ([HostOutput]): Finished output
+        """
+        errors = IPTablesManager.failures(output)
+        for host_out in output:
+            s = self.host_status(host_out.host)
+            s["commands"] += 1
+            error = errors.get(host_out.host)
+            if error is not None:
+                s["failed"] += 1
+                s["error"] = error
+                timeout = isinstance(host_out.exception, HostTimeout)
+                s["status"] = "timeout" if timeout else "failed"
+
+    @staticmethod
+    def failures(output):
+        """Finds the hosts whose command failed
+
+        Args:
+            output ([HostOutput]): Finished output
+
+        Returns:
+            {str: str}: Error for each failed host
+        """
+        errors = {}
+        for host_out in output:
+            if host_out.exception is not None:
+                errors[host_out.host] = repr(host_out.exception)
+            elif host_out.exit_code not in (None, 0):
+                errors[host_out.host] = f"Exit code {host_out.exit_code}"
+        return errors
+
+    def time_left(self, output):
+        """Seconds left before output's hosts should be cut off
+
+        Args:
+            output (FanoutOutput): Output from run
+
+        Returns:
+            float: Seconds left, or None if there's no limit
+        """
+        limit = self.limit()
+        if limit is None:
+            return None
+        return max(0.0, limit - (time.time() - output.started))
+
+    def limit(self):
+        # Seconds a command gets from when it's sent: the tighter of the
+        # per host timeout and the deadline
+        limits = [t for t in (self.host_timeout, self.deadline) if t is not None]
+        return min(limits) if len(limits) != 0 else None
+
+    def join(self, output):
+        """Waits for output within the time limits, cancelling stragglers
+
+        Args:
+            output (FanoutOutput): Output from run
+
+        Returns:
+            [str]: Hosts that were cut off
+        """
+        self.ssh_manager.join(output, timeout=self.time_left(output))
+        self.record(output)
+        return IPTablesManager.timed_out(output)
+
+    @staticmethod
+    def timed_out(output):
+        return [h.host for h in output if isinstance(h.exception, HostTimeout)]
+
+    def print_timed_out(self, hosts):
+        if len(hosts) != 0:
+            hosts = ", ".join(sorted(hosts))
+            self.message(f"{Fore.RED}Timed out: {hosts}{Style.RESET_ALL}\n")
+
+    def run_command(self, cmd, sudo=False, callback=None):
+        if self.interactive:
+            output = self.ssh_manager.run_shell(
+                cmd,
+                sudo=sudo,
+                hosts=self.ssh_manager.hosts,
+                timeout=self.host_timeout,
+                deadline=self.deadline,
+            )
+            self.track(output)
         else:
-            ahosts = self.ssh_manager.all_hosts
-            cs = [cmd if h in hosts else "" for h in ahosts]
-            output = self.ssh_manager.run_command("%s", commands=cs, sudo=sudo)
+            output = self.run(cmd, self.ssh_manager.hosts, sudo=sudo)
         if sudo:
-            self.send_sudo_password(output)
-        self.ssh_manager.join(output)
-        out = []
-        for host_out in output:
-            if host_out.host not in hosts:
+            self.cache.invalidate(self.ssh_manager.hosts)
+        if self.interactive:
+            self.record(output)
+            self.print_results(output, colorize=False, callback=callback)
+        else:
+            self.print_output(output, colorize=False, callback=callback)
+
+    def load(self, saves, delta=False):
+        # saves holds each host's saved rules, from a snapshot or directory
+        payloads, deltas = self.restore_payloads(saves, delta)
+        if len(payloads) == 0:
+            print("\nNothing to change\n")
+            return
+        ans = self.ask(
+            "\nAre you absolutely sure you know what you're doing?\nThis could lock you out.\nType `COMMIT` to proceed: ",
+            "COMMIT",
+        )
+        if ans != "COMMIT":
+            print("\nNo worries. Better safe than sorry.\n")
+            return
+        hosts = list(payloads.keys())
+        if self.confirm_timeout is not None:
+            self.commit_confirm(
+                hosts, lambda armed: self.push_restore(armed, payloads, deltas), True
+            )
+        else:
+            output = self.push_restore(hosts, payloads, deltas)
+            self.print_output(output, stderr=True)
+
+    def push_restore(self, hosts, payloads, deltas=None, counters=False):
+        # Starts each host's restore command with its payload on stdin.
+        # Delta payloads go with --noflush; counters restores [p:b] counters.
+        # Hosts whose payload their backend can't take are failed, not run.
+        self.detect_pending(hosts)
+        commands = {}
+        translated = {}
+        errors = {}
+        for h in hosts:
+            backend = self.backend(h)
+            delta = deltas is not None and h in deltas
+            try:
+                translated[h] = backend.restore_payload(payloads[h], delta, counters)
+            except NftablesException as e:
+                errors[h] = str(e)
                 continue
-            o = "\n".join(host_out.stdout)
-            out.append((self.host_map[host_out.host], o))
-        out = sorted(out, key=lambda x: x[0].host)
-        for host, o in out:
-            print("\n" + host.colorize())
-            print(o + "\n")
+            commands[h] = backend.restore_command(delta, counters)
+        self.fail(errors)
+        return self.push([h for h in hosts if h in commands], commands, translated)
 
-    def load(self, fs):
-        ahosts = self.ssh_manager.all_hosts
-        c = [""] * len(ahosts)
-        hosts = []
-        for h, fn in fs.items():
+    def push(self, hosts, commands, payloads):
+        # Starts each host's command, with its payload (if it has one) on stdin
+        commands = [commands[h] for h in hosts]
+        output = self.run("%s", hosts, sudo=True, commands=commands, stdin=payloads)
+        self.cache.invalidate(hosts)
+        return output
+
+    def restore_payloads(self, saves, delta=False):
+        ahosts = set(self.ssh_manager.all_hosts)
+        payloads = {}
+        for h, text in saves.items():
             if h not in ahosts:
                 continue
-            hosts.append(h)
-            i = ahosts.index(h)
-            c[i] = self.read_commands(fn)
-        ans = input(
-            "\nAre you absolutely sure you know what you're doing?\nThis could lock you out.\nType `COMMIT` to proceed: "
+            payloads[h] = self.build_restore(IPTablesManager.split_tables(text))
+        deltas = {}
+        if delta:
+            deltas = self.load_deltas({h: saves[h] for h in payloads})
+            for h, p in list(deltas.items()):
+                if p == "":
+                    del payloads[h]
+                    del deltas[h]
+                else:
+                    payloads[h] = p
+        return (payloads, deltas)
+
+    def load_deltas(self, saves):
+        # Hosts we can't fetch or whose chains changed too much are left out,
+        # so they fall back to the full restore, as do nftables hosts, which
+        # always load whole tables
+        self.detect_pending(saves.keys())
+        hosts = [h for h in saves.keys() if self.backend(h).delta]
+        live = {r.host: r.tables for r in self.fetch_rules(hosts, True)}
+        deltas = {}
+        for h in sorted(hosts):
+            if h not in live:
+                self.message(f"{h}: couldn't fetch live rules, using full restore")
+                continue
+            target = IPTablesManager.parse_tables(saves[h])
+            p = delta_restore(live[h], target, self.tables)
+            if p is None:
+                self.message(f"{h}: too many changes for a delta, using full restore")
+                continue
+            deltas[h] = p
+            n = len([line for line in p.split("\n") if line.startswith("-")])
+            self.message(f"{h}: {n} rule changes" if p != "" else f"{h}: up to date")
+        return deltas
+
+    def backup(self, hosts):
+        """Fetches hosts' rules in a form roll_back can put back
+
+        Args:
+            hosts ([str]): Hosts
+
+        Returns:
+            {str: str}: iptables-save output (nft ruleset on nftables hosts) for each host that could be fetched
+        """
+        output = self.run_each(hosts, "backup_command", self.tables)
+        self.join(output)
+        errors = IPTablesManager.failures(output)
+        backups = {}
+        for host_out in output:
+            if host_out.host in errors:
+                self.message(
+                    f"\nCouldn't back up {host_out.host}: {errors[host_out.host]}"
+                )
+                continue
+            backups[host_out.host] = self.backend(host_out.host).backup(host_out.stdout)
+        return backups
+
+    def rollout(self, hosts, apply, plan=None):
+        """Applies a change a batch at a time, checking each batch's health
+
+        The canary batch goes first. Every batch is backed up, changed
+        (concurrency hosts at a time) and probed before the next one starts.
+        If any host can't be backed up, the batch isn't changed at all. If
+        that happens or any host fails to change or fails its probe, the
+        rollout stops and every host changed so far is restored from its
+        backup.
+
+        Args:
+            hosts ([str]): Hosts in rollout order
+            apply (function): apply(hosts) starts the change, returning its output
+            plan (RolloutPlan, optional): Batching and probe. Defaults to self.rollout_plan.
+
+        Returns:
+            bool: Whether every batch went through
+        """
+        if plan is None:
+            plan = self.rollout_plan
+        kind, port = parse_probe(plan.probe)
+        batches = plan.batches(hosts)
+        backups = {}
+        changed = []
+        for n, batch in enumerate(batches):
+            name = (
+                "canary"
+                if n == 0 and plan.canary > 0
+                else f"batch {n + 1}/{len(batches)}"
+            )
+            self.message(f"\nRolling out to {name}: {', '.join(batch)}")
+            saved = self.backup(batch)
+            errors = {h: "Couldn't back up" for h in batch if h not in saved}
+            backups.update(saved)
+            if len(errors) == 0:
+                for i in range(0, len(batch), plan.concurrency):
+                    output = apply(batch[i : i + plan.concurrency])
+                    self.print_output(output, stderr=True)
+                    changed += [h.host for h in output]
+                    errors.update(IPTablesManager.failures(output))
+                healthy = [h for h in batch if h not in errors]
+                if kind == "ssh":
+                    probed = self.ssh_manager.probe(healthy, plan.probe_timeout)
+                elif kind == "port":
+                    probed = probe_ports(
+                        healthy, port, plan.probe_timeout, plan.concurrency
+                    )
+                else:
+                    probed = {}
+                errors.update({h: f"Probe failed: {e!r}" for h, e in probed.items()})
+            if len(errors) != 0:
+                for h in sorted(errors.keys()):
+                    self.message(f"{Fore.RED}{h}: {errors[h]}{Style.RESET_ALL}")
+                self.message(f"\nHalting at {name}, rolling back {len(changed)} hosts")
+                self.roll_back(changed, backups)
+                return False
+            self.message(f"{name}: {len(batch)} hosts healthy")
+        self.message(f"\nRolled out to {len(changed)} hosts\n")
+        return True
+
+    def roll_back(self, hosts, backups):
+        hosts = [h for h in hosts if h in backups]
+        if len(hosts) == 0:
+            return
+        commands = {h: self.backend(h).backup_restore_command() for h in hosts}
+        output = self.push(hosts, commands, backups)
+        self.join(output)
+        errors = IPTablesManager.failures(output)
+        for h in sorted(errors.keys()):
+            self.message(
+                f"{Fore.RED}Couldn't roll back {h}: {errors[h]}{Style.RESET_ALL}"
+            )
+        self.message(f"Rolled back {len(hosts) - len(errors)} of {len(hosts)} hosts\n")
+
+    def commit_confirm(self, hosts, apply, stderr=False, callback=None):
+        """Applies a change that each host reverts unless it's confirmed
+
+        Every host saves its live rules and starts a timer to restore them
+        in self.confirm_timeout seconds. The change is then applied, and each
+        host that took it is confirmed over a brand new SSH session, which
+        cancels its timer. A host the change locked out can't be confirmed,
+        so it heals itself when the timer fires. Hosts whose change failed
+        are reverted straight away.
+
+        Args:
+            hosts ([str]): Hosts
+            apply (function): apply(hosts) starts the change, returning its output
+            stderr (bool, optional): Show the change's stderr. Defaults to False.
+            callback (function, optional): Line callback for the change's output. Defaults to None.
+
+        Returns:
+            {str: str}: Confirmation status of each host
+        """
+        token = new_token()
+        seconds = self.confirm_timeout
+        states = {}
+        errors = {}
+
+        self.detect_pending(hosts)
+        commands = [arm_command(token, seconds, self.backend(h)) for h in hosts]
+        output = self.run("%s", hosts, sudo=True, commands=commands)
+        self.ssh_manager.join(output, timeout=self.time_left(output))
+        failed = IPTablesManager.failures(output)
+        for h in failed:
+            states[h] = "not armed"
+            errors[h] = failed[h]
+        armed = [h for h in hosts if h not in failed]
+        if len(armed) == 0:
+            self.print_confirm(states, errors)
+            return states
+
+        output = apply(armed)
+        self.print_output(output, stderr=stderr, callback=callback)
+        failed = IPTablesManager.failures(output)
+        # The pooled sessions still work for these, so don't wait on the timer
+        reverting = [h for h in armed if h in failed]
+        if len(reverting) != 0:
+            commands = [revert_command(token, self.backend(h)) for h in reverting]
+            output = self.run("%s", reverting, sudo=True, commands=commands)
+            self.join(output)
+            unreverted = IPTablesManager.failures(output)
+            for h in reverting:
+                if h in unreverted:
+                    states[h] = "reverting"
+                    errors[h] = f"{failed[h]}, revert failed: {unreverted[h]}"
+                else:
+                    states[h] = "rolled back"
+                    errors[h] = failed[h]
+
+        applied = [h for h in armed if h not in failed]
+        probed = self.ssh_manager.probe(
+            applied,
+            self.rollout_plan.probe_timeout,
+            command=cancel_command(token),
+            sudo=True,
         )
-        if ans == "COMMIT":
-            output = self.ssh_manager.run_command("%s", commands=c, sudo=True)
-            self.send_sudo_password(output)
-            self.ssh_manager.join(output)
-            out = []
-            for host_out in output:
-                if host_out.host not in hosts:
-                    continue
-                o = IPTablesManager._colorize("\n".join(host_out.stdout))
-                out.append((self.host_map[host_out.host], o))
-            out = sorted(out, key=lambda x: x[0].host)
-            for host, o in out:
-                print("\n" + host.colorize())
-                print(o + "\n")
-        else:
-            print("\nNo worries. Better safe than sorry.\n")
+        for h in applied:
+            if h in probed:
+                states[h] = "reverting"
+                errors[h] = repr(probed[h])
+            else:
+                states[h] = "confirmed"
+        self.cache.invalidate(hosts)
+        self.print_confirm(states, errors)
+        return states
+
+    def print_confirm(self, states, errors):
+        for h in sorted(states.keys()):
+            s = self.host_status(h)
+            s["confirm"] = states[h]
+            if states[h] != "confirmed" and s["status"] == "ok":
+                s["status"] = "failed"
+                s["error"] = errors.get(h)
+        # Goes through message, so records on stdout stay one document
+        lines = [f"\nCommit confirm ({self.confirm_timeout}s):\n"]
+        for h in sorted(states.keys()):
+            state = states[h]
+            color = Fore.GREEN if state == "confirmed" else Fore.RED
+            if state == "reverting":
+                state = f"reverting within {self.confirm_timeout}s"
+            line = f"{h}\t{color}{state}{Style.RESET_ALL}"
+            if h in errors:
+                line += f"\t{errors[h]}"
+            lines.append(line)
+        self.message("\n".join(lines) + "\n")
 
-    def list_rules(self, verbose):
-        c = "&&".join(
-            [
-                f'printf "\\n{Fore.YELLOW + table + Style.RESET_ALL}\\n" && iptables -L -t{table} --line-numbers{" -v" if verbose else ""}'
-                for table in self.tables
-            ]
+    def rollout_iptables(self, arg, plan=None):
+        def apply(batch):
+            output = self.iptables_output(arg, batch)
+            self.cache.invalidate(batch)
+            return output
+
+        return self.rollout(self.ssh_manager.hosts, apply, plan)
+
+    def rollout_load(self, saves, plan=None):
+        context = set(self.ssh_manager.hosts)
+        saves = {h: text for h, text in saves.items() if h in context}
+        payloads, deltas = self.restore_payloads(saves)
+        if len(payloads) == 0:
+            print("\nNothing to change\n")
+            return False
+        ans = self.ask(
+            "\nAre you absolutely sure you know what you're doing?\nThis could lock you out.\nType `COMMIT` to proceed: ",
+            "COMMIT",
         )
-        hosts = self.ssh_manager.hosts
-        if not self.ssh_manager.context_changed:
-            output = self.ssh_manager.run_command(c, sudo=True)
+        if ans != "COMMIT":
+            print("\nNo worries. Better safe than sorry.\n")
+            return False
+        hosts = sorted(payloads.keys())
+        return self.rollout(
+            hosts, lambda batch: self.push_restore(batch, payloads), plan
+        )
+
+    def list_rules(self, verbose, changed=False):
+        self.list_hosts(self.ssh_manager.hosts, verbose, changed)
+
+    def list_rules_hosts(self, hosts, verbose, changed=False):
+        hosts = set(hosts)
+        hosts = [h for h in self.ssh_manager.hosts if h in hosts]
+        self.list_hosts(hosts, verbose, changed)
+
+    def list_rules_indices(self, indices, verbose, changed=False):
+        hosts = self.host_map.hosts_by_ids(sorted(set(indices)))
+        if hosts is None:
+            print("Args invalid")
+            return
+        self.list_hosts(hosts, verbose, changed)
+
+    def list_hosts(self, hosts, verbose, changed=False):
+        if changed:
+            self.print_changes(self.fetch_rules(hosts, force=True))
+        elif self.format != "text":
+            # Records carry the parsed rules, so fetch iptables-save output
+            # rather than the -L listing
+            stale = self.cache.stale(hosts) if self.cache.ttl > 0 else hosts
+            fresh = [h for h in hosts if h not in stale]
+            writer = RecordWriter(self.format)
+            for ruleset in [self.cache[h] for h in fresh]:
+                writer.write(self.ruleset_record(ruleset))
+            if len(stale) != 0:
+                output = self.run_each(stale, "fetch_command", self.tables)
+                self.emit_records(output, writer=writer, rules=True)
+            writer.close()
+        elif self.cache.ttl > 0:
+            self.print_rulesets(self.fetch_rules(hosts), verbose)
         else:
-            ahosts = self.ssh_manager.all_hosts
-            cs = [c if h in hosts else "" for h in ahosts]
-            output = self.ssh_manager.run_command("%s", commands=cs, sudo=True)
-        self.send_sudo_password(output)
-        self.ssh_manager.join(output)
-        out = []
+            output = self.run_each(hosts, "list_command", self.tables, verbose)
+            self.print_output(output)
+
+    def fetch_rules(self, hosts, force=False):
+        stale = hosts if force else self.cache.stale(hosts)
+        if len(stale) != 0:
+            errors, timed_out = self.refresh(stale)
+            for host, e in errors.items():
+                self.message(f"\nCouldn't fetch {host}: {e}")
+            self.print_timed_out(timed_out)
+        return [self.cache[h] for h in hosts if h in self.cache]
+
+    def refresh(self, hosts):
+        """Fetches hosts' rules into the cache
+
+        Args:
+            hosts ([str]): Host names
+
+        Returns:
+            ({str: str}, [str]): Error for each host that couldn't be fetched, and the hosts that timed out
+        """
+        output = self.run_each(hosts, "fetch_command", self.tables)
+        timed_out = self.join(output)
+        errors = {}
         for host_out in output:
-            if host_out.host not in hosts:
+            if host_out.exception is not None:
+                errors[host_out.host] = repr(host_out.exception)
                 continue
-            o = IPTablesManager._colorize("\n".join(host_out.stdout))
-            out.append((self.host_map[host_out.host], o))
-        out = sorted(out, key=lambda x: x[0].host)
-        for host, o in out:
-            print("\n" + host.colorize())
-            print(o + "\n")
+            try:
+                tables = self.backend(host_out.host).parse_fetch(
+                    host_out.stdout, self.tables
+                )
+            except NftablesException as e:
+                errors[host_out.host] = str(e)
+                continue
+            self.cache.update(Ruleset(host_out.host, tables))
+        return (errors, timed_out)
+
+    def watch(
+        self, hosts, interval=WATCH_INTERVAL, top=WATCH_TOP, by_bytes=False, count=None
+    ):
+        """Polls rule counters and shows the busiest rules across hosts
+
+        Polls only carry each rule's counters and chain. Hosts are fetched
+        in full at the start, whenever their chains no longer line up with
+        the fetched rules, and every WATCH_REFRESH polls.
+
+        Args:
+            hosts ([str]): Host names
+            interval (float, optional): Seconds between polls. Defaults to WATCH_INTERVAL.
+            top (int, optional): Rules shown. Defaults to WATCH_TOP.
+            by_bytes (bool, optional): Rank by bytes/s instead of packets/s. Defaults to False.
+            count (int, optional): Polls before stopping, or None to poll until interrupted. Defaults to None.
+        """
+        monitor = HitMonitor(self.tables)
+        writer = RecordWriter(self.format) if self.format != "text" else None
+        polls = 0
+        try:
+            while True:
+                started = time.time()
+                errors = self.poll_counters(monitor, hosts)
+                polls += 1
+                rows = monitor.hottest(hosts, top, by_bytes)
+                if writer is not None:
+                    writer.write(self.hits_record(rows, errors))
+                else:
+                    self.print_hits(monitor, hosts, rows, interval, errors)
+                if count is not None and polls >= count:
+                    break
+                self.ssh_manager.sleep(max(0.0, interval - (time.time() - started)))
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def poll_counters(self, monitor, hosts):
+        """Polls counters into a HitMonitor, fetching hosts whose rules changed
+
+        Args:
+            monitor (HitMonitor): Monitor to update
+            hosts ([str]): Host names
+
+        Returns:
+            {str: str}: Error for each host that couldn't be polled
+        """
+        polled = [h for h in hosts if h in monitor.rules]
+        fetch = [h for h in hosts if h not in monitor.rules]
+        errors = {}
+        if len(polled) != 0:
+            output = self.run_each(polled, "counters_command", self.tables)
+            self.join(output)
+            now = time.time()
+            errors = IPTablesManager.failures(output)
+            for host_out in output:
+                if host_out.host in errors:
+                    continue
+                try:
+                    tables = self.backend(host_out.host).parse_counters(
+                        host_out.stdout, self.tables
+                    )
+                except NftablesException as e:
+                    errors[host_out.host] = str(e)
+                    continue
+                if monitor.matches(host_out.host, tables):
+                    monitor.poll(host_out.host, now, tables)
+                else:
+                    fetch.append(host_out.host)
+        if len(fetch) != 0:
+            fetch_errors, _ = self.refresh(fetch)
+            errors.update(fetch_errors)
+            for h in fetch:
+                if h not in fetch_errors:
+                    monitor.set_ruleset(self.cache[h])
+        # A host that fails starts over with a full fetch once it's back
+        monitor.remove(errors.keys())
+        return errors
+
+    def print_hits(self, monitor, hosts, rows, interval, errors):
+        packets, bytes, rules = monitor.totals(hosts)
+        lines = [
+            f"Every {interval:g}s: {len(hosts)} hosts, {rules} rules, "
+            f"{human(packets)} pkt/s, {human(bytes)}B/s\t{time.strftime('%H:%M:%S')}",
+            "",
+            "pkt/s\tbytes/s\tpackets\thost\t\ttable\trule",
+        ]
+        for host, table, r, pps, bps, total, _ in rows:
+            rule = IPTablesManager._colorize(str(r))
+            lines.append(
+                f"{human(pps)}\t{human(bps)}\t{human(total)}\t{host}\t{table}\t{rule}"
+            )
+        if len(rows) == 0:
+            lines.append("(rates show from the second poll)")
+        for host, e in sorted(errors.items()):
+            lines.append(f"{Fore.RED}{host}: {e}{Style.RESET_ALL}")
+        # Redraw in place on a terminal, scroll otherwise
+        clear = "\033[H\033[2J" if sys.stdout.isatty() else "\n"
+        print(clear + "\n".join(lines))
+
+    def hits_record(self, rows, errors):
+        return {
+            "time": round(time.time(), 3),
+            "rules": [
+                {
+                    "host": host,
+                    "table": table,
+                    "chain": r.chain,
+                    "rule": str(r),
+                    "pps": round(pps, 3),
+                    "bps": round(bps, 3),
+                    "packets": packets,
+                    "bytes": bytes,
+                }
+                for host, table, r, pps, bps, packets, bytes in rows
+            ],
+            "errors": errors,
+        }
 
-    def list_rules_hosts(self, hosts, verbose):
-        c = "&&".join(
-            [
-                f'printf "\\n{Fore.YELLOW + table + Style.RESET_ALL}\\n" && iptables -L -t{table} --line-numbers{" -v" if verbose else ""}'
-                for table in self.tables
-            ]
+    def print_rulesets(self, rulesets, verbose):
+        for ruleset in sorted(rulesets, key=lambda r: r.host):
+            age = time.time() - ruleset.fetched
+            print("\n" + self.host_map[ruleset.host].colorize() + f" ({age:.0f}s old)")
+            for table in self.tables:
+                if table not in ruleset.tables:
+                    continue
+                t = ruleset.tables[table]
+                print(f"\n{Fore.YELLOW + table + Style.RESET_ALL}")
+                for chain in t.chains:
+                    policy = t.policies.get(chain, "-")
+                    print(f"Chain {chain} (policy {policy})")
+                    for i, r in enumerate(t.rules[chain]):
+                        counters = ""
+                        if verbose and r.packets is not None:
+                            counters = f"[{r.packets}:{r.bytes}] "
+                        print(IPTablesManager._colorize(f"{i + 1}\t{counters}{r.spec}"))
+            print()
+
+    def ruleset_record(self, ruleset):
+        return {
+            "host": ruleset.host,
+            "age": round(time.time() - ruleset.fetched, 3),
+            "rules": tables_record(ruleset.tables, self.tables),
+        }
+
+    def print_changes(self, rulesets):
+        if self.format != "text":
+            writer = RecordWriter(self.format)
+            for ruleset in sorted(rulesets, key=lambda r: r.host):
+                record = {"host": ruleset.host, "added": None, "removed": None}
+                if ruleset.host in self.cache.previous:
+                    added, removed = ruleset.changes(self.cache.previous[ruleset.host])
+                    record["added"] = [{"table": t, "rule": str(r)} for t, r in added]
+                    record["removed"] = [
+                        {"table": t, "rule": str(r)} for t, r in removed
+                    ]
+                writer.write(record)
+            writer.close()
+            return
+        for ruleset in sorted(rulesets, key=lambda r: r.host):
+            print("\n" + self.host_map[ruleset.host].colorize())
+            if ruleset.host not in self.cache.previous:
+                print("No earlier fetch to compare against\n")
+                continue
+            added, removed = ruleset.changes(self.cache.previous[ruleset.host])
+            if len(added) == 0 and len(removed) == 0:
+                print("No changes\n")
+                continue
+            for table, r in removed:
+                print(f"{Fore.RED}- {table}\t{r}{Style.RESET_ALL}")
+            for table, r in added:
+                print(f"{Fore.GREEN}+ {table}\t{r}{Style.RESET_ALL}")
+            print()
+
+    def diff(self, hosts, baseline):
+        # baseline is a host, a save file (golden ruleset), a snapshot or a
+        # save directory, in which case each host is compared to its own save
+        is_host = baseline in self.host_map.keys()
+        saves = None
+        if not is_host and not os.path.exists(baseline) and baseline in self.store:
+            saves = self.store.load(baseline, hosts)
+        elif os.path.isdir(baseline):
+            saves = IPTablesManager.read_saves(baseline)
+        fetch = list(hosts)
+        if is_host and baseline not in fetch:
+            fetch.append(baseline)
+        rulesets = {r.host: r.tables for r in self.fetch_rules(fetch)}
+        if is_host:
+            if baseline not in rulesets:
+                return
+            golden = rulesets[baseline]
+        elif os.path.isfile(baseline):
+            golden = IPTablesManager.load_tables(baseline)
+        elif saves is None:
+            print(
+                "Baseline must be a host, a save file, a snapshot or a save directory"
+            )
+            return
+        same = []
+        writer = RecordWriter(self.format) if self.format != "text" else None
+        for h in sorted(hosts):
+            if h == baseline or h not in rulesets:
+                continue
+            if saves is not None:
+                if h not in saves:
+                    self.message(f"\nNo snapshot for {h} in {baseline}")
+                    continue
+                golden = IPTablesManager.parse_tables(saves[h])
+            diffs = diff_tables(rulesets[h], golden, self.tables)
+            if writer is not None:
+                record = {"host": h, "baseline": baseline}
+                record["diffs"] = [diff_record(d) for d in diffs]
+                writer.write(record)
+                continue
+            if len(diffs) == 0:
+                same.append(h)
+                continue
+            print("\n" + self.host_map[h].colorize() + f" vs {baseline}")
+            for d in diffs:
+                print("\n".join(d.lines()))
+        if writer is not None:
+            writer.close()
+            return
+        if len(same) != 0:
+            print(f"\nMatching {baseline}: {', '.join(same)}")
+        print()
+
+    def analyze(self, hosts, plan=False, apply=False):
+        """Reports duplicate, covered and mergeable rules on each host
+
+        Rules covered by an earlier rule never match, so removing them (and
+        merging runs) doesn't change what a chain does. The cleanup is a
+        delta iptables-restore payload from each host's live rules (whole
+        tables on nftables hosts).
+
+        Args:
+            hosts ([str]): Host names
+            plan (bool, optional): Show each host's cleanup payload. Defaults to False.
+            apply (bool, optional): Push the cleanup once confirmed. Defaults to False.
+        """
+        saves = self.fetch_saves(hosts)
+        payloads = {}
+        deltas = {}
+        writer = RecordWriter(self.format) if self.format != "text" else None
+        for h in sorted(saves.keys()):
+            live = IPTablesManager.parse_tables(saves[h])
+            findings, cleaned = analyze_tables(live, self.tables)
+            removes = sum(f.removes for f in findings)
+            payload = ""
+            if removes != 0:
+                payload = self.target_payload(h, live, cleaned, deltas)
+                payloads[h] = payload
+            if writer is not None:
+                record = {"host": h, "findings": [f.record() for f in findings]}
+                record["removes"] = removes
+                record["plan"] = payload if plan else None
+                writer.write(record)
+            else:
+                self.print_analysis(h, findings, removes, payload if plan else None)
+        if writer is not None:
+            writer.close()
+        if not apply:
+            return
+        if len(payloads) == 0:
+            self.message("\nNothing to clean up\n")
+            return
+        ans = self.ask(
+            f"\nClean up {len(payloads)} hosts?\nType `COMMIT` to proceed: ", "COMMIT"
         )
-        if not self.ssh_manager.context_changed:
-            chosts = self.ssh_manager.hosts
-            cs = [c if h in hosts else "" for h in chosts]
+        if ans != "COMMIT":
+            print("\nNo worries. Better safe than sorry.\n")
+            return
+        hosts = sorted(payloads.keys())
+        if self.confirm_timeout is not None:
+            self.commit_confirm(
+                hosts, lambda armed: self.push_restore(armed, payloads, deltas), True
+            )
         else:
-            ahosts = self.ssh_manager.all_hosts
-            chosts = self.ssh_manager.hosts
-            cs = [c if h in hosts and h in chosts else "" for h in ahosts]
-        output = self.ssh_manager.run_command("%s", commands=cs, sudo=True)
-        self.send_sudo_password(output)
-        self.ssh_manager.join(output)
-        out = []
-        for host_out in output:
-            if host_out.host not in hosts:
-                continue
-            o = IPTablesManager._colorize("\n".join(host_out.stdout))
-            out.append((self.host_map[host_out.host], o))
-        out = sorted(out, key=lambda x: x[0].host)
-        for host, o in out:
-            print("\n" + host.colorize())
-            print(o + "\n")
+            output = self.push_restore(hosts, payloads, deltas)
+            self.print_output(output, stderr=True)
+
+    def target_payload(self, host, live, target, deltas):
+        """Builds the restore payload taking a host from its live rules to target
+
+        A delta where the host takes them and the chains line up, the full
+        tables otherwise.
 
-    def list_rules_indices(self, indices, verbose):
-        c = "&&".join(
-            [
-                f'printf "\\n{Fore.YELLOW + table + Style.RESET_ALL}\\n" && iptables -L -t{table} --line-numbers{" -v" if verbose else ""}'
-                for table in self.tables
-            ]
+        Args:
+            host (str): Host name
+            live ({str: Table}): Host's live tables
+            target ({str: Table}): Tables wanted
+            deltas ({str: str}): Delta payloads by host, added to when the payload is one
+
+        Returns:
+            str: iptables-restore payload
+        """
+        if self.backend(host).delta:
+            payload = delta_restore(live, target, self.tables)
+            if payload is not None:
+                deltas[host] = payload
+                return payload
+        return self.build_restore({name: t.to_lines() for name, t in target.items()})
+
+    def print_analysis(self, host, findings, removes, payload):
+        print("\n" + self.host_map[host].colorize())
+        if len(findings) == 0:
+            print("Nothing to clean up\n")
+            return
+        chain = None
+        for f in findings:
+            if (f.table, f.chain) != chain:
+                chain = (f.table, f.chain)
+                print(f"{Fore.YELLOW}{f.table} {f.chain}{Style.RESET_ALL}")
+            print("  " + f.line())
+        counts = {}
+        for f in findings:
+            counts[f.kind] = counts.get(f.kind, 0) + 1
+        summary = ", ".join(f"{n} {kind}" for kind, n in sorted(counts.items()))
+        print(f"\n{summary}; cleanup removes {removes} rules")
+        if payload is not None and payload != "":
+            print(f"\nCleanup plan:\n{payload}")
+        print()
+
+    def optimize(self, hosts, window=OPTIMIZE_WINDOW, plan=False, apply=False):
+        """Moves each host's busiest rules towards the top of their chains
+
+        Rule counters are read twice, window seconds apart, and each chain
+        is reordered by hits over that window. Rules only move past rules
+        they can't both match (or that end the chain the same way), so
+        every packet still gets the same verdict. The new order is a delta
+        iptables-restore payload from each host's live rules (whole tables
+        on nftables hosts, which resets their counters).
+
+        Args:
+            hosts ([str]): Host names
+            window (float, optional): Seconds of traffic to count, or 0 to use the counters since they were last zeroed. Defaults to OPTIMIZE_WINDOW.
+            plan (bool, optional): Show each host's reorder payload. Defaults to False.
+            apply (bool, optional): Push the new order once confirmed. Defaults to False.
+        """
+        monitor = HitMonitor(self.tables)
+        if window > 0:
+            for r in self.fetch_rules(hosts, force=True):
+                monitor.set_ruleset(r)
+            self.message(f"\nCounting hits for {window:g} seconds...")
+            self.ssh_manager.sleep(window)
+            hosts = [h for h in hosts if h in monitor.rules]
+        rulesets = self.fetch_rules(hosts, force=True)
+        payloads = {}
+        deltas = {}
+        writer = RecordWriter(self.format) if self.format != "text" else None
+        for ruleset in sorted(rulesets, key=lambda r: r.host):
+            h = ruleset.host
+            live = ruleset.tables
+            if window > 0:
+                monitor.set_ruleset(ruleset)
+                weights = {
+                    id(r): rate[0] if rate is not None else 0.0
+                    for (_, r), rate in zip(monitor.rules[h], monitor.rates[h])
+                }
+            else:
+                weights = {
+                    id(r): r.packets or 0 for t in live.values() for r in t.all_rules()
+                }
+            changes, optimized = optimize_tables(live, self.tables, weights)
+            payload = ""
+            if len(changes) != 0:
+                payload = self.target_payload(h, live, optimized, deltas)
+                payloads[h] = payload
+            if writer is not None:
+                record = {
+                    "host": h,
+                    "window": window,
+                    "chains": [c.record() for c in changes],
+                }
+                record["plan"] = payload if plan else None
+                writer.write(record)
+            else:
+                self.print_optimize(h, changes, payload if plan else None)
+        if writer is not None:
+            writer.close()
+        if not apply:
+            return
+        if len(payloads) == 0:
+            self.message("\nNothing to reorder\n")
+            return
+        ans = self.ask(
+            f"\nReorder rules on {len(payloads)} hosts?\nType `COMMIT` to proceed: ",
+            "COMMIT",
         )
-        if not self.ssh_manager.context_changed:
-            shosts = self.ssh_manager.hosts
-            hosts = []
-            for i in range(len(shosts)):
-                if i in indices:
-                    hosts.append(shosts[i])
-            cs = [c if h in hosts else "" for h in shosts]
+        if ans != "COMMIT":
+            print("\nNo worries. Better safe than sorry.\n")
+            return
+        hosts = sorted(payloads.keys())
+        if self.confirm_timeout is not None:
+            self.commit_confirm(
+                hosts, lambda armed: self.push_restore(armed, payloads, deltas), True
+            )
         else:
-            ahosts = self.ssh_manager.all_hosts
-            shosts = self.ssh_manager.hosts
-            hosts = []
-            for i in range(len(shosts)):
-                if i in indices:
-                    hosts.append(shosts[i])
-            cs = [c if h in hosts else "" for h in ahosts]
-        output = self.ssh_manager.run_command("%s", commands=cs, sudo=True)
-        self.send_sudo_password(output)
-        self.ssh_manager.join(output)
-        out = []
-        for host_out in output:
-            if host_out.host not in hosts:
+            output = self.push_restore(hosts, payloads, deltas)
+            self.print_output(output, stderr=True)
+
+    def print_optimize(self, host, changes, payload):
+        print("\n" + self.host_map[host].colorize())
+        if len(changes) == 0:
+            print("Nothing to reorder\n")
+            return
+        for c in changes:
+            print(f"  {Fore.YELLOW}{c.line()}{Style.RESET_ALL}")
+        if payload is not None and payload != "":
+            print(f"\nReorder plan:\n{payload}")
+        print()
+
+    def consolidate(self, hosts, plan=False, apply=False):
+        """Finds runs of rules that differ in one address or port and moves them into ipsets
+
+        Each run becomes one rule matching a set. The sets are loaded first
+        with ipset restore, then the rules are swapped in with one delta
+        iptables-restore per host.
+
+        Args:
+            hosts ([str]): Host names
+            plan (bool, optional): Show each host's ipset and iptables payloads. Defaults to False.
+            apply (bool, optional): Push the change once confirmed. Defaults to False.
+        """
+        saves = self.fetch_saves(self.split_backends(hosts, "consolidate"))
+        sets = {}
+        payloads = {}
+        deltas = {}
+        writer = RecordWriter(self.format) if self.format != "text" else None
+        for h in sorted(saves.keys()):
+            live = IPTablesManager.parse_tables(saves[h])
+            runs, consolidated = consolidate_tables(live, self.tables)
+            if len(runs) != 0:
+                sets[h] = ipset_payload(runs)
+                payloads[h] = self.target_payload(h, live, consolidated, deltas)
+            if writer is not None:
+                record = {"host": h, "sets": [r.record() for r in runs]}
+                record["ipset"] = sets.get(h) if plan else None
+                record["plan"] = payloads.get(h) if plan else None
+                writer.write(record)
                 continue
-            o = IPTablesManager._colorize("\n".join(host_out.stdout))
-            out.append((self.host_map[host_out.host], o))
-        out = sorted(out, key=lambda x: x[0].host)
-        for host, o in out:
-            print("\n" + host.colorize())
-            print(o + "\n")
+            print("\n" + self.host_map[h].colorize())
+            if len(runs) == 0:
+                print("Nothing to consolidate\n")
+                continue
+            for r in runs:
+                print(f"{Fore.YELLOW}{r.table} {r.chain}{Style.RESET_ALL} {r.line()}")
+            removed = sum(len(r.rules) - 1 for r in runs)
+            print(f"\n{len(runs)} sets replace {removed + len(runs)} rules")
+            if plan:
+                print(f"\nipset restore:\n{sets[h]}\nCleanup plan:\n{payloads[h]}")
+            print()
+        if writer is not None:
+            writer.close()
+        if not apply:
+            return
+        if len(payloads) == 0:
+            self.message("\nNothing to consolidate\n")
+            return
+        ans = self.ask(
+            f"\nMove rules into ipsets on {len(payloads)} hosts?\nType `COMMIT` to proceed: ",
+            "COMMIT",
+        )
+        if ans != "COMMIT":
+            print("\nNo worries. Better safe than sorry.\n")
+            return
+        # Sets nothing references yet are harmless, so a host whose ipset
+        # restore fails is just left out of the rule change
+        output = self.push_ipset(sorted(payloads.keys()), sets)
+        self.join(output)
+        failed = IPTablesManager.failures(output)
+        for h in sorted(failed.keys()):
+            self.message(
+                f"{Fore.RED}Couldn't load sets on {h}: {failed[h]}{Style.RESET_ALL}"
+            )
+        hosts = [h for h in sorted(payloads.keys()) if h not in failed]
+        if len(hosts) == 0:
+            return
+        if self.confirm_timeout is not None:
+            self.commit_confirm(
+                hosts, lambda armed: self.push_restore(armed, payloads, deltas), True
+            )
+        else:
+            output = self.push_restore(hosts, payloads, deltas)
+            self.print_output(output, stderr=True)
+
+    def push_ipset(self, hosts, payloads, command="ipset restore"):
+        # Starts command on each host with its ipset restore payload on stdin
+        return self.run(command, hosts, sudo=True, stdin=payloads)
+
+    def block(self, action, addresses):
+        """Adds addresses to (or removes them from) the blocklist set on every host in context
+
+        Only the set changes, so this costs one ipset restore per host
+        however long the blocklist is. The rules dropping the set's
+        addresses are added the first time.
 
-    def run_iptables(self, arg, hosts=None, indices=None, all_hosts=False):
-        c = f"iptables {arg}"
+        Args:
+            action (str): "add" or "remove"
+            addresses ([str]): Addresses or networks
+        """
+        hosts = self.split_backends(self.ssh_manager.hosts, "block")
+        payload = block_payload(action, parse_addresses(addresses))
+        output = self.push_ipset(hosts, {h: payload for h in hosts}, block_command())
+        self.cache.invalidate(hosts)
+        self.print_output(output, stderr=True)
+
+    def run_iptables(
+        self, arg, hosts=None, indices=None, all_hosts=False, callback=None
+    ):
         ahosts = self.ssh_manager.all_hosts
         if all_hosts:
             hosts = ahosts
         elif hosts is None and indices is None:
             hosts = self.ssh_manager.hosts
         elif hosts is None:
-            indices = sorted(list(set(indices)))
-            if indices[0] < 0 or indices[len(indices) - 1] >= len(ahosts):
+            hosts = self.host_map.hosts_by_ids(sorted(set(indices)))
+            if hosts is None:
                 print("Args invalid")
                 return
-            hosts = [ahosts[i] for i in indices]
+            hosts = sorted(hosts)
         else:
             hosts = sorted(list(set(hosts)))
-        cs = [c if h in hosts else "" for h in ahosts]
-        output = self.ssh_manager.run_command("%s", commands=cs, sudo=True)
-        self.send_sudo_password(output)
-        self.ssh_manager.join(output)
+        if self.confirm_timeout is not None:
+            apply = lambda armed: self.iptables_output(arg, armed)
+            self.commit_confirm(hosts, apply, callback=callback)
+            return
+        output = self.iptables_output(arg, hosts)
+        self.cache.invalidate(hosts)
+        self.print_output(output, callback=callback)
+
+    def iptables_output(self, arg, hosts):
+        """Starts an `iptables` command on each host
+
+        nftables hosts get the command as an nft script against their live
+        rules, which are fetched first. Hosts it can't be turned into a
+        script for are failed rather than run.
+
+        Args:
+            arg (str): iptables arguments
+            hosts ([str]): Host names
+
+        Returns:
+            [HostOutput]: Output of the hosts it was started on
+        """
+        self.detect_pending(hosts)
+        nft = [h for h in hosts if not self.backend(h).delta]
+        payloads = {}
+        errors = {}
+        if len(nft) != 0:
+            live = {r.host: r.tables for r in self.fetch_rules(nft, True)}
+            for h in nft:
+                if h not in live:
+                    errors[h] = "couldn't fetch live rules"
+                    continue
+                try:
+                    payloads[h] = command_script(live[h], arg)
+                except NftablesException as e:
+                    errors[h] = str(e)
+        self.fail(errors)
+        hosts = [h for h in hosts if h not in errors]
+        commands = {h: self.backend(h).iptables_command(arg) for h in hosts}
+        return self.push(hosts, commands, payloads)
+
+    def print_output(self, output, colorize=True, stderr=False, callback=None):
+        if self.format != "text" and callback is None:
+            self.emit_records(output)
+            return
+        if callback is not None or self.stream:
+            self.stream_output(output, colorize, stderr, callback)
+            return
+        self.print_results(output, colorize, stderr, self.join(output))
+
+    def print_results(
+        self, output, colorize=True, stderr=False, timed_out=None, callback=None
+    ):
+        # Prints output that's already finished, sorted by host
+        if self.format != "text" and callback is None:
+            writer = RecordWriter(self.format)
+            for host_out in sorted(output, key=lambda h: h.host):
+                finished = getattr(host_out, "finished", None) or time.time()
+                stdout = list(host_out.stdout) if host_out.client is not None else []
+                d = finished - output.started
+                writer.write(host_record(host_out, stdout, [], d))
+            writer.close()
+            return
+        if timed_out is None:
+            timed_out = IPTablesManager.timed_out(output)
+        if callback is not None or self.stream:
+            if callback is None:
+                callback = self._print_line
+            for host_out in output:
+                host = self.host_map[host_out.host]
+                for line in IPTablesManager._host_lines(host_out, stderr):
+                    callback(
+                        host, IPTablesManager._colorize(line) if colorize else line
+                    )
+                callback(host, None)
+            self.print_timed_out(timed_out)
+            return
         out = []
         for host_out in output:
-            if host_out.host not in hosts:
-                continue
-            o = IPTablesManager._colorize("\n".join(host_out.stdout))
+            o = "\n".join(IPTablesManager._host_lines(host_out, stderr))
+            if colorize:
+                o = IPTablesManager._colorize(o)
             out.append((self.host_map[host_out.host], o))
         out = sorted(out, key=lambda x: x[0].host)
         for host, o in out:
             print("\n" + host.colorize())
             print(o + "\n")
+        for host_out in output:
+            output.timings.collect(host_out.host)
+        self.print_timed_out(timed_out)
+
+    def emit_records(self, output, writer=None, rules=False):
+        # Writes each host's record as soon as it finishes, without colors.
+        # With rules, stdout is each backend's fetch output to parse into the
+        # record.
+        close = writer is None
+        if writer is None:
+            writer = RecordWriter(self.format)
+        stdout = {host_out: [] for host_out in output}
+        lines = self.ssh_manager.iter_lines(output, timeout=self.time_left(output))
+        for host_out, line in lines:
+            if line is not None:
+                stdout[host_out].append(line)
+                continue
+            self.ssh_manager.wait_host(host_out)
+            duration = time.time() - output.started
+            stderr = []
+            if host_out.exception is None and host_out.client is not None:
+                stderr = list(host_out.stderr)
+            record = host_record(host_out, stdout[host_out], stderr, duration)
+            if rules and host_out.exception is None:
+                backend = self.backend(host_out.host)
+                try:
+                    tables = backend.parse_fetch(stdout[host_out], self.tables)
+                    ruleset = Ruleset(host_out.host, tables)
+                    self.cache.update(ruleset)
+                    record["rules"] = tables_record(ruleset.tables, self.tables)
+                    record["stdout"] = []
+                except NftablesException as e:
+                    record["error"] = str(e)
+            writer.write(record)
+            output.timings.collect(host_out.host)
+        self.ssh_manager.join(output)
+        self.record(output)
+        if close:
+            writer.close()
+
+    def stream_output(self, output, colorize=True, stderr=False, callback=None):
+        # Lines come back in arrival order, so a slow host never holds back
+        # the others. A None line marks the end of a host's output.
+        if callback is None:
+            callback = self._print_line
+        lines = self.ssh_manager.iter_lines(
+            output, stderr, timeout=self.time_left(output)
+        )
+        for host_out, line in lines:
+            host = self.host_map[host_out.host]
+            if line is None:
+                if host_out.exception is not None:
+                    callback(host, IPTablesManager._error_line(host_out))
+                callback(host, None)
+                output.timings.collect(host_out.host)
+                continue
+            if colorize:
+                line = IPTablesManager._colorize(line)
+            callback(host, line)
+        self.ssh_manager.join(output)
+        self.record(output)
+        self.print_timed_out(IPTablesManager.timed_out(output))
+
+    @staticmethod
+    def _host_lines(host_out, stderr=False):
+        # Hosts cut off by a deadline still show what they printed in time
+        if host_out.client is not None:
+            try:
+                yield from host_out.stdout
+                if stderr:
+                    yield from host_out.stderr
+            except Exception as e:
+                if host_out.exception is None:
+                    host_out.exception = HostTimeout(repr(e))
+        if host_out.exception is not None:
+            yield IPTablesManager._error_line(host_out)
+
+    @staticmethod
+    def _error_line(host_out):
+        return f"{Fore.RED}Error: {host_out.exception!r}{Style.RESET_ALL}"
+
+    @staticmethod
+    def _print_line(host, line):
+        if line is None:
+            print(f"{host.colorize()} {Style.DIM}(done){Style.RESET_ALL}")
+        else:
+            print(f"{host.colorize()} {line}")
 
     def add_tables(self, tables):
         tables = list(filter(lambda t: t not in self.tables, tables))
@@ -279,7 +1550,13 @@ class IPTablesManager(object):
         self.ssh_manager.change_context_hosts(new_hosts)
 
     def change_context_indices(self, indices):
-        self.ssh_manager.change_context_indices(indices)
+        hosts = self.host_map.hosts_by_ids(indices)
+        if hosts is None:
+            raise self.ssh_manager.ContextException("No host with that ID")
+        self.ssh_manager.change_context_hosts(hosts)
+
+    def change_context_select(self, terms):
+        self.ssh_manager.change_context_hosts(self.host_map.select(terms))
 
     def reset_context(self):
         self.ssh_manager.reset_context()
@@ -291,17 +1568,21 @@ class IPTablesManager(object):
         hosts = self.ssh_manager.hosts
         if self.context_changed():
             print("\nContext:\n")
-            for i in range(len(hosts)):
-                print(f"{i}\t{hosts[i]}")
+            for h in sorted(hosts, key=lambda h: self.host_map.ids[h]):
+                print(f"{self.host_map.ids[h]}\t{h}")
             print()
         else:
             print("\nContext not set\n")
 
     def print_hosts(self):
-        hosts = self.ssh_manager.all_hosts
         print("\nHosts:\n")
-        for i in range(len(hosts)):
-            print(f"{i}\t{hosts[i]}")
+        for i, h in self.host_map.sorted_ids():
+            host = self.host_map[h]
+            labels = [f"group:{g}" for g in sorted(host.groups)]
+            labels += [f"tag:{t}" for t in sorted(host.tags)]
+            if not self.backend(h).delta:
+                labels.append(f"firewall:{self.backend(h).name}")
+            print(f"{i}\t{h}" + (f"\t{' '.join(labels)}" if len(labels) != 0 else ""))
         print()
 
     def print_tables(self):
@@ -310,6 +1591,25 @@ class IPTablesManager(object):
             print(f"{i}\t{self.tables[i]}")
         print()
 
+    def print_settings(self):
+        print("\nSettings:\n")
+        print(f"stream\t{'on' if self.stream else 'off'}")
+        print(f"ttl\t{self.cache.ttl}")
+        print(f"timeout\t{self.host_timeout if self.host_timeout else 'none'}")
+        print(f"deadline\t{self.deadline if self.deadline else 'none'}")
+        print(f"sudo\t{'session' if self.ssh_manager.sudo_session else 'prompt'}")
+        print(f"interactive\t{'on' if self.interactive else 'off'}")
+        print(f"concurrency\t{self.ssh_manager.pool_size}")
+        print(f"connect\t{self.ssh_manager.sessions.limiter}")
+        print(f"format\t{self.format}")
+        print(f"rollout\t{self.rollout_plan}")
+        confirm = self.confirm_timeout
+        print(f"confirm\t{confirm if confirm is not None else 'off'}")
+        print(f"timings\t{'on' if self.show_timings else 'off'}")
+        print(f"metrics\t{self.metrics_spec if self.metrics is not None else 'off'}")
+        print(f"firewall\t{self.firewall}")
+        print()
+
     @staticmethod
     def _colorize(output):
         return (
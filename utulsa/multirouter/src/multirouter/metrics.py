@@ -0,0 +1,224 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+import json
+import math
+import os
+import time
+
+# Phases in the order a command goes through them (see Timings)
+PHASES = ("connect", "auth", "sudo", "channel", "exec", "collect")
+
+# Histogram bucket bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class MetricsException(Exception):
+    pass
+
+
+def merge(timings):
+    """Adds up each host's phases over every fan-out of one command
+
+    Args:
+        timings ([Timings]): Timings of the command's fan-outs
+
+    Returns:
+        {str: {str: float}}: host -> phase -> seconds
+    """
+    hosts = {}
+    for t in timings:
+        for host, phases in t.phases.items():
+            merged = hosts.setdefault(host, {})
+            for phase, seconds in phases.items():
+                merged[phase] = merged.get(phase, 0.0) + seconds
+    return hosts
+
+
+def percentile(values, p):
+    """Nearest rank percentile
+
+    Args:
+        values ([float]): Values, sorted
+        p (float): Percentile, 0 to 100
+
+    Returns:
+        float: Value
+    """
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def phase_stats(hosts):
+    """Summarizes each phase across hosts
+
+    Args:
+        hosts ({str: {str: float}}): host -> phase -> seconds, from merge
+
+    Returns:
+        [(str, float, float, float, str)]: (phase, p50, p95, max, slowest host), ending with the total
+    """
+    stats = []
+    totals = {h: sum(phases.values()) for h, phases in hosts.items()}
+    for phase in PHASES + ("total",):
+        if phase == "total":
+            values = totals
+        else:
+            values = {h: p[phase] for h, p in hosts.items() if phase in p}
+        if len(values) == 0:
+            continue
+        ordered = sorted(values.values())
+        slowest = max(values.keys(), key=lambda h: values[h])
+        stats.append(
+            (
+                phase,
+                percentile(ordered, 50),
+                percentile(ordered, 95),
+                ordered[-1],
+                slowest,
+            )
+        )
+    return stats
+
+
+class MetricsSink(object):
+    """Gets every command's per host phase timings"""
+
+    def observe(self, command, hosts):
+        """Records one command's timings
+
+        Args:
+            command (str): Command name (list, iptables, ...)
+            hosts ({str: {str: float}}): host -> phase -> seconds, from merge
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PrometheusSink(MetricsSink):
+    """Keeps running totals and rewrites them as a Prometheus text file
+
+    The file suits node_exporter's textfile collector. Phase histograms are
+    fleet wide; per host series only carry a sum and count, so the number of
+    series stays proportional to the number of hosts.
+    """
+
+    def __init__(self, path):
+        """Initializes PrometheusSink
+
+        Args:
+            path (str): File to write (written atomically after each command)
+        """
+        self.path = path
+        self.buckets = {phase: [0] * len(BUCKETS) for phase in PHASES}
+        self.sums = {phase: 0.0 for phase in PHASES}
+        self.counts = {phase: 0 for phase in PHASES}
+        self.host_sums = {}
+        self.host_counts = {}
+        self.commands = {}
+
+    def observe(self, command, hosts):
+        self.commands[command] = self.commands.get(command, 0) + 1
+        for host, phases in hosts.items():
+            for phase, seconds in phases.items():
+                for i, bound in enumerate(BUCKETS):
+                    if seconds <= bound:
+                        self.buckets[phase][i] += 1
+                self.sums[phase] += seconds
+                self.counts[phase] += 1
+                key = (host, phase)
+                self.host_sums[key] = self.host_sums.get(key, 0.0) + seconds
+                self.host_counts[key] = self.host_counts.get(key, 0) + 1
+        self.write()
+
+    def write(self):
+        lines = [
+            "# HELP multirouter_commands_total Commands run, by command",
+            "# TYPE multirouter_commands_total counter",
+        ]
+        for command in sorted(self.commands.keys()):
+            lines.append(
+                f'multirouter_commands_total{{command="{command}"}} {self.commands[command]}'
+            )
+        lines += [
+            "# HELP multirouter_phase_seconds Seconds hosts spent in each phase of a command",
+            "# TYPE multirouter_phase_seconds histogram",
+        ]
+        for phase in PHASES:
+            for bound, count in zip(BUCKETS, self.buckets[phase]):
+                lines.append(
+                    f'multirouter_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {count}'
+                )
+            lines.append(
+                f'multirouter_phase_seconds_bucket{{phase="{phase}",le="+Inf"}} {self.counts[phase]}'
+            )
+            lines.append(
+                f'multirouter_phase_seconds_sum{{phase="{phase}"}} {self.sums[phase]:.6f}'
+            )
+            lines.append(
+                f'multirouter_phase_seconds_count{{phase="{phase}"}} {self.counts[phase]}'
+            )
+        lines += [
+            "# HELP multirouter_host_phase_seconds Seconds each host spent in each phase",
+            "# TYPE multirouter_host_phase_seconds summary",
+        ]
+        for host, phase in sorted(self.host_sums.keys()):
+            labels = f'host="{host}",phase="{phase}"'
+            lines.append(
+                f"multirouter_host_phase_seconds_sum{{{labels}}} {self.host_sums[(host, phase)]:.6f}"
+            )
+            lines.append(
+                f"multirouter_host_phase_seconds_count{{{labels}}} {self.host_counts[(host, phase)]}"
+            )
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.path)
+
+
+class NDJSONSink(MetricsSink):
+    """Appends one JSON line per command with every host's phases"""
+
+    def __init__(self, path):
+        """Initializes NDJSONSink
+
+        Args:
+            path (str): File to append to
+        """
+        self.f = open(path, "a")
+
+    def observe(self, command, hosts):
+        record = {"time": time.time(), "command": command, "hosts": hosts}
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+SINKS = {"prometheus": PrometheusSink, "ndjson": NDJSONSink}
+
+
+def open_sink(spec):
+    """Opens a sink from its text form
+
+    Args:
+        spec (str): kind:path, e.g. prometheus:/var/lib/node_exporter/multirouter.prom
+
+    Returns:
+        MetricsSink: Sink
+    """
+    kind, _, path = spec.partition(":")
+    if kind not in SINKS or path == "":
+        raise MetricsException(
+            f"Metrics must be {' or '.join(k + ':path' for k in SINKS)}"
+        )
+    return SINKS[kind](path)
@@ -0,0 +1,245 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+import heapq
+
+# Seconds between polls, and rules shown
+WATCH_INTERVAL = 2.0
+WATCH_TOP = 20
+# Polls between full refetches, which catch a rule replaced in place by one
+# in the same chain (the only change counter polls can't see)
+WATCH_REFRESH = 30
+
+# Cuts iptables-save -c down to `*table` lines and `packets bytes chain` per
+# rule, so polls don't transfer rule text. Double quoted since the command is
+# wrapped in single quotes for sudo.
+COUNTER_FILTER = (
+    'sed -n -e "/^\\*/p" '
+    '-e "s/^\\[\\([0-9]*\\):\\([0-9]*\\)\\] -A \\([^ ]*\\).*/\\1 \\2 \\3/p"'
+)
+
+
+def counters_command(tables):
+    """Builds the command that polls rule counters
+
+    Args:
+        tables ([str]): Table names
+
+    Returns:
+        str: Command
+    """
+    return " && ".join(
+        [f"iptables-save -c -t {table} | {COUNTER_FILTER}" for table in tables]
+    )
+
+
+def parse_counters(lines):
+    """Parses counters_command output
+
+    Args:
+        lines ([str]): Output lines
+
+    Returns:
+        {str: ([str], [(int, int)])}: table -> (chain of each rule, (packets, bytes) of each rule)
+    """
+    tables = {}
+    chains = None
+    counts = None
+    for line in lines:
+        if line.startswith("*"):
+            chains = []
+            counts = []
+            tables[line[1:].strip()] = (chains, counts)
+            continue
+        args = line.split()
+        if chains is None or len(args) != 3:
+            continue
+        chains.append(args[2])
+        counts.append((int(args[0]), int(args[1])))
+    return tables
+
+
+class HitMonitor(object):
+    """Turns successive counter polls into per rule packet and byte rates
+
+    Each host's rules are kept from its last full fetch, and polls only
+    carry counters in the same order. A poll whose chains don't line up
+    with the rules (a rule was added, deleted or moved) means the host needs
+    fetching again.
+    """
+
+    def __init__(self, tables):
+        """Initializes HitMonitor
+
+        Args:
+            tables ([str]): Tables watched
+        """
+        self.tables = tables
+        # host -> [(table, Rule)] in iptables-save order
+        self.rules = {}
+        # host -> {table: [chain of each rule]}
+        self.layouts = {}
+        # host -> (time, [(packets, bytes)]) aligned with self.rules
+        self.samples = {}
+        # host -> [(packets/s, bytes/s)] aligned with self.rules
+        self.rates = {}
+        # host -> polls since its last full fetch
+        self.polls = {}
+
+    def set_ruleset(self, ruleset):
+        """Takes a host's rules (and their counters) from a full fetch
+
+        Rates carry on across the fetch for rules that are still there.
+
+        Args:
+            ruleset (Ruleset): Fetched ruleset
+        """
+        host = ruleset.host
+        rules = []
+        layout = {}
+        for name in self.tables:
+            table = ruleset.tables.get(name)
+            chains = layout.setdefault(name, [])
+            if table is None:
+                continue
+            for r in table.all_rules():
+                rules.append((name, r))
+                chains.append(r.chain)
+        previous = self.samples.pop(host, None)
+        if previous is not None:
+            # Line the old counters up with the new rules, with duplicate
+            # rules matched in order
+            old = {}
+            for key, count in zip(self.rules[host], previous[1]):
+                old.setdefault(key, []).append(count)
+            counts = [
+                old[k].pop(0) if len(old.get(k, ())) != 0 else None for k in rules
+            ]
+            self.samples[host] = (previous[0], counts)
+        self.rules[host] = rules
+        self.layouts[host] = layout
+        self.polls[host] = 0
+        counts = [(r.packets or 0, r.bytes or 0) for _, r in rules]
+        self.update(host, ruleset.fetched, counts)
+
+    def matches(self, host, tables):
+        """Checks whether a poll lines up with the host's last full fetch
+
+        Args:
+            host (str): Host name
+            tables ({str: ([str], [(int, int)])}): Parsed poll, from parse_counters
+
+        Returns:
+            bool: Whether the poll's counters can be used
+        """
+        layout = self.layouts.get(host)
+        if layout is None or self.polls[host] >= WATCH_REFRESH:
+            return False
+        return all(tables.get(t, ([], []))[0] == chains for t, chains in layout.items())
+
+    def poll(self, host, when, tables):
+        """Takes a poll that matches the host's rules
+
+        Args:
+            host (str): Host name
+            when (float): Time polled
+            tables ({str: ([str], [(int, int)])}): Parsed poll, from parse_counters
+        """
+        counts = []
+        for name in self.tables:
+            counts += tables.get(name, ([], []))[1]
+        self.polls[host] += 1
+        self.update(host, when, counts)
+
+    def update(self, host, when, counts):
+        previous = self.samples.get(host)
+        self.samples[host] = (when, counts)
+        if previous is None or when <= previous[0]:
+            self.rates[host] = [None] * len(counts)
+            return
+        elapsed = when - previous[0]
+        rates = []
+        for new, old in zip(counts, previous[1]):
+            if old is None:
+                rates.append(None)
+            elif new[0] < old[0]:
+                # Zeroed (iptables -Z) since the last poll
+                rates.append((new[0] / elapsed, new[1] / elapsed))
+            else:
+                rates.append(((new[0] - old[0]) / elapsed, (new[1] - old[1]) / elapsed))
+        self.rates[host] = rates
+
+    def remove(self, hosts):
+        for h in hosts:
+            for d in (self.rules, self.layouts, self.samples, self.rates, self.polls):
+                d.pop(h, None)
+
+    def hottest(self, hosts, top, by_bytes=False):
+        """Gets the busiest rules across hosts
+
+        Args:
+            hosts ([str]): Host names
+            top (int): Rules to return
+            by_bytes (bool, optional): Rank by bytes/s instead of packets/s. Defaults to False.
+
+        Returns:
+            [(str, str, Rule, float, float, int, int)]: (host, table, rule, packets/s, bytes/s, packets, bytes), busiest first
+        """
+        i = 1 if by_bytes else 0
+
+        def rows():
+            for host in hosts:
+                rules = self.rules.get(host, [])
+                counts = self.samples.get(host, (0, []))[1]
+                for (table, r), rate, count in zip(
+                    rules, self.rates.get(host, []), counts
+                ):
+                    if rate is not None:
+                        yield (host, table, r, rate[0], rate[1], count[0], count[1])
+
+        return heapq.nlargest(top, rows(), key=lambda row: row[3 + i])
+
+    def totals(self, hosts):
+        """Adds up every rule's rates across hosts
+
+        Args:
+            hosts ([str]): Host names
+
+        Returns:
+            (float, float, int): (packets/s, bytes/s, rules)
+        """
+        packets = 0.0
+        bytes = 0.0
+        rules = 0
+        for host in hosts:
+            for rate in self.rates.get(host, []):
+                rules += 1
+                if rate is not None:
+                    packets += rate[0]
+                    bytes += rate[1]
+        return (packets, bytes, rules)
+
+
+def human(n):
+    """Formats a rate like iptables -L -v does counters (1234K)
+
+    Args:
+        n (float): Value
+
+    Returns:
+        str: Value with a K/M/G suffix
+    """
+    if n < 100:
+        return f"{n:.1f}"
+    for suffix in ("", "K", "M"):
+        if n < 10000:
+            return f"{n:.0f}{suffix}"
+        n /= 1000
+    return f"{n:.0f}G"
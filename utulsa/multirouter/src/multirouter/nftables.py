@@ -0,0 +1,987 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+import ipaddress
+import json
+import shlex
+
+from colorama import Fore, Style
+
+from .analyze import join
+from .backend import FirewallBackend
+from .ruleset import Rule, Table, parse_save
+
+# Only tables of this family are read and written, the same ones
+# iptables-nft uses
+FAMILY = "ip"
+
+# table -> chain -> (type, hook, priority) of the chains iptables builds in
+BASE_CHAINS = {
+    "filter": {
+        "INPUT": ("filter", "input", 0),
+        "FORWARD": ("filter", "forward", 0),
+        "OUTPUT": ("filter", "output", 0),
+    },
+    "nat": {
+        "PREROUTING": ("nat", "prerouting", -100),
+        "INPUT": ("nat", "input", 100),
+        "OUTPUT": ("nat", "output", -100),
+        "POSTROUTING": ("nat", "postrouting", 100),
+    },
+    "mangle": {
+        "PREROUTING": ("filter", "prerouting", -150),
+        "INPUT": ("filter", "input", -150),
+        "FORWARD": ("filter", "forward", -150),
+        "OUTPUT": ("route", "output", -150),
+        "POSTROUTING": ("filter", "postrouting", -150),
+    },
+    "raw": {
+        "PREROUTING": ("filter", "prerouting", -300),
+        "OUTPUT": ("filter", "output", -300),
+    },
+}
+
+# iptables --log-level numbers are indices into this
+LOG_LEVELS = ["emerg", "alert", "crit", "err", "warn", "notice", "info", "debug"]
+
+# iptables --limit units, and nft's
+LIMIT_UNITS = {"sec": "second", "min": "minute", "hour": "hour", "day": "day"}
+
+# iptables --reject-with, and nft's icmp type
+REJECT_TYPES = {
+    "icmp-net-unreachable": "net-unreachable",
+    "icmp-host-unreachable": "host-unreachable",
+    "icmp-port-unreachable": "port-unreachable",
+    "icmp-proto-unreachable": "prot-unreachable",
+    "icmp-net-prohibited": "net-prohibited",
+    "icmp-host-prohibited": "host-prohibited",
+    "icmp-admin-prohibited": "admin-prohibited",
+}
+
+ICMP_TYPES = {
+    "echo-reply": 0,
+    "destination-unreachable": 3,
+    "source-quench": 4,
+    "redirect": 5,
+    "echo-request": 8,
+    "router-advertisement": 9,
+    "router-solicitation": 10,
+    "time-exceeded": 11,
+    "parameter-problem": 12,
+    "timestamp-request": 13,
+    "timestamp-reply": 14,
+    "info-request": 15,
+    "info-reply": 16,
+    "address-mask-request": 17,
+    "address-mask-reply": 18,
+}
+
+PROTOCOLS = {1: "icmp", 6: "tcp", 17: "udp", 132: "sctp"}
+
+# Conntrack states nft matches natively, in the order iptables prints them
+STATES = ["INVALID", "NEW", "RELATED", "ESTABLISHED", "UNTRACKED"]
+
+# Matches that go with -m, and the options each takes
+MODULES = {
+    "tcp": ("--sport", "--source-port", "--dport", "--destination-port"),
+    "udp": ("--sport", "--source-port", "--dport", "--destination-port"),
+    "sctp": ("--sport", "--source-port", "--dport", "--destination-port"),
+    "multiport": (
+        "--sports",
+        "--source-ports",
+        "--dports",
+        "--destination-ports",
+        "--ports",
+    ),
+    "conntrack": ("--ctstate",),
+    "state": ("--state",),
+    "icmp": ("--icmp-type",),
+    "limit": ("--limit", "--limit-burst"),
+    "comment": ("--comment",),
+}
+
+# iptables commands that can be turned into nft ones
+COMMANDS = (
+    "-A",
+    "--append",
+    "-I",
+    "--insert",
+    "-D",
+    "--delete",
+    "-R",
+    "--replace",
+    "-F",
+    "--flush",
+    "-N",
+    "--new-chain",
+    "-X",
+    "--delete-chain",
+    "-P",
+    "--policy",
+)
+
+# Options of the targets supported, in the order iptables -S prints them
+TARGET_OPTIONS = (
+    "--reject-with",
+    "--log-prefix",
+    "--log-level",
+    "--to-ports",
+    "--to-source",
+    "--to-destination",
+)
+
+
+class NftablesException(Exception):
+    pass
+
+
+class NftRule(object):
+    """One rule, in the part of iptables nftables can do natively
+
+    Parsed from an iptables rule spec or from a rule in `nft -j` output, and
+    formatted as either, so the rest of multirouter keeps working on
+    iptables specs whatever a host runs. Anything outside that part raises
+    NftablesException instead of being dropped.
+    """
+
+    def __init__(self):
+        # (negated, value) pairs, None when not matched
+        self.src = None
+        self.dst = None
+        self.iface = None
+        self.oface = None
+        self.proto = None
+        # (negated, [(lo, hi)], multiport)
+        self.sports = None
+        self.dports = None
+        # (negated, type, code or None)
+        self.icmp = None
+        # (negated, [state]), states in upper case
+        self.states = None
+        # (rate, iptables unit, burst)
+        self.limit = None
+        self.comment = None
+        # (-j or -g, target, {option: value})
+        self.target = None
+
+    def spec(self):
+        """Formats the rule like `iptables -S` does
+
+        Returns:
+            str: Rule spec
+        """
+        tokens = []
+        for flag, value in (
+            ("-s", self.src),
+            ("-d", self.dst),
+            ("-i", self.iface),
+            ("-o", self.oface),
+            ("-p", self.proto),
+        ):
+            if value is not None:
+                tokens += negated(value[0]) + [flag, value[1]]
+        single = [
+            (f, p)
+            for f, p in (("--sport", self.sports), ("--dport", self.dports))
+            if p is not None and not p[2]
+        ]
+        if len(single) != 0:
+            tokens += ["-m", self.proto[1]]
+            for flag, (neg, ports, _) in single:
+                tokens += negated(neg) + [flag, port_list(ports, ":")]
+        if self.icmp is not None:
+            neg, kind, code = self.icmp
+            tokens += ["-m", "icmp"] + negated(neg)
+            tokens += ["--icmp-type", str(kind) if code is None else f"{kind}/{code}"]
+        multi = [
+            (f, p)
+            for f, p in (("--sports", self.sports), ("--dports", self.dports))
+            if p is not None and p[2]
+        ]
+        if len(multi) != 0:
+            tokens += ["-m", "multiport"]
+            for flag, (neg, ports, _) in multi:
+                tokens += negated(neg) + [flag, port_list(ports, ":")]
+        if self.states is not None:
+            tokens += ["-m", "conntrack"] + negated(self.states[0])
+            tokens += ["--ctstate", ",".join(self.states[1])]
+        if self.limit is not None:
+            rate, unit, burst = self.limit
+            tokens += ["-m", "limit", "--limit", f"{rate}/{unit}"]
+            if burst != 5:
+                tokens += ["--limit-burst", str(burst)]
+        if self.comment is not None:
+            tokens += ["-m", "comment", "--comment", self.comment]
+        if self.target is not None:
+            flag, name, options = self.target
+            tokens += [flag, name]
+            for option in TARGET_OPTIONS:
+                if option in options:
+                    tokens += [option, options[option]]
+        return join(tokens)
+
+    def statements(self, counters=None):
+        """Formats the rule as nft statements
+
+        Args:
+            counters ((int, int), optional): (packets, bytes) to start the counter at. Defaults to None.
+
+        Returns:
+            str: Statements, as they follow `add rule family table chain`
+        """
+        out = []
+        for field, value in (("ip saddr", self.src), ("ip daddr", self.dst)):
+            if value is not None:
+                out.append(f"{field} {'!= ' if value[0] else ''}{value[1]}")
+        for field, value in (("iifname", self.iface), ("oifname", self.oface)):
+            if value is not None:
+                name = value[1][:-1] + "*" if value[1].endswith("+") else value[1]
+                out.append(f'{field} {"!= " if value[0] else ""}"{name}"')
+        if self.proto is not None:
+            out.append(f"meta l4proto {'!= ' if self.proto[0] else ''}{self.proto[1]}")
+        for field, value in (("sport", self.sports), ("dport", self.dports)):
+            if value is None:
+                continue
+            if (
+                self.proto is None
+                or self.proto[0]
+                or self.proto[1] not in ("tcp", "udp", "sctp")
+            ):
+                raise NftablesException("Ports need -p tcp, udp or sctp")
+            neg, ports, multi = value
+            ports = port_list(ports, "-")
+            out.append(
+                f"{self.proto[1]} {field} {'!= ' if neg else ''}"
+                + (f"{{ {ports.replace(',', ', ')} }}" if multi else ports)
+            )
+        if self.icmp is not None:
+            neg, kind, code = self.icmp
+            if neg and code is not None:
+                raise NftablesException(
+                    "Negated ICMP type/code matches aren't supported"
+                )
+            out.append(f"icmp type {'!= ' if neg else ''}{kind}")
+            if code is not None:
+                out.append(f"icmp code {code}")
+        if self.states is not None:
+            neg, states = self.states
+            if neg and len(states) != 1:
+                raise NftablesException(
+                    "Negated matches on several conntrack states aren't supported"
+                )
+            states = [s.lower() for s in states]
+            if len(states) == 1:
+                out.append(f"ct state {'!= ' if neg else ''}{states[0]}")
+            else:
+                out.append(f"ct state {{ {', '.join(states)} }}")
+        if self.limit is not None:
+            rate, unit, burst = self.limit
+            out.append(f"limit rate {rate}/{LIMIT_UNITS[unit]} burst {burst} packets")
+        out.append(
+            "counter"
+            if counters is None
+            else f"counter packets {counters[0]} bytes {counters[1]}"
+        )
+        if self.target is not None:
+            out.append(verdict(self.target))
+        if self.comment is not None:
+            out.append(f'comment "{self.comment}"')
+        return " ".join(out)
+
+
+def negated(neg):
+    return ["!"] if neg else []
+
+
+def parse_spec(spec):
+    """Parses an iptables rule spec
+
+    Args:
+        spec (str): Everything after `-A chain`
+
+    Returns:
+        NftRule: Rule
+    """
+    try:
+        tokens = shlex.split(spec)
+    except ValueError as e:
+        raise NftablesException(f"Can't parse `{spec}`: {e}")
+    r = NftRule()
+    module = None
+    neg = False
+    i = 0
+    while i < len(tokens):
+        flag = tokens[i]
+        if flag == "!":
+            neg = True
+            i += 1
+            continue
+        if flag in ("-j", "--jump", "-g", "--goto"):
+            r.target = parse_target(flag, tokens[i + 1 :], spec)
+            break
+        if i + 1 >= len(tokens):
+            raise NftablesException(f"{flag} needs a value in `{spec}`")
+        value = tokens[i + 1]
+        if flag in ("-s", "--source", "-d", "--destination"):
+            addr = (neg, address(value))
+            if flag in ("-s", "--source"):
+                r.src = addr
+            else:
+                r.dst = addr
+        elif flag in ("-i", "--in-interface"):
+            r.iface = (neg, value)
+        elif flag in ("-o", "--out-interface"):
+            r.oface = (neg, value)
+        elif flag in ("-p", "--protocol"):
+            if value.lower() != "all":
+                r.proto = (neg, value.lower())
+        elif flag in ("-m", "--match"):
+            if value not in MODULES:
+                raise NftablesException(
+                    f"-m {value} isn't supported on nftables hosts (in `{spec}`)"
+                )
+            module = value
+        elif implicit(r, module, flag):
+            # -p tcp loads the tcp match, so --dport needs no -m tcp
+            module = r.proto[1]
+            continue
+        elif module is None or flag not in MODULES[module]:
+            raise NftablesException(
+                f"{flag} isn't supported on nftables hosts (in `{spec}`)"
+            )
+        elif flag in ("--sport", "--source-port", "--sports", "--source-ports"):
+            r.sports = (neg, parse_ports(value, spec), module == "multiport")
+        elif flag in (
+            "--dport",
+            "--destination-port",
+            "--dports",
+            "--destination-ports",
+        ):
+            r.dports = (neg, parse_ports(value, spec), module == "multiport")
+        elif flag == "--ports":
+            raise NftablesException(
+                f"multiport --ports isn't supported on nftables hosts (in `{spec}`)"
+            )
+        elif flag in ("--ctstate", "--state"):
+            r.states = (neg, parse_states(value.upper().split(",")))
+        elif flag == "--icmp-type":
+            kind, _, code = value.partition("/")
+            r.icmp = (neg, icmp_type(kind, spec), int(code) if code != "" else None)
+        elif flag == "--limit":
+            rate, _, unit = value.partition("/")
+            unit = {
+                "s": "sec",
+                "second": "sec",
+                "m": "min",
+                "minute": "min",
+                "h": "hour",
+                "d": "day",
+            }.get(unit, unit)
+            if unit not in LIMIT_UNITS or not rate.isdigit() or neg:
+                raise NftablesException(f"Can't use --limit {value} (in `{spec}`)")
+            burst = r.limit[2] if r.limit is not None else 5
+            r.limit = (int(rate), unit, burst)
+        elif flag == "--limit-burst":
+            rate, unit, _ = r.limit if r.limit is not None else (3, "hour", 5)
+            r.limit = (rate, unit, int(value))
+        elif flag == "--comment":
+            if '"' in value:
+                raise NftablesException(
+                    f"Comments with double quotes aren't supported (in `{spec}`)"
+                )
+            r.comment = value
+        neg = False
+        i += 2
+    if neg:
+        raise NftablesException(f"Dangling ! in `{spec}`")
+    return r
+
+
+def implicit(r, module, flag):
+    if r.proto is None or r.proto[1] not in MODULES:
+        return False
+    if module is not None and flag in MODULES[module]:
+        return False
+    return flag in MODULES[r.proto[1]]
+
+
+def parse_target(flag, tokens, spec):
+    if len(tokens) == 0:
+        raise NftablesException(f"{flag} needs a target in `{spec}`")
+    name = tokens[0]
+    flag = "-g" if flag in ("-g", "--goto") else "-j"
+    options = {}
+    args = tokens[1:]
+    if len(args) % 2 != 0:
+        raise NftablesException(f"Can't parse the target options in `{spec}`")
+    for option, value in zip(args[::2], args[1::2]):
+        options[option] = value
+    allowed = {
+        "REJECT": ("--reject-with",),
+        "LOG": ("--log-prefix", "--log-level"),
+        "MASQUERADE": ("--to-ports",),
+        "SNAT": ("--to-source",),
+        "DNAT": ("--to-destination",),
+    }
+    for option in options:
+        if option not in allowed.get(name, ()):
+            raise NftablesException(
+                f"{option} isn't supported on nftables hosts (in `{spec}`)"
+            )
+    if name == "REJECT":
+        reject = options.setdefault("--reject-with", "icmp-port-unreachable")
+        if reject != "tcp-reset" and reject not in REJECT_TYPES:
+            raise NftablesException(
+                f"--reject-with {reject} isn't supported on nftables hosts"
+            )
+    if name == "LOG" and "--log-level" in options:
+        level = options["--log-level"]
+        if level in LOG_LEVELS:
+            level = str(LOG_LEVELS.index(level))
+        if not level.isdigit() or int(level) >= len(LOG_LEVELS):
+            raise NftablesException(f"Bad --log-level {level} in `{spec}`")
+        # iptables leaves the default level out
+        if level == "4":
+            del options["--log-level"]
+        else:
+            options["--log-level"] = level
+    if name in ("SNAT", "DNAT") and len(options) == 0:
+        raise NftablesException(f"{name} needs an address in `{spec}`")
+    return (flag, name, options)
+
+
+def verdict(target):
+    flag, name, options = target
+    if flag == "-g":
+        return f"goto {name}"
+    if name in ("ACCEPT", "DROP", "RETURN"):
+        return name.lower()
+    if name == "REJECT":
+        reject = options["--reject-with"]
+        if reject == "tcp-reset":
+            return "reject with tcp reset"
+        if reject == "icmp-port-unreachable":
+            return "reject"
+        return f"reject with icmp type {REJECT_TYPES[reject]}"
+    if name == "LOG":
+        out = "log"
+        if "--log-prefix" in options:
+            out += f' prefix "{options["--log-prefix"]}"'
+        if "--log-level" in options:
+            out += f" level {LOG_LEVELS[int(options['--log-level'])]}"
+        return out
+    if name == "MASQUERADE":
+        ports = options.get("--to-ports")
+        return "masquerade" if ports is None else f"masquerade to :{ports}"
+    if name == "SNAT":
+        return f"snat to {options['--to-source']}"
+    if name == "DNAT":
+        return f"dnat to {options['--to-destination']}"
+    return f"jump {name}"
+
+
+def address(value):
+    try:
+        net = ipaddress.IPv4Network(value, strict=False)
+    except ValueError:
+        raise NftablesException(f"{value} isn't an IPv4 address or network")
+    return str(net) if net.prefixlen != 32 else f"{net.network_address}/32"
+
+
+def parse_ports(value, spec):
+    ports = []
+    for part in value.split(","):
+        lo, sep, hi = part.partition(":")
+        try:
+            lo = int(lo) if lo != "" else 0
+            hi = int(hi) if hi != "" else (lo if sep == "" else 65535)
+        except ValueError:
+            raise NftablesException(f"Bad port {part} in `{spec}`")
+        ports.append((lo, hi))
+    return ports
+
+
+def parse_states(states):
+    for s in states:
+        if s not in STATES:
+            raise NftablesException(
+                f"Conntrack state {s} isn't supported on nftables hosts"
+            )
+    return [s for s in STATES if s in states]
+
+
+def port_list(ports, sep):
+    return ",".join(str(lo) if lo == hi else f"{lo}{sep}{hi}" for lo, hi in ports)
+
+
+def icmp_type(kind, spec):
+    if kind.isdigit():
+        return int(kind)
+    if kind not in ICMP_TYPES:
+        raise NftablesException(
+            f"ICMP type {kind} isn't supported on nftables hosts (in `{spec}`)"
+        )
+    return ICMP_TYPES[kind]
+
+
+def from_json(rule):
+    """Parses one rule from `nft -j` output
+
+    Args:
+        rule (dict): The rule's object
+
+    Returns:
+        (NftRule, int, int): Rule, and its packet and byte counters (None without a counter)
+    """
+    r = NftRule()
+    r.comment = rule.get("comment")
+    packets = None
+    bytes = None
+    for expr in rule.get("expr", []):
+        if len(expr) != 1:
+            raise NftablesException(f"Can't read {json.dumps(expr)}")
+        key, value = next(iter(expr.items()))
+        if r.target is not None and key not in ("counter", "limit", "match"):
+            # iptables has one target per rule, e.g. no log and drop
+            raise NftablesException(
+                f"Rules with {key} after another action aren't supported"
+            )
+        if key == "match":
+            json_match(r, value)
+        elif key == "counter":
+            value = value or {}
+            packets = value.get("packets", 0)
+            bytes = value.get("bytes", 0)
+        elif key in ("accept", "drop", "return"):
+            r.target = ("-j", key.upper(), {})
+        elif key in ("jump", "goto"):
+            r.target = ("-j" if key == "jump" else "-g", value["target"], {})
+        elif key == "reject":
+            r.target = ("-j", "REJECT", {"--reject-with": json_reject(value)})
+        elif key == "log":
+            options = {}
+            value = value or {}
+            if "prefix" in value:
+                options["--log-prefix"] = value["prefix"]
+            level = value.get("level", "warn")
+            if level not in LOG_LEVELS:
+                raise NftablesException(f"log level {level} isn't supported")
+            if level != "warn":
+                options["--log-level"] = str(LOG_LEVELS.index(level))
+            r.target = ("-j", "LOG", options)
+        elif key == "masquerade":
+            options = {}
+            if value is not None and "port" in value:
+                options["--to-ports"] = json_port(value["port"], "-")
+            r.target = ("-j", "MASQUERADE", options)
+        elif key in ("snat", "dnat"):
+            to = str(value["addr"])
+            if "port" in value:
+                to += ":" + json_port(value["port"], "-")
+            option = "--to-source" if key == "snat" else "--to-destination"
+            r.target = ("-j", key.upper(), {option: to})
+        elif key == "limit":
+            if value.get("rate_unit", "packets") != "packets" or value.get(
+                "inv", False
+            ):
+                raise NftablesException("Only packet rate limits are supported")
+            units = {v: k for k, v in LIMIT_UNITS.items()}
+            r.limit = (
+                value["rate"],
+                units[value.get("per", "second")],
+                value.get("burst", 5),
+            )
+        elif key == "xt":
+            # iptables-nft keeps extensions nft has no expression for this way
+            name = (value or {}).get("name", "?")
+            raise NftablesException(
+                f"iptables extension {name} can't be read through nft; set firewall iptables for this host"
+            )
+        else:
+            raise NftablesException(f"nft {key} statements aren't supported")
+    return (r, packets, bytes)
+
+
+def json_match(r, m):
+    op = m.get("op", "==")
+    if op not in ("==", "!=", "in"):
+        raise NftablesException(f"nft {op} matches aren't supported")
+    neg = op == "!="
+    left = m["left"]
+    right = m["right"]
+    if "payload" in left:
+        protocol = left["payload"].get("protocol")
+        field = left["payload"].get("field")
+        if protocol == "ip" and field in ("saddr", "daddr"):
+            value = (neg, json_address(right))
+            if field == "saddr":
+                r.src = value
+            else:
+                r.dst = value
+            return
+        if protocol == "ip" and field == "protocol":
+            r.proto = (neg, json_protocol(right))
+            return
+        if protocol in ("tcp", "udp", "sctp") and field in ("sport", "dport"):
+            if r.proto is None:
+                r.proto = (False, protocol)
+            multi = (
+                isinstance(right, dict) and "set" in right or isinstance(right, list)
+            )
+            value = (neg, json_ports(right), multi)
+            if field == "sport":
+                r.sports = value
+            else:
+                r.dports = value
+            return
+        if protocol == "icmp" and field in ("type", "code"):
+            if r.proto is None:
+                r.proto = (False, "icmp")
+            if field == "type":
+                kind = right if isinstance(right, int) else ICMP_TYPES.get(right)
+                if kind is None:
+                    raise NftablesException(f"ICMP type {right} isn't supported")
+                r.icmp = (neg, kind, r.icmp[2] if r.icmp is not None else None)
+            else:
+                if r.icmp is None:
+                    raise NftablesException("ICMP code matches need a type first")
+                r.icmp = (r.icmp[0] or neg, r.icmp[1], int(right))
+            return
+    if "meta" in left:
+        key = left["meta"].get("key")
+        if key == "l4proto":
+            r.proto = (neg, json_protocol(right))
+            return
+        if key in ("iifname", "oifname"):
+            if not isinstance(right, str):
+                raise NftablesException(f"{key} sets aren't supported")
+            name = right[:-1] + "+" if right.endswith("*") else right
+            if key == "iifname":
+                r.iface = (neg, name)
+            else:
+                r.oface = (neg, name)
+            return
+    if "ct" in left and left["ct"].get("key") == "state":
+        states = right
+        if isinstance(states, dict) and "set" in states:
+            states = states["set"]
+        if isinstance(states, str):
+            states = [states]
+        r.states = (neg, parse_states([s.upper() for s in states]))
+        return
+    raise NftablesException(f"Can't read the match on {json.dumps(left)}")
+
+
+def json_address(right):
+    if isinstance(right, str):
+        return address(right)
+    if isinstance(right, dict) and "prefix" in right:
+        return address(f"{right['prefix']['addr']}/{right['prefix']['len']}")
+    raise NftablesException(f"Can't read address {json.dumps(right)}")
+
+
+def json_protocol(right):
+    if isinstance(right, int):
+        return PROTOCOLS.get(right, str(right))
+    if isinstance(right, str):
+        return right
+    raise NftablesException(f"Can't read protocol {json.dumps(right)}")
+
+
+def json_ports(right):
+    if isinstance(right, dict) and "set" in right:
+        right = right["set"]
+    if not isinstance(right, list):
+        right = [right]
+    ports = []
+    for p in right:
+        if isinstance(p, int):
+            ports.append((p, p))
+        elif isinstance(p, dict) and "range" in p:
+            ports.append((int(p["range"][0]), int(p["range"][1])))
+        else:
+            raise NftablesException(f"Can't read port {json.dumps(p)}")
+    return ports
+
+
+def json_port(value, sep):
+    if isinstance(value, dict) and "range" in value:
+        return f"{value['range'][0]}{sep}{value['range'][1]}"
+    return str(value)
+
+
+def json_reject(value):
+    if value is None:
+        return "icmp-port-unreachable"
+    kind = value.get("type")
+    if kind == "tcp reset":
+        return "tcp-reset"
+    expr = value.get("expr", "port-unreachable")
+    for option, name in REJECT_TYPES.items():
+        if name == expr:
+            return option
+    raise NftablesException(f"reject with {expr} isn't supported")
+
+
+def parse_ruleset(data, names):
+    """Parses `nft -j list ruleset` output into iptables style tables
+
+    Args:
+        data (dict): Parsed JSON
+        names ([str]): Tables to read; other tables, and other families, are ignored
+
+    Returns:
+        {str: Table}: Tables by name, with rule handles and counters
+    """
+    tables = {}
+    for item in data.get("nftables", []):
+        if len(item) != 1:
+            continue
+        kind, obj = next(iter(item.items()))
+        if not isinstance(obj, dict) or obj.get("family") != FAMILY:
+            continue
+        name = obj.get("name") if kind == "table" else obj.get("table")
+        if name not in names:
+            continue
+        if kind == "table":
+            tables[name] = Table(name)
+        elif kind == "chain":
+            table = tables.setdefault(name, Table(name))
+            policy = None
+            if "hook" in obj:
+                base = BASE_CHAINS.get(name, {}).get(obj["name"].upper())
+                if base is None or base[1] != obj["hook"]:
+                    raise NftablesException(
+                        f"Chain {obj['name']} in {FAMILY} {name} hooks {obj['hook']}, which iptables can't name"
+                    )
+                policy = obj.get("policy", "accept").upper()
+            table.add_chain(obj["name"], policy)
+        elif kind == "rule":
+            table = tables.setdefault(name, Table(name))
+            r, packets, bytes = from_json(obj)
+            table.add_rule(
+                Rule(obj["chain"], r.spec(), packets, bytes, obj.get("handle"))
+            )
+        else:
+            # Sets, maps and the like would be lost when the table is rewritten
+            raise NftablesException(
+                f"{FAMILY} {name} has an nft {kind}, which isn't supported"
+            )
+    return tables
+
+
+def restore_script(tables, counters=False):
+    """Builds an `nft -f` transaction that replaces whole tables
+
+    Each table is created if it's missing, deleted and rebuilt, so the
+    change is atomic like iptables-restore and leaves other tables alone.
+
+    Args:
+        tables ({str: Table}): Tables to write
+        counters (bool, optional): Keep the rules' counters. Defaults to False.
+
+    Returns:
+        str: Script
+    """
+    lines = []
+    for name, table in tables.items():
+        lines += [
+            f"add table {FAMILY} {name}",
+            f"delete table {FAMILY} {name}",
+            f"add table {FAMILY} {name}",
+        ]
+        for chain in table.chains:
+            lines.append(chain_line(table, chain))
+        for r in table.all_rules():
+            c = (r.packets or 0, r.bytes or 0) if counters else None
+            lines.append(
+                f"add rule {FAMILY} {name} {r.chain} {parse_spec(r.spec).statements(c)}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def chain_line(table, chain, policy=None):
+    base = BASE_CHAINS.get(table.name, {}).get(chain.upper())
+    if policy is None:
+        policy = table.policies.get(chain)
+    if base is None:
+        if policy is not None:
+            raise NftablesException(f"{chain} isn't a built in chain of {table.name}")
+        return f"add chain {FAMILY} {table.name} {chain}"
+    kind, hook, priority = base
+    policy = (policy or "ACCEPT").lower()
+    return (
+        f"add chain {FAMILY} {table.name} {chain} "
+        f"{{ type {kind} hook {hook} priority {priority}; policy {policy}; }}"
+    )
+
+
+def command_script(tables, arg):
+    """Turns an `iptables` command into nft commands against the live rules
+
+    Rules are found by position or spec in the tables as fetched, and
+    changed by their handles.
+
+    Args:
+        tables ({str: Table}): Live tables, from parse_ruleset
+        arg (str): iptables arguments
+
+    Returns:
+        str: Script for `nft -f`
+    """
+    try:
+        args = shlex.split(arg)
+    except ValueError as e:
+        raise NftablesException(f"Can't parse `{arg}`: {e}")
+    name = "filter"
+    rest = []
+    i = 0
+    while i < len(args):
+        if args[i] in ("-t", "--table") and i + 1 < len(args):
+            name = args[i + 1]
+            i += 2
+        elif args[i] in ("-w", "--wait"):
+            i += 2 if i + 1 < len(args) and args[i + 1].isdigit() else 1
+        else:
+            rest.append(args[i])
+            i += 1
+    if len(rest) == 0:
+        raise NftablesException("No command specified")
+    op = rest[0]
+    if op not in COMMANDS:
+        raise NftablesException(f"iptables {op} isn't supported on nftables hosts")
+    chain = rest[1] if len(rest) > 1 else None
+    table = tables.get(name, Table(name))
+    prefix = f"{FAMILY} {name}"
+    if op in ("-N", "--new-chain") and chain is not None:
+        return f"add chain {prefix} {chain}\n"
+    if op in ("-F", "--flush") and chain is None:
+        return f"flush table {prefix}\n"
+    if op in ("-X", "--delete-chain") and chain is None:
+        base = BASE_CHAINS.get(name, {})
+        chains = [c for c in table.chains if c.upper() not in base]
+        return "".join(f"delete chain {prefix} {c}\n" for c in chains)
+    if chain is None or chain not in table.rules:
+        raise NftablesException(f"No chain {chain} in {name}")
+    rules = table.rules[chain]
+    if op in ("-A", "--append"):
+        return f"add rule {prefix} {chain} {parse_spec(join(rest[2:])).statements()}\n"
+    if op in ("-I", "--insert"):
+        position = 1
+        spec = rest[2:]
+        if len(spec) != 0 and spec[0].isdigit():
+            position = int(spec[0])
+            spec = spec[1:]
+        statements = parse_spec(join(spec)).statements()
+        if position == len(rules) + 1:
+            return f"add rule {prefix} {chain} {statements}\n"
+        if position < 1 or position > len(rules):
+            raise NftablesException("Index of insertion too big")
+        return f"insert rule {prefix} {chain} position {rules[position - 1].handle} {statements}\n"
+    if op in ("-D", "--delete"):
+        r = find_rule(rules, chain, rest[2:])
+        return f"delete rule {prefix} {chain} handle {r.handle}\n"
+    if op in ("-R", "--replace") and len(rest) > 2 and rest[2].isdigit():
+        r = find_rule(rules, chain, rest[2:3])
+        statements = parse_spec(join(rest[3:])).statements()
+        return f"replace rule {prefix} {chain} handle {r.handle} {statements}\n"
+    if op in ("-F", "--flush"):
+        return f"flush chain {prefix} {chain}\n"
+    if op in ("-X", "--delete-chain"):
+        return f"delete chain {prefix} {chain}\n"
+    if op in ("-P", "--policy") and len(rest) == 3:
+        return chain_line(table, chain, rest[2].upper()) + "\n"
+    raise NftablesException(f"Can't parse `iptables {arg}`")
+
+
+def find_rule(rules, chain, args):
+    # A rule by its position, or the first one with the same spec
+    if len(args) == 1 and args[0].isdigit():
+        n = int(args[0])
+        if n < 1 or n > len(rules):
+            raise NftablesException("Index of deletion too big")
+        return rules[n - 1]
+    wanted = Rule(chain, parse_spec(join(args)).spec())
+    for r in rules:
+        if r == wanted:
+            return r
+    raise NftablesException("Bad rule (does a matching rule exist in that chain?)")
+
+
+class NftablesBackend(FirewallBackend):
+    """Hosts managed with nft, reading JSON and writing whole transactions
+
+    Rules are still shown, saved, diffed and loaded as iptables rule specs.
+    Only the FAMILY tables named in the tables setting are touched.
+    """
+
+    name = "nftables"
+    delta = False
+
+    def list_command(self, tables, verbose):
+        # -a adds each rule's handle; counters show either way
+        return "&&".join(
+            [
+                f'printf "\\n{Fore.YELLOW + table + Style.RESET_ALL}\\n" && nft{" -a" if verbose else ""} list table {FAMILY} {table}'
+                for table in tables
+            ]
+        )
+
+    def save_command(self, tables):
+        return self.fetch_command(tables)
+
+    def parse_saves(self, lines, tables):
+        parsed = self.parse_fetch(lines, tables)
+        text = ""
+        # Tables the host doesn't have are left out, so loading the save
+        # doesn't create them
+        for name in tables:
+            if name in parsed:
+                text += f"\n{name}\n" + "".join(
+                    [f"{line}\n" for line in parsed[name].to_lines()]
+                )
+        return text
+
+    def fetch_command(self, tables):
+        return "nft -j list ruleset"
+
+    def parse_fetch(self, lines, tables):
+        try:
+            data = json.loads("".join(lines))
+        except ValueError as e:
+            raise NftablesException(f"Can't parse nft output: {e}")
+        return parse_ruleset(data, tables)
+
+    def restore_command(self, delta=False, counters=False):
+        return "nft -f -"
+
+    def restore_payload(self, payload, delta=False, counters=False):
+        if delta:
+            raise NftablesException("nftables hosts don't take delta restores")
+        return restore_script(parse_save(payload.split("\n")), counters)
+
+    def iptables_command(self, arg):
+        return "nft -f -"
+
+    def backup_command(self, tables):
+        return "nft list ruleset"
+
+    def backup(self, lines):
+        # The whole ruleset, so rules nft can't show as iptables come back too
+        return "flush ruleset\n" + "".join([f"{line}\n" for line in lines])
+
+    def backup_restore_command(self):
+        return "nft -f -"
+
+    def save_to(self, path):
+        return f"{{ echo flush ruleset && nft list ruleset; }} > {path}"
+
+    def restore_from(self, path):
+        return f"nft -f {path}"
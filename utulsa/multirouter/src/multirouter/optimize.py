@@ -0,0 +1,285 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+from .analyze import RuleMatch, mask
+from .ruleset import Table
+
+# Seconds of traffic counted before reordering (0 uses the counters as is)
+OPTIMIZE_WINDOW = 10.0
+
+# Matches that keep state each time they're evaluated, so rules using them
+# never move and nothing is moved past them
+STATEFUL = {
+    "recent",
+    "limit",
+    "hashlimit",
+    "statistic",
+    "quota",
+    "connlimit",
+    "connbytes",
+    "nth",
+}
+
+# Conntrack states a packet has exactly one of. Others (DNAT, SNAT) are
+# set alongside these, so they never prove two rules disjoint
+EXCLUSIVE_STATES = {"NEW", "ESTABLISHED", "RELATED", "INVALID", "UNTRACKED"}
+
+
+class ChainOrder(object):
+    """A chain's hot-first reordering and what it saves"""
+
+    def __init__(self, table, chain, rules, order, weights):
+        """Initializes ChainOrder
+
+        Args:
+            table (str): Table name
+            chain (str): Chain name
+            rules ([Rule]): Rules in their current order
+            order ([int]): New order, as indices into rules
+            weights ([float]): Hits (or hits per second) of each rule
+        """
+        self.table = table
+        self.chain = chain
+        self.rules = [rules[i] for i in order]
+        self.moved = sum(1 for n, i in enumerate(order) if n != i)
+        self.before = depth(weights)
+        self.after = depth([weights[i] for i in order])
+
+    def line(self):
+        return (
+            f"{self.table} {self.chain}: {self.moved} rules moved, "
+            f"average depth {self.before:.1f} -> {self.after:.1f}"
+        )
+
+    def record(self):
+        return {
+            "table": self.table,
+            "chain": self.chain,
+            "moved": self.moved,
+            "before": round(self.before, 3),
+            "after": round(self.after, 3),
+        }
+
+
+def reorder(rules, weights):
+    """Moves hot rules up a chain without changing what it does
+
+    An insertion sort by weight that only ever swaps two adjacent rules
+    when they commute (see commute), so every step, and the result, treats
+    every packet the same way as the original chain.
+
+    Args:
+        rules ([Rule]): Rules in order
+        weights ([float]): Hits of each rule
+
+    Returns:
+        [int]: New order, as indices into rules
+    """
+    fields = [Fields(RuleMatch(r, position)) for position, r in enumerate(rules, 1)]
+    order = list(range(len(rules)))
+    for i in range(1, len(order)):
+        current = order[i]
+        w = weights[current]
+        if w == 0 or fields[current].stateful:
+            continue
+        j = i
+        while j > 0:
+            above = order[j - 1]
+            if weights[above] >= w or fields[above].stateful:
+                break
+            if not commute(fields[above], fields[current]):
+                break
+            order[j] = above
+            j -= 1
+        order[j] = current
+    return order
+
+
+class Fields(object):
+    """What commute compares of a rule, worked out once per rule"""
+
+    __slots__ = (
+        "target",
+        "stateful",
+        "proto",
+        "src",
+        "dst",
+        "sports",
+        "dports",
+        "iface",
+        "oface",
+        "states",
+    )
+
+    def __init__(self, m):
+        """Initializes Fields
+
+        Args:
+            m (RuleMatch): Parsed rule
+        """
+        self.target = m.target if m.terminal else None
+        self.stateful = any(
+            c.split()[1] in STATEFUL for c in m.extras if c.startswith("-m ")
+        )
+        self.proto = m.proto
+        self.src = net_fields(m.src)
+        self.dst = net_fields(m.dst)
+        self.sports = port_fields(m.sports)
+        self.dports = port_fields(m.dports)
+        self.iface = clause(m, "-i")
+        self.oface = clause(m, "-o")
+        states = clause(m, "--ctstate") or clause(m, "--state")
+        self.states = frozenset(states.split(",")) if states is not None else None
+
+
+def commute(a, b):
+    """Checks whether two adjacent rules can swap places
+
+    They can if no packet matches both, or if both end the chain with the
+    same target, so a packet matching both gets the same verdict either way.
+    Rules with stateful matches (see STATEFUL) never move.
+
+    Args:
+        a (Fields): Rule
+        b (Fields): Rule
+
+    Returns:
+        bool: Whether swapping them keeps the chain's behaviour
+    """
+    if a.target is not None and a.target == b.target:
+        return True
+    return disjoint(a, b)
+
+
+def disjoint(a, b):
+    """Checks whether no packet can match both rules
+
+    Only matches understood well enough to tell are compared; anything else
+    is assumed to overlap.
+
+    Args:
+        a (Fields): Rule
+        b (Fields): Rule
+
+    Returns:
+        bool: Whether the rules are provably disjoint
+    """
+    if a.proto is not None and b.proto is not None and a.proto != b.proto:
+        return True
+    if nets_disjoint(a.src, b.src) or nets_disjoint(a.dst, b.dst):
+        return True
+    if ports_disjoint(a.dports, b.dports) or ports_disjoint(a.sports, b.sports):
+        return True
+    if interfaces_disjoint(a.iface, b.iface) or interfaces_disjoint(a.oface, b.oface):
+        return True
+    return states_disjoint(a.states, b.states)
+
+
+def net_fields(net):
+    # (network, mask), or None for a hostname, which could be anything
+    network, length = net
+    if length == 33:
+        return None
+    return (network, mask(length))
+
+
+def port_fields(ports):
+    # Negated port lists (no upper bound) could be anything
+    if ports is None or any(hi is None for _, hi in ports):
+        return None
+    return ports
+
+
+def nets_disjoint(a, b):
+    if a is None or b is None:
+        return False
+    # Two prefixes overlap exactly when they agree under the shorter mask
+    return (a[0] ^ b[0]) & a[1] & b[1] != 0
+
+
+def states_disjoint(a, b):
+    if a is None or b is None:
+        return False
+    if not (a <= EXCLUSIVE_STATES and b <= EXCLUSIVE_STATES):
+        return False
+    return a.isdisjoint(b)
+
+
+def ports_disjoint(a, b):
+    if a is None or b is None:
+        return False
+    return not any(alo <= hi and lo <= ahi for alo, ahi in a for lo, hi in b)
+
+
+def interfaces_disjoint(a, b):
+    # iptables interface names ending in + match any name with that prefix
+    if a is None or b is None:
+        return False
+    if a.endswith("+") or b.endswith("+"):
+        x = a.rstrip("+") if a.endswith("+") else a
+        y = b.rstrip("+") if b.endswith("+") else b
+        return not x.startswith(y) and not y.startswith(x)
+    return a != b
+
+
+def clause(m, flag):
+    # Value of a plain (not negated) option kept in the rule's extras
+    for c in m.extras:
+        args = c.split()
+        if len(args) == 2 and args[0] == flag:
+            return args[1]
+    return None
+
+
+def depth(weights):
+    """Average position in the chain of the rule each hit matched
+
+    Args:
+        weights ([float]): Hits of each rule, in chain order
+
+    Returns:
+        float: Weighted mean position, from 1 (0 if nothing was hit)
+    """
+    total = sum(weights)
+    if total == 0:
+        return 0.0
+    return sum(w * n for n, w in enumerate(weights, 1)) / total
+
+
+def optimize_tables(tables, names, weights):
+    """Reorders every chain of the given tables hot rules first
+
+    Args:
+        tables ({str: Table}): Tables from a host
+        names ([str]): Tables to reorder
+        weights ({int: float}): Hits of each rule, by id() of the Rule
+
+    Returns:
+        ([ChainOrder], {str: Table}): Chains that changed, and the reordered tables
+    """
+    changes = []
+    optimized = {}
+    for name in names:
+        if name not in tables:
+            continue
+        t = tables[name]
+        o = Table(name)
+        for chain in t.chains:
+            o.add_chain(chain, t.policies.get(chain))
+            rules = t.rules[chain]
+            w = [weights.get(id(r), 0.0) for r in rules]
+            order = reorder(rules, w)
+            change = ChainOrder(name, chain, rules, order, w)
+            if change.moved != 0:
+                changes.append(change)
+            for r in change.rules:
+                o.add_rule(r)
+        optimized[name] = o
+    return (changes, optimized)
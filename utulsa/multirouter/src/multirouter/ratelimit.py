@@ -0,0 +1,111 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+import random
+import threading
+import time
+
+# New SSH connections per second (0 for no limit until hosts push back)
+CONNECT_RATE = 0
+# Tries per connection before giving up on a host
+CONNECT_ATTEMPTS = 4
+# Seconds before the first retry of a failed connection, doubling each retry
+BACKOFF = 1.0
+BACKOFF_MAX = 30.0
+# Rate an unlimited limiter is treated as having when hosts start refusing
+# connections, and the lowest any limiter drops to
+FALLBACK_RATE = 20.0
+MIN_RATE = 1.0
+
+
+class ConnectLimiter(object):
+    """Paces new SSH connections and backs off when hosts push back
+
+    Connections are spaced 1/rate seconds apart. Each failed connection
+    (refused, reset, timed out) halves the current rate, at most once a
+    second, and each success adds one connection per second back, up to
+    the configured rate. With no configured rate connections aren't paced
+    until the first failure, which starts pacing at half FALLBACK_RATE, and
+    pacing stops again once the rate has recovered to FALLBACK_RATE. So a
+    burst that trips fail2ban or sshd's MaxStartups slows down quickly and
+    speeds back up gradually.
+    """
+
+    def __init__(self, rate=CONNECT_RATE, attempts=CONNECT_ATTEMPTS, backoff=BACKOFF):
+        """Initializes ConnectLimiter
+
+        Args:
+            rate (float, optional): Connections per second, 0 for no limit. Defaults to CONNECT_RATE.
+            attempts (int, optional): Tries per connection. Defaults to CONNECT_ATTEMPTS.
+            backoff (float, optional): Seconds before the first retry. Defaults to BACKOFF.
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.random = random.Random()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.current = float(rate) if rate > 0 else None
+            self.next = 0.0
+            self.last_cut = 0.0
+
+    def reserve(self):
+        """Claims the next connection slot
+
+        Returns:
+            float: Seconds to wait before connecting
+        """
+        with self.lock:
+            if self.current is None:
+                return 0.0
+            now = time.time()
+            start = max(now, self.next)
+            self.next = start + 1.0 / self.current
+            return start - now
+
+    def success(self):
+        with self.lock:
+            if self.current is None:
+                return
+            self.current += 1.0
+            if self.rate > 0:
+                self.current = min(self.current, float(self.rate))
+            elif self.current >= FALLBACK_RATE:
+                self.current = None
+
+    def failure(self):
+        with self.lock:
+            now = time.time()
+            if now - self.last_cut < 1.0:
+                return
+            self.last_cut = now
+            current = FALLBACK_RATE if self.current is None else self.current
+            self.current = max(MIN_RATE, current / 2)
+
+    def delay(self, attempt):
+        """Seconds to wait before retrying, with jitter so retries spread out
+
+        Args:
+            attempt (int): Retry number, from 1
+
+        Returns:
+            float: Seconds
+        """
+        d = min(BACKOFF_MAX, self.backoff * 2 ** (attempt - 1))
+        return d * self.random.uniform(0.5, 1.0)
+
+    def __str__(self):
+        rate = f"{self.rate}/s" if self.rate > 0 else "unlimited"
+        if self.current is not None and self.current != self.rate:
+            rate += f" (backed off to {self.current:g}/s)"
+        return f"{rate}, {self.attempts} attempts, backoff {self.backoff}s"
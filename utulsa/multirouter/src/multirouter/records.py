@@ -0,0 +1,134 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+import json
+import sys
+import threading
+
+from .ssh_handler import HostTimeout
+
+FORMATS = ("text", "json", "ndjson")
+
+
+class RecordWriter(object):
+    """Writes one JSON record per host as soon as it's ready
+
+    ndjson writes one compact record per line. json writes a single array,
+    opened before the first record and closed by close(), so it is still
+    written a record at a time.
+    """
+
+    def __init__(self, fmt, out=None):
+        """Initializes RecordWriter
+
+        Args:
+            fmt (str): "json" or "ndjson"
+            out (file, optional): Where to write. Defaults to sys.stdout.
+        """
+        self.fmt = fmt
+        self.out = out if out is not None else sys.stdout
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        """Writes a record
+
+        Args:
+            record (dict): Record
+        """
+        with self.lock:
+            if self.fmt == "ndjson":
+                self.out.write(json.dumps(record) + "\n")
+            else:
+                self.out.write("[\n" if self.count == 0 else ",\n")
+                self.out.write(json.dumps(record, indent=1))
+            self.count += 1
+            self.out.flush()
+
+    def close(self):
+        with self.lock:
+            if self.fmt == "json":
+                self.out.write("[]\n" if self.count == 0 else "\n]\n")
+                self.out.flush()
+
+
+def host_record(host_out, stdout, stderr, duration):
+    """Builds a host's record from its output
+
+    Args:
+        host_out (HostOutput): Finished output
+        stdout ([str]): Its stdout lines
+        stderr ([str]): Its stderr lines
+        duration (float): Seconds from sending the command to it finishing
+
+    Returns:
+        dict: Record
+    """
+    exception = host_out.exception
+    return {
+        "host": host_out.host,
+        "exit_code": host_out.exit_code,
+        "stdout": stdout,
+        "stderr": stderr,
+        "duration": round(duration, 3),
+        "error": repr(exception) if exception is not None else None,
+        "timed_out": isinstance(exception, HostTimeout),
+    }
+
+
+def tables_record(tables, names=None):
+    """Converts parsed tables to plain dicts
+
+    Args:
+        tables ({str: Table}): Tables by name
+        names ([str], optional): Only these tables, in this order. Defaults to all.
+
+    Returns:
+        {str: dict}: table -> {"chains": {chain: {"policy": str, "rules": [dict]}}}
+    """
+    if names is None:
+        names = list(tables.keys())
+    out = {}
+    for name in names:
+        if name not in tables:
+            continue
+        t = tables[name]
+        out[name] = {
+            "chains": {
+                chain: {
+                    "policy": t.policies.get(chain),
+                    "rules": [
+                        {"spec": r.spec, "packets": r.packets, "bytes": r.bytes}
+                        for r in t.rules[chain]
+                    ],
+                }
+                for chain in t.chains
+            }
+        }
+    return out
+
+
+def diff_record(d):
+    """Converts a ChainDiff to a plain dict
+
+    Args:
+        d (ChainDiff): Chain diff
+
+    Returns:
+        dict: Record
+    """
+    return {
+        "table": d.table,
+        "chain": d.chain,
+        "status": d.status,
+        "policy": list(d.policy) if d.policy is not None else None,
+        "added": [r.spec for r in d.added],
+        "removed": [r.spec for r in d.removed],
+    }
@@ -0,0 +1,152 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+import concurrent.futures
+import socket
+
+# Seconds a health probe gets per host
+PROBE_TIMEOUT = 10
+
+
+class RolloutException(Exception):
+    pass
+
+
+class RolloutPlan(object):
+    """How a change is rolled out: canary first, then batches"""
+
+    def __init__(
+        self,
+        canary=1,
+        batch_size=10,
+        concurrency=10,
+        probe="ssh",
+        probe_timeout=PROBE_TIMEOUT,
+    ):
+        """Initializes RolloutPlan
+
+        Args:
+            canary (int, optional): Hosts in the first batch. Defaults to 1.
+            batch_size (int, optional): Hosts per batch after the canary. Defaults to 10.
+            concurrency (int, optional): Hosts changed at once within a batch. Defaults to 10.
+            probe (str, optional): "ssh", "port:N" or "none". Defaults to "ssh".
+            probe_timeout (float, optional): Seconds per probe. Defaults to PROBE_TIMEOUT.
+        """
+        self.canary = canary
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.probe = probe
+        self.probe_timeout = probe_timeout
+
+    def copy(self):
+        return RolloutPlan(
+            self.canary,
+            self.batch_size,
+            self.concurrency,
+            self.probe,
+            self.probe_timeout,
+        )
+
+    def set(self, name, value):
+        """Changes a setting from its text form
+
+        Args:
+            name (str): canary, batch, concurrency, probe or probe_timeout
+            value (str): New value
+        """
+        if name == "probe":
+            parse_probe(value)
+            self.probe = value
+            return
+        attrs = {
+            "canary": ("canary", int, 0),
+            "batch": ("batch_size", int, 1),
+            "concurrency": ("concurrency", int, 1),
+            "probe_timeout": ("probe_timeout", float, 0),
+        }
+        if name not in attrs:
+            raise RolloutException(f"Unknown rollout setting {name}")
+        attr, kind, low = attrs[name]
+        try:
+            v = kind(value)
+        except ValueError:
+            raise RolloutException(f"{name} must be a number")
+        if v < low:
+            raise RolloutException(f"{name} must be at least {low}")
+        setattr(self, attr, v)
+
+    def batches(self, hosts):
+        """Splits hosts into the canary batch and the batches after it
+
+        Args:
+            hosts ([str]): Hosts in rollout order
+
+        Returns:
+            [[str]]: Batches
+        """
+        batches = []
+        rest = list(hosts)
+        if self.canary > 0:
+            batches.append(rest[: self.canary])
+            rest = rest[self.canary :]
+        for i in range(0, len(rest), self.batch_size):
+            batches.append(rest[i : i + self.batch_size])
+        return [b for b in batches if len(b) != 0]
+
+    def __str__(self):
+        return (
+            f"canary {self.canary}, batch {self.batch_size}, concurrency "
+            f"{self.concurrency}, probe {self.probe} ({self.probe_timeout}s)"
+        )
+
+
+def parse_probe(probe):
+    """Parses a probe setting
+
+    Args:
+        probe (str): "ssh", "port:N" or "none"
+
+    Returns:
+        (str, int): Probe kind and port (None unless a port probe)
+    """
+    if probe in ("ssh", "none"):
+        return (probe, None)
+    if probe.startswith("port:"):
+        try:
+            port = int(probe[len("port:") :])
+            if 0 < port < 65536:
+                return ("port", port)
+        except ValueError:
+            pass
+    raise RolloutException("Probe must be ssh, port:N or none")
+
+
+def probe_ports(hosts, port, timeout, concurrency):
+    """Checks a TCP port accepts connections on each host
+
+    Args:
+        hosts ([str]): Hosts
+        port (int): Port
+        timeout (float): Seconds per connection
+        concurrency (int): Connections at once
+
+    Returns:
+        {str: Exception}: Error for each host that failed
+    """
+
+    def check(host):
+        try:
+            socket.create_connection((host, port), timeout=timeout).close()
+        except OSError as e:
+            return e
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(check, hosts))
+    return {h: e for h, e in zip(hosts, results) if e is not None}
@@ -0,0 +1,314 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+import time
+
+
+class Rule(object):
+    """A single rule in a chain
+
+    Rules compare equal on chain and spec only, so counters don't make an
+    otherwise identical rule look changed.
+    """
+
+    def __init__(self, chain, spec, packets=None, bytes=None, handle=None):
+        """Initializes Rule
+
+        Args:
+            chain (str): Chain the rule is appended to
+            spec (str): Everything after `-A chain`
+            packets (int, optional): Packet counter. Defaults to None.
+            bytes (int, optional): Byte counter. Defaults to None.
+            handle (int, optional): nftables rule handle, on nftables hosts. Defaults to None.
+        """
+        self.chain = chain
+        self.spec = " ".join(spec.split())
+        self.packets = packets
+        self.bytes = bytes
+        self.handle = handle
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Rule)
+            and self.chain == other.chain
+            and self.spec == other.spec
+        )
+
+    def __hash__(self):
+        return hash((self.chain, self.spec))
+
+    def __str__(self):
+        return f"-A {self.chain} {self.spec}"
+
+    def __repr__(self):
+        return f"Rule({self.chain!r}, {self.spec!r})"
+
+
+class Table(object):
+    """Chains, policies and rules of one table"""
+
+    def __init__(self, name):
+        """Initializes Table
+
+        Args:
+            name (str): Table name (filter, nat, ...)
+        """
+        self.name = name
+        self.chains = []
+        self.policies = {}
+        self.rules = {}
+
+    def add_chain(self, chain, policy=None):
+        """Adds a chain if it isn't already there
+
+        Args:
+            chain (str): Chain name
+            policy (str, optional): Policy for built in chains. Defaults to None.
+        """
+        if chain not in self.rules:
+            self.chains.append(chain)
+            self.rules[chain] = []
+        if policy is not None and policy != "-":
+            self.policies[chain] = policy
+
+    def add_rule(self, rule):
+        """Appends a rule to its chain
+
+        Args:
+            rule (Rule): Rule to append
+        """
+        self.add_chain(rule.chain)
+        self.rules[rule.chain].append(rule)
+
+    def all_rules(self):
+        """Gets every rule in chain order
+
+        Returns:
+            [Rule]: Rules
+        """
+        return [r for chain in self.chains for r in self.rules[chain]]
+
+    def to_lines(self):
+        """Formats the table like `iptables -S`
+
+        Returns:
+            [str]: Lines
+        """
+        lines = []
+        for chain in self.chains:
+            if chain in self.policies:
+                lines.append(f"-P {chain} {self.policies[chain]}")
+            else:
+                lines.append(f"-N {chain}")
+        lines += [str(r) for r in self.all_rules()]
+        return lines
+
+
+class Ruleset(object):
+    """Every table fetched from a host at one point in time"""
+
+    def __init__(self, host, tables=None, fetched=None):
+        """Initializes Ruleset
+
+        Args:
+            host (str): Host name
+            tables ({str: Table}, optional): Tables by name. Defaults to None.
+            fetched (float, optional): Time fetched. Defaults to now.
+        """
+        self.host = host
+        self.tables = tables if tables is not None else {}
+        self.fetched = fetched if fetched is not None else time.time()
+
+    def changes(self, old):
+        """Gets the rules added and removed since an older ruleset
+
+        Args:
+            old (Ruleset): Older ruleset for the same host
+
+        Returns:
+            ([(str, Rule)], [(str, Rule)]): (table, rule) pairs added and removed
+        """
+        added = []
+        removed = []
+        names = list(self.tables.keys())
+        names += [t for t in old.tables.keys() if t not in self.tables]
+        for name in names:
+            new_rules = self.tables[name].all_rules() if name in self.tables else []
+            old_rules = old.tables[name].all_rules() if name in old.tables else []
+            added += [(name, r) for r in subtract(new_rules, old_rules)]
+            removed += [(name, r) for r in subtract(old_rules, new_rules)]
+        return (added, removed)
+
+
+class RuleCache(object):
+    """Per host cache of fetched rulesets"""
+
+    def __init__(self, ttl=0):
+        """Initializes RuleCache
+
+        Args:
+            ttl (float, optional): Seconds a fetched ruleset stays fresh. Defaults to 0.
+        """
+        self.ttl = ttl
+        self.rulesets = {}
+        self.previous = {}
+
+    def __getitem__(self, host):
+        return self.rulesets[host]
+
+    def __contains__(self, host):
+        return host in self.rulesets
+
+    def update(self, ruleset):
+        """Stores a newly fetched ruleset, keeping the last one for diffs
+
+        Args:
+            ruleset (Ruleset): Fetched ruleset
+        """
+        if ruleset.host in self.rulesets:
+            self.previous[ruleset.host] = self.rulesets[ruleset.host]
+        self.rulesets[ruleset.host] = ruleset
+
+    def stale(self, hosts):
+        """Filters hosts down to the ones that need fetching
+
+        Args:
+            hosts ([str]): Host names
+
+        Returns:
+            [str]: Hosts without a fresh ruleset
+        """
+        now = time.time()
+        return [
+            h
+            for h in hosts
+            if h not in self.rulesets or now - self.rulesets[h].fetched >= self.ttl
+        ]
+
+    def invalidate(self, hosts=None):
+        """Marks hosts as needing a fetch (all if hosts not given)
+
+        The rulesets are kept so the next fetch can still be diffed.
+
+        Args:
+            hosts ([str], optional): Host names. Defaults to None.
+        """
+        if hosts is None:
+            hosts = list(self.rulesets.keys())
+        for h in hosts:
+            if h in self.rulesets:
+                self.rulesets[h].fetched = 0
+
+    def remove(self, hosts):
+        """Forgets hosts entirely
+
+        Args:
+            hosts ([str]): Host names
+        """
+        for h in hosts:
+            self.rulesets.pop(h, None)
+            self.previous.pop(h, None)
+
+
+def parse_save(lines):
+    """Parses `iptables-save` (optionally with -c) output
+
+    Args:
+        lines ([str]): Output lines
+
+    Returns:
+        {str: Table}: Tables by name
+    """
+    tables = {}
+    table = None
+    for line in lines:
+        line = line.strip()
+        if line == "" or line.startswith("#") or line == "COMMIT":
+            continue
+        if line.startswith("*"):
+            table = Table(line[1:])
+            tables[table.name] = table
+            continue
+        if table is None:
+            continue
+        packets = None
+        bytes = None
+        if line.startswith("["):
+            counters, line = line.split("]", 1)
+            packets, bytes = _counters(counters[1:])
+            line = line.strip()
+        if line.startswith(":"):
+            args = line[1:].split()
+            table.add_chain(args[0], args[1] if len(args) > 1 else None)
+        elif line.startswith("-A "):
+            args = line[3:].split(" ", 1)
+            spec = args[1] if len(args) > 1 else ""
+            table.add_rule(Rule(args[0], spec, packets, bytes))
+    return tables
+
+
+def parse_rules(name, lines):
+    """Parses `iptables -S` output for one table
+
+    Args:
+        name (str): Table name
+        lines ([str]): Output lines
+
+    Returns:
+        Table: Parsed table
+    """
+    table = Table(name)
+    for line in lines:
+        args = line.split()
+        if len(args) < 2:
+            continue
+        if args[0] == "-P":
+            table.add_chain(args[1], args[2])
+        elif args[0] == "-N":
+            table.add_chain(args[1])
+        elif args[0] == "-A":
+            packets = None
+            bytes = None
+            # iptables -S -v appends the counters as `-c packets bytes`
+            if len(args) > 4 and args[-3] == "-c":
+                packets, bytes = int(args[-2]), int(args[-1])
+                args = args[:-3]
+            table.add_rule(Rule(args[1], " ".join(args[2:]), packets, bytes))
+    return table
+
+
+def _counters(s):
+    packets, bytes = s.split(":")
+    return (int(packets), int(bytes))
+
+
+def subtract(a, b):
+    """Multiset difference of two rule lists, keeping a's order
+
+    Rules are hashed, so this is linear in len(a) + len(b). Duplicates count,
+    so two copies of a rule minus one copy leaves one.
+
+    Args:
+        a ([Rule]): Rules to keep
+        b ([Rule]): Rules to take away
+
+    Returns:
+        [Rule]: Rules in a not matched by one in b
+    """
+    counts = {}
+    for r in b:
+        counts[r] = counts.get(r, 0) + 1
+    out = []
+    for r in a:
+        if counts.get(r, 0) > 0:
+            counts[r] -= 1
+        else:
+            out.append(r)
+    return out
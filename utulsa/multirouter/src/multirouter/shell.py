@@ -18,6 +18,14 @@ else:
     import readline
 
 from .ssh_handler import SSHManager
+from .backend import FIREWALLS
+from .ipsets import BLOCKLIST, IPSetException
+from .metrics import MetricsException
+from .monitor import WATCH_INTERVAL, WATCH_TOP
+from .optimize import OPTIMIZE_WINDOW
+from .records import FORMATS
+from .rollout import RolloutException
+from .snapshot import SnapshotException
 from .host import *
 
 
@@ -27,11 +35,84 @@ class MultirouterShell(cmd.Cmd):
     intro = "Welcome to Multirouter, the tool designed to configure multiple IPTables routers via SSH.\n"
     prompt = "> "
 
-    def __init__(self, iptables_manager):
+    def __init__(self, iptables_manager, batch=False):
         self.iptables_manager = iptables_manager
+        self.jobs = {}
+        self.handles = []
+        self.next_job = 1
+        # Batch mode runs a script instead of prompting, and can pipeline
+        # background commands on either backend
+        self.batch = batch
+        self.errors = 0
 
         super().__init__()
 
+    def onecmd(self, line):
+        line = line.strip()
+        if line.endswith("&"):
+            self.start_job(line[:-1].strip())
+            return
+        try:
+            return super().onecmd(line)
+        finally:
+            self.iptables_manager.report_timings(" ".join(parse(line)[:1]))
+
+    def start_job(self, line):
+        ssh_manager = self.iptables_manager.ssh_manager
+        if not ssh_manager.concurrent and not self.batch:
+            print("Background commands need the asyncio backend (--backend asyncio)")
+            return
+        refused = (
+            (("exit",), ("EOF",)) if self.batch else (("watch",), ("exit",), ("EOF",))
+        )
+        args = parse(line)
+        # Batch mode answers confirmations itself, but a prompt in an
+        # interactive job would race the prompt for the next line typed
+        if args[:1] in refused or (not self.batch and prompts(args)):
+            print("That command can't run in the background")
+            self.errors += 1
+            return
+        job = self.next_job
+        self.next_job += 1
+        self.jobs[job] = line
+        print(f"[{job}] {line}")
+        context = (ssh_manager.hosts, ssh_manager.context_changed)
+        self.handles.append(ssh_manager.spawn(self.run_job, job, line, context))
+
+    def run_job(self, job, line, context):
+        try:
+            self.iptables_manager.ssh_manager.pin_context(*context)
+            super().onecmd(line)
+            self.iptables_manager.report_timings(" ".join(parse(line)[:1]))
+        finally:
+            self.jobs.pop(job, None)
+            print(f"\n[{job}] Done\t{line}")
+
+    def wait_jobs(self):
+        while len(self.handles) != 0:
+            self.handles.pop(0).join()
+
+    def run_script(self, lines):
+        """Runs commands from a script, as if typed at the prompt
+
+        Lines ending in & run in the background alongside the following
+        lines, until a `wait` or the end of the script.
+
+        Args:
+            lines ([str]): Script lines (blank lines and # comments are skipped)
+        """
+        for line in lines:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            print(f"{self.prompt}{line}")
+            self.onecmd(line)
+        self.wait_jobs()
+
+    def default(self, line):
+        self.errors += 1
+        super().default(line)
+
     def emptyline(self):
         return
 
@@ -61,7 +142,7 @@ class MultirouterShell(cmd.Cmd):
 
         add hostname, username, password, port (default: 22), sshkey (if applicable)\tAdd host
         remove host1, host2, ...\t\tRemove list of hosts
-        remove host_index1, host_index2, ...\tRemove list of hosts by indices
+        remove host_id1, host_id2, ...\tRemove list of hosts by IDs
         """
         args = parse(arg)
         if len(args) == 0:
@@ -139,25 +220,212 @@ class MultirouterShell(cmd.Cmd):
         list 127.0.0.1
         list all
         list -v
+        list --changed
 
         Args:
 
-        -v\tVerbose
+        -v\t\tVerbose
+        --changed\tOnly show rules added or removed since the last fetch
+
+        Rules are served from the cache while younger than the ttl setting.
         """
         args = parse(arg)
         verbose = "-v" in args
-        if verbose:
-            args = list(filter(lambda a: a != "-v", args))
+        changed = "--changed" in args
+        args = list(filter(lambda a: a not in ("-v", "--changed"), args))
         if len(args) == 0 or "all" in args or "a" in args:
-            self.iptables_manager.list_rules(verbose)
+            self.iptables_manager.list_rules(verbose, changed)
         else:
             status, args = validate_args(args)
             if status == 0:
                 print("Args invalid")
             elif status == 1:
-                self.iptables_manager.list_rules_hosts(args, verbose)
+                self.iptables_manager.list_rules_hosts(args, verbose, changed)
             else:
-                self.iptables_manager.list_rules_indices(args, verbose)
+                self.iptables_manager.list_rules_indices(args, verbose, changed)
+
+    def do_analyze(self, arg):
+        """Finds duplicate, shadowed and mergeable rules in the current context (all if context not set)
+
+        Examples:
+        analyze
+        analyze 0 1
+        analyze 127.0.0.1
+        analyze --plan
+        analyze --apply
+
+        Args:
+
+        --plan\t\tShow each host's cleanup as an iptables-restore payload
+        --apply\tPush the cleanup (asks first)
+
+        Only rules that can never match are removed, and only adjacent rules
+        with the same target are merged, so the chains behave the same.
+        """
+        args = parse(arg)
+        plan = "--plan" in args
+        apply = "--apply" in args
+        args = [a for a in args if a not in ("--plan", "--apply")]
+        selected = select_hosts(
+            args,
+            self.iptables_manager.ssh_manager.hosts,
+            self.iptables_manager.host_map,
+        )
+        if selected is None:
+            print("Args invalid")
+            return
+        self.iptables_manager.analyze(selected, plan, apply)
+
+    def do_consolidate(self, arg):
+        """Moves runs of rules that differ only in one address or port into ipsets, in the current context (all if context not set)
+
+        Examples:
+        consolidate
+        consolidate 0 1
+        consolidate --plan
+        consolidate --apply
+
+        Args:
+
+        --plan\t\tShow each host's ipset and iptables-restore payloads
+        --apply\tPush the change (asks first)
+
+        Runs of at least 8 adjacent rules with the same target become one
+        rule matching a set, so the chain checks one hash instead of each rule.
+        """
+        args = parse(arg)
+        plan = "--plan" in args
+        apply = "--apply" in args
+        args = [a for a in args if a not in ("--plan", "--apply")]
+        selected = select_hosts(
+            args,
+            self.iptables_manager.ssh_manager.hosts,
+            self.iptables_manager.host_map,
+        )
+        if selected is None:
+            print("Args invalid")
+            return
+        self.iptables_manager.consolidate(selected, plan, apply)
+
+    def do_optimize(self, arg):
+        """Moves the busiest rules towards the top of their chains, in the current context (all if context not set)
+
+        Examples:
+        optimize
+        optimize 0 1
+        optimize -w 30
+        optimize -w 0 --plan
+        optimize --apply
+
+        Args:
+
+        -w seconds\tCount hits for this long first (default 10, 0 uses the counters as they are)
+        --plan\t\tShow each host's new order as an iptables-restore payload
+        --apply\tPush the new order (asks first)
+
+        Rules only move past rules that can't match the same packets (or
+        that end the chain the same way), and rules with stateful matches
+        like recent or limit never move, so the chains behave the same.
+        """
+        args = list(parse(arg))
+        plan = "--plan" in args
+        apply = "--apply" in args
+        args = [a for a in args if a not in ("--plan", "--apply")]
+        window = OPTIMIZE_WINDOW
+        try:
+            if "-w" in args:
+                i = args.index("-w")
+                window = float(args[i + 1])
+                del args[i : i + 2]
+        except (ValueError, IndexError):
+            print("Args invalid")
+            return
+        selected = select_hosts(
+            args,
+            self.iptables_manager.ssh_manager.hosts,
+            self.iptables_manager.host_map,
+        )
+        if selected is None or window < 0:
+            print("Args invalid")
+            return
+        self.iptables_manager.optimize(selected, window, plan, apply)
+
+    def do_block(self, arg):
+        """Blocks addresses on every host in the current context (all if context not set)
+
+        Usage:
+        block add ip1, ip2, ...\tDrop traffic from addresses or networks
+        block remove ip1, ip2, ...\tStop dropping them
+        block list\t\t\tShow the blocklist on each host
+
+        Only the mr-block ipset changes, so blocking is one ipset restore per
+        host however long the list gets. The rules dropping the set in INPUT
+        and FORWARD are added the first time.
+        """
+        args = parse(arg)
+        if len(args) == 1 and args[0] == "list":
+            self.iptables_manager.run_command(f"ipset list {BLOCKLIST}", sudo=True)
+        elif len(args) > 1 and args[0] in ("add", "remove"):
+            try:
+                self.iptables_manager.block(args[0], args[1:])
+            except IPSetException as e:
+                print(e)
+        else:
+            print("Args invalid")
+
+    def do_watch(self, arg):
+        """Shows the busiest rules across the current context (all if context not set), refreshed in place
+
+        Examples:
+        watch
+        watch 5
+        watch 2 50
+        watch -b
+        watch -c 10
+
+        Usage:
+        watch [seconds] [top]\tPoll every seconds (default 2) and show the top busiest rules (default 20)
+
+        Args:
+
+        -b\t\tRank by bytes/s instead of packets/s
+        -c polls\tStop after this many polls (needed in batch mode)
+
+        Only counters are polled; rules are fetched again when they change.
+        Press Ctrl-C to stop.
+        """
+        args = list(parse(arg))
+        by_bytes = "-b" in args
+        args = [a for a in args if a != "-b"]
+        count = None
+        try:
+            if "-c" in args:
+                i = args.index("-c")
+                count = int(args[i + 1])
+                del args[i : i + 2]
+            interval = float(args[0]) if len(args) > 0 else WATCH_INTERVAL
+            top = int(args[1]) if len(args) > 1 else WATCH_TOP
+        except (ValueError, IndexError):
+            print("Args invalid")
+            return
+        if (
+            len(args) > 2
+            or interval <= 0
+            or top < 1
+            or (count is not None and count < 1)
+        ):
+            print("Args invalid")
+            return
+        if count is None and self.batch:
+            print("watch needs -c in batch mode")
+            self.errors += 1
+            return
+        try:
+            self.iptables_manager.watch(
+                self.iptables_manager.ssh_manager.hosts, interval, top, by_bytes, count
+            )
+        except KeyboardInterrupt:
+            print()
 
     def do_context(self, arg):
         """Manages the context (the current hosts being acted on by default)
@@ -167,9 +435,14 @@ class MultirouterShell(cmd.Cmd):
         Args:
 
         set host1, host2, ...\tSet context to list of hosts
-        set index1, index2, ...\tSet context to list of host indices
+        set id1, id2, ...\tSet context to list of host IDs (see `hosts`)
         set all\tSet context to all hosts
+        set term1, term2, ...\tSet context with a selection (e.g. group:dmz &tag:edge !10.0.0.5)
         reset\tUnsets the context
+
+        Selection terms are hosts, IDs, group:name, tag:name or all. Plain
+        terms add hosts, &term keeps only hosts also in term and !term drops
+        term's hosts.
         """
         args = parse(arg)
         if len(args) == 0:
@@ -182,7 +455,16 @@ class MultirouterShell(cmd.Cmd):
                 print("Args invalid")
         else:
             if args[0] == "set":
-                if "all" in args[1:]:
+                if is_selection(args[1:]):
+                    try:
+                        self.iptables_manager.change_context_select(args[1:])
+                        self.iptables_manager.print_context()
+                    except (
+                        HostMap.SelectionException,
+                        SSHManager.ContextException,
+                    ) as e:
+                        print(str(e))
+                elif "all" in args[1:]:
                     self.iptables_manager.change_context_hosts_all()
                     self.iptables_manager.print_context()
                 else:
@@ -208,7 +490,8 @@ class MultirouterShell(cmd.Cmd):
         """Runs iptables commands
 
         Usage if context not set:
-        iptables host1 (or index), host2 (or index), ... (iptables args)
+        iptables host1 (or ID), host2 (or ID), ... (iptables args)
+        iptables group:name tag:name ... (iptables args)
         iptables all (iptables args)
 
         Usage if context set:
@@ -227,6 +510,13 @@ class MultirouterShell(cmd.Cmd):
                 )
             elif len(args) == 0 or "all" in args:
                 self.iptables_manager.run_iptables(cmd, all_hosts=True)
+            elif is_selection(args):
+                try:
+                    hosts = self.iptables_manager.host_map.select(args)
+                except HostMap.SelectionException as e:
+                    print(str(e))
+                    return
+                self.iptables_manager.run_iptables(cmd, hosts=hosts)
             else:
                 status, args = validate_args(args)
                 if status == 0:
@@ -239,51 +529,310 @@ class MultirouterShell(cmd.Cmd):
             self.iptables_manager.run_iptables(arg)
 
     def do_save(self, arg):
-        """Saves rules in a directory
+        """Saves rules as a snapshot in the snapshot store
+
+        No argument saves with save_[timestamp]. You can specify the snapshot name.
 
-        No argument saves with save_[timestamp]. You can specify the directory name.
+        Args:
+
+        --dir\tSave to a directory with one plain text file per host instead
         """
         args = parse(arg)
+        to_dir = "--dir" in args
+        args = list(filter(lambda a: a != "--dir", args))
+        if len(args) > 1:
+            print("Too many args")
+            return
         if len(args) == 0:
             t = time.localtime()
-            timestamp = time.strftime("%b-%d-%Y_%H%M", t)
-            d = f"save_{timestamp}"
-            os.makedirs(d)
-            self.iptables_manager.save(d)
-        elif len(args) == 1:
-            d = args[0]
+            timestamp = time.strftime("%b-%d-%Y_%H%M%S", t)
+            name = f"save_{timestamp}"
+        else:
+            name = args[0]
+        if to_dir:
             try:
-                os.makedirs(d)
-                self.iptables_manager.save(d)
+                os.makedirs(name)
+                self.iptables_manager.save(name)
             except FileExistsError:
                 print("Directory already exists")
-        else:
-            print("Too many args")
+            return
+        try:
+            self.iptables_manager.save_snapshot(name)
+        except SnapshotException as e:
+            print(str(e))
 
     def do_load(self, arg):
-        """Loads the specified directory and applies the rules (if the hosts are connected to)"""
+        """Loads the specified snapshot (or save directory) and applies the rules (if the hosts are connected to)
+
+        Args:
+
+        --delta\tOnly push the rule inserts and deletes needed to reach the saved rules
+        """
         args = parse(arg)
+        delta = "--delta" in args
+        args = list(filter(lambda a: a != "--delta", args))
         if len(args) == 0:
-            print("Directory name required")
+            print("Snapshot or directory name required")
         elif len(args) == 1:
             d = args[0]
-            if os.path.exists(d):
-                fs = dict(
-                    map(
-                        lambda f: (f[:-4], os.path.join(d, f)),
-                        filter(lambda f: f.endswith(".txt"), os.listdir(d)),
-                    )
-                )
-                ans = input(
-                    "WARNING: this operation will reset the tables, but it will NOT change the default policies.\nMake sure you set your policies to accept traffic or you're in for a bad time.\nProceed? (yes/no) "
+            saves = None
+            if d in self.iptables_manager.store:
+                saves = self.iptables_manager.store.load(d)
+            elif os.path.isdir(d):
+                saves = self.iptables_manager.read_saves(d)
+            if saves is not None:
+                ans = self.iptables_manager.ask(
+                    "WARNING: this operation will reset the tables, but it will NOT change the default policies.\nMake sure you set your policies to accept traffic or you're in for a bad time.\nProceed? (yes/no) ",
+                    "yes",
                 )
                 while ans != "yes" and ans != "no":
                     print("Answer must be `yes` or `no`")
-                    input("Proceed? (yes/no) ")
+                    ans = self.iptables_manager.ask("Proceed? (yes/no) ", "yes")
                 if ans == "yes":
-                    self.iptables_manager.load(fs)
+                    self.iptables_manager.load(saves, delta)
                 elif ans == "no":
                     print("\nGood call\nSee you when you're ready.\n")
+            else:
+                print(f"No snapshot or directory named {d}")
+        else:
+            print("Args invalid")
+
+    def do_rollout(self, arg):
+        """Rolls a change out to the context a batch at a time (all hosts if context not set)
+
+        The canary batch goes first, then batches of the batch size. Each
+        batch is backed up, changed and health checked before the next; on
+        any failure the rollout halts and every changed host is restored.
+
+        Pass no arguments to show the rollout settings.
+
+        Usage:
+        rollout iptables (iptables args)\tRun an iptables command
+        rollout load name\t\t\tLoad a snapshot or save directory
+        rollout set canary count\t\tHosts in the canary batch (0 for none)
+        rollout set batch count\t\tHosts per batch after the canary
+        rollout set concurrency count\tHosts changed at once within a batch
+        rollout set probe ssh|port:N|none\tHealth check: new SSH login, TCP connect or nothing
+        rollout set probe_timeout seconds\tSeconds each probe gets
+        """
+        args = parse(arg)
+        plan = self.iptables_manager.rollout_plan
+        if len(args) == 0:
+            print(f"\nRollout: {plan}\n")
+        elif args[0] == "set" and len(args) == 3:
+            try:
+                plan.set(args[1], args[2])
+                print(f"\nRollout: {plan}\n")
+            except RolloutException as e:
+                print(str(e))
+        elif args[0] == "iptables" and len(args) > 1:
+            self.iptables_manager.rollout_iptables(" ".join(args[1:]))
+        elif args[0] == "load" and len(args) == 2:
+            saves = None
+            if args[1] in self.iptables_manager.store:
+                saves = self.iptables_manager.store.load(args[1])
+            elif os.path.isdir(args[1]):
+                saves = self.iptables_manager.read_saves(args[1])
+            if saves is None:
+                print(f"No snapshot or directory named {args[1]}")
+                return
+            self.iptables_manager.rollout_load(saves)
+        else:
+            print("Args invalid")
+
+    def do_diff(self, arg):
+        """Compares rulesets and shows the rules to add (+) and delete (-) per chain
+
+        Usage:
+        diff host1 host2\t\tCompare host1 against host2
+        diff host snapshot\t\tCompare host against its rules in a snapshot
+        diff host directory\t\tCompare host against its file in a save directory
+        diff host file\t\tCompare host against a saved ruleset file
+        diff all baseline\t\tCompare every host in context against a baseline (host, file, snapshot or directory)
+
+        Hosts can be given as addresses or host IDs.
+        """
+        args = parse(arg)
+        if len(args) != 2:
+            print("Args invalid")
+            return
+        hosts = self.iptables_manager.ssh_manager.hosts
+        host_map = self.iptables_manager.host_map
+        if args[0] in ("all", "a"):
+            selected = hosts
+        else:
+            selected = resolve_host(args[0], host_map)
+            if selected is None:
+                print("Args invalid")
+                return
+            selected = [selected]
+        baseline = args[1]
+        if not os.path.exists(baseline) and baseline not in self.iptables_manager.store:
+            baseline = resolve_host(baseline, host_map)
+            if baseline is None:
+                print(
+                    "Baseline must be a host, a save file, a snapshot or a save directory"
+                )
+                return
+        self.iptables_manager.diff(selected, baseline)
+
+    def do_snapshots(self, arg):
+        """Manages the snapshot store
+
+        Pass no arguments to list snapshots.
+
+        Args:
+
+        remove name1, name2, ...\tDelete snapshots
+        prune count\t\t\tDelete all but the newest count snapshots
+        """
+        args = parse(arg)
+        store = self.iptables_manager.store
+        if len(args) == 0:
+            self.iptables_manager.print_snapshots()
+        elif args[0] == "remove" and len(args) > 1:
+            missing = [n for n in args[1:] if n not in store]
+            if len(missing) != 0:
+                print(f"No snapshots named {', '.join(missing)}")
+                return
+            deleted = store.remove(args[1:])
+            print(f"\nRemoved {len(args) - 1} snapshots ({deleted} files freed)\n")
+        elif args[0] == "prune" and len(args) == 2:
+            try:
+                keep = int(args[1])
+            except ValueError:
+                print("Args invalid")
+                return
+            if keep < 0:
+                print("Args invalid")
+                return
+            removed, deleted = store.prune(keep)
+            print(f"\nRemoved {len(removed)} snapshots ({deleted} files freed)\n")
+        else:
+            print("Args invalid")
+
+    def do_jobs(self, arg):
+        """Lists commands running in the background
+
+        End a command with & to run it in the background (asyncio backend only,
+        or any backend in batch mode). A background command keeps the context
+        it was started with. Commands that ask for confirmation can only run
+        in the background in batch mode.
+        """
+        if len(self.jobs) == 0:
+            print("\nNo jobs\n")
+            return
+        print()
+        for job, line in sorted(self.jobs.items()):
+            print(f"[{job}] Running\t{line}")
+        print()
+
+    def do_wait(self, arg):
+        """Waits for every command running in the background to finish"""
+        self.wait_jobs()
+
+    def do_set(self, arg):
+        """Manages settings
+
+        Pass no arguments to show settings.
+
+        Args:
+
+        stream on|off\tPrint each host's lines as they arrive instead of waiting for every host
+        ttl seconds\tServe `list` from the rule cache while younger than this (0 disables)
+        timeout seconds\tCut off any host still running after this long (0 disables)
+        deadline seconds\tCut off every host still running this long after a command starts (0 disables)
+        sudo session|prompt\tValidate sudo once per session, or send the password with every sudo command
+        interactive on|off\tRun `cmd` on one long lived shell per host instead of a new channel each time
+        format text|json|ndjson\tPrint one JSON record per host instead of text
+        confirm seconds\tRevert `load` and `iptables` changes on any host not reconfirmed within this long (0 disables)
+        concurrency count\tWork on at most this many hosts at once
+        connect_rate count\tOpen at most this many SSH connections per second (0 for no limit)
+        connect_attempts count\tTries per connection before giving up on a host
+        backoff seconds\tWait before retrying a refused connection, doubling each retry
+        timings on|off\tPrint p50/p95/max seconds per phase across hosts after each command
+        metrics kind:path|off\tSend per host phase timings to prometheus:file or ndjson:file
+        firewall auto|iptables|nftables\tManage hosts with iptables or nft, or detect each host's (hosts with their own firewall in the load file keep it)
+
+        Hosts that are cut off show what they printed in time and are listed after the output.
+        """
+        args = parse(arg)
+        if len(args) == 0:
+            self.iptables_manager.print_settings()
+        elif len(args) == 2 and args[0] == "stream" and args[1] in ("on", "off"):
+            self.iptables_manager.stream = args[1] == "on"
+            self.iptables_manager.print_settings()
+        elif len(args) == 2 and args[0] == "format" and args[1] in FORMATS:
+            self.iptables_manager.format = args[1]
+            self.iptables_manager.print_settings()
+        elif len(args) == 2 and args[0] == "interactive" and args[1] in ("on", "off"):
+            self.iptables_manager.interactive = args[1] == "on"
+            self.iptables_manager.print_settings()
+        elif len(args) == 2 and args[0] == "ttl":
+            try:
+                self.iptables_manager.cache.ttl = max(0.0, float(args[1]))
+                self.iptables_manager.print_settings()
+            except ValueError:
+                print("Args invalid")
+        elif len(args) == 2 and args[0] == "sudo" and args[1] in ("session", "prompt"):
+            self.iptables_manager.ssh_manager.sudo_session = args[1] == "session"
+            self.iptables_manager.print_settings()
+        elif len(args) == 2 and args[0] in (
+            "concurrency",
+            "connect_rate",
+            "connect_attempts",
+            "backoff",
+        ):
+            ssh_manager = self.iptables_manager.ssh_manager
+            limiter = ssh_manager.sessions.limiter
+            try:
+                v = float(args[1])
+            except ValueError:
+                print("Args invalid")
+                return
+            if args[0] == "connect_rate" and v >= 0:
+                limiter.set_rate(v)
+            elif args[0] == "backoff" and v >= 0:
+                limiter.backoff = v
+            elif args[0] == "concurrency" and v >= 1:
+                ssh_manager.set_concurrency(int(v))
+            elif args[0] == "connect_attempts" and v >= 1:
+                limiter.attempts = int(v)
+            else:
+                print("Args invalid")
+                return
+            self.iptables_manager.print_settings()
+        elif len(args) == 2 and args[0] == "timings" and args[1] in ("on", "off"):
+            self.iptables_manager.show_timings = args[1] == "on"
+            self.iptables_manager.print_settings()
+        elif len(args) == 2 and args[0] == "metrics":
+            try:
+                spec = args[1] if args[1] != "off" else None
+                self.iptables_manager.set_metrics(spec)
+                self.iptables_manager.print_settings()
+            except (MetricsException, OSError) as e:
+                print(e)
+        elif len(args) == 2 and args[0] == "firewall" and args[1] in FIREWALLS:
+            self.iptables_manager.set_firewall(args[1])
+            self.iptables_manager.print_settings()
+        elif len(args) == 2 and args[0] == "confirm":
+            try:
+                t = int(args[1])
+                self.iptables_manager.confirm_timeout = t if t > 0 else None
+                self.iptables_manager.print_settings()
+            except ValueError:
+                print("Args invalid")
+        elif len(args) == 2 and args[0] in ("timeout", "deadline"):
+            try:
+                t = float(args[1])
+                t = t if t > 0 else None
+                if args[0] == "timeout":
+                    self.iptables_manager.host_timeout = t
+                else:
+                    self.iptables_manager.deadline = t
+                self.iptables_manager.print_settings()
+            except ValueError:
+                print("Args invalid")
         else:
             print("Args invalid")
 
@@ -314,5 +863,38 @@ def validate_args(args):
     return (status, args_out)
 
 
+def select_hosts(args, hosts, host_map):
+    # Hosts or host IDs, or every host in context
+    if len(args) == 0 or "all" in args or "a" in args:
+        return hosts
+    status, args = validate_args(args)
+    if status == 0:
+        return None
+    elif status == 1:
+        wanted = set(args)
+        return [h for h in hosts if h in wanted]
+    return host_map.hosts_by_ids(sorted(set(args)))
+
+
+def is_selection(args):
+    return any(":" in a or a[0] in "&!" for a in args)
+
+
+def resolve_host(arg, host_map):
+    status, args = validate_args([arg])
+    if status == 1:
+        return args[0]
+    elif status == 2 and args[0] in host_map.by_id:
+        return host_map.by_id[args[0]]
+    return None
+
+
+def prompts(args):
+    # Commands that ask for confirmation on stdin
+    if args[:1] in (("analyze",), ("consolidate",), ("optimize",)):
+        return "--apply" in args
+    return args[:1] == ("load",) or args[:2] == ("rollout", "load")
+
+
 def parse(arg):
-    return tuple(arg.split())
\ No newline at end of file
+    return tuple(arg.split())
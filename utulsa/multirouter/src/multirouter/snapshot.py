@@ -0,0 +1,179 @@
+##################################################################
+#
+#   Written by Tabor Kvasnicka
+#
+#   University of Tulsa
+#
+#   3/17/2021
+#
+##################################################################
+
+import gzip
+import hashlib
+import json
+import os
+import time
+
+# Default store location, relative to where multirouter is run
+SNAPSHOT_DIR = "snapshots"
+
+
+class SnapshotException(Exception):
+    pass
+
+
+class SnapshotStore(object):
+    """Content addressed store of saved rulesets
+
+    Each host's saved rules are stored once per distinct content, gzipped
+    under their SHA-256, and index.json maps snapshot -> host -> hash. Saving
+    a host whose rules haven't changed only adds an index entry.
+    """
+
+    def __init__(self, root=SNAPSHOT_DIR):
+        """Initializes SnapshotStore
+
+        Nothing is created on disk until the first snapshot is saved.
+
+        Args:
+            root (str, optional): Store directory. Defaults to SNAPSHOT_DIR.
+        """
+        self.root = root
+        self.index_path = os.path.join(root, "index.json")
+        self._index = None
+
+    def __contains__(self, name):
+        return name in self.index()
+
+    def index(self):
+        """Gets the snapshot index
+
+        Returns:
+            {str: dict}: Snapshot name -> {"created": float, "hosts": {host: hash}}
+        """
+        if self._index is None:
+            if os.path.exists(self.index_path):
+                with open(self.index_path, "r") as f:
+                    self._index = json.load(f)
+            else:
+                self._index = {}
+        return self._index
+
+    def save(self, name, rules):
+        """Stores a snapshot
+
+        Args:
+            name (str): Snapshot name
+            rules ({str: str}): Saved rules text per host
+
+        Returns:
+            int: Number of new blobs written (hosts with unseen rules)
+        """
+        if name in self:
+            raise SnapshotException(f"Snapshot {name} already exists")
+        written = 0
+        hosts = {}
+        for host, text in rules.items():
+            digest = hashlib.sha256(text.encode()).hexdigest()
+            path = self.blob_path(digest)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = path + ".tmp"
+                with gzip.open(tmp, "wt") as f:
+                    f.write(text)
+                os.replace(tmp, path)
+                written += 1
+            hosts[host] = digest
+        self.index()[name] = {"created": time.time(), "hosts": hosts}
+        self.write_index()
+        return written
+
+    def load(self, name, hosts=None):
+        """Reads a snapshot's rules
+
+        Args:
+            name (str): Snapshot name
+            hosts ([str], optional): Only read these hosts. Defaults to every host in the snapshot.
+
+        Returns:
+            {str: str}: Saved rules text per host
+        """
+        if name not in self:
+            raise SnapshotException(f"No snapshot named {name}")
+        entries = self.index()[name]["hosts"]
+        if hosts is None:
+            hosts = list(entries.keys())
+        rules = {}
+        for host in hosts:
+            if host not in entries:
+                continue
+            with gzip.open(self.blob_path(entries[host]), "rt") as f:
+                rules[host] = f.read()
+        return rules
+
+    def snapshots(self):
+        """Lists snapshots, oldest first
+
+        Returns:
+            [(str, float, int)]: (name, created, host count) for each snapshot
+        """
+        index = self.index()
+        return sorted(
+            [(n, s["created"], len(s["hosts"])) for n, s in index.items()],
+            key=lambda s: s[1],
+        )
+
+    def remove(self, names):
+        """Deletes snapshots and any blobs no other snapshot uses
+
+        Args:
+            names ([str]): Snapshot names
+
+        Returns:
+            int: Number of blobs deleted
+        """
+        index = self.index()
+        for name in names:
+            index.pop(name, None)
+        self.write_index()
+        return self.collect()
+
+    def prune(self, keep):
+        """Deletes all but the newest snapshots
+
+        Args:
+            keep (int): Number of snapshots to keep
+
+        Returns:
+            ([str], int): Snapshots removed and number of blobs deleted
+        """
+        names = [s[0] for s in self.snapshots()]
+        old = names[: max(0, len(names) - keep)]
+        return (old, self.remove(old))
+
+    def collect(self):
+        # Blobs are only ever referenced from the index, so anything it
+        # doesn't mention can go
+        used = set()
+        for s in self.index().values():
+            used.update(s["hosts"].values())
+        deleted = 0
+        objects = os.path.join(self.root, "objects")
+        if not os.path.isdir(objects):
+            return 0
+        for d in os.listdir(objects):
+            for f in os.listdir(os.path.join(objects, d)):
+                if f[: -len(".gz")] not in used:
+                    os.remove(os.path.join(objects, d, f))
+                    deleted += 1
+        return deleted
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], f"{digest}.gz")
+
+    def write_index(self):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.index(), f, indent=1, sort_keys=True)
+        os.replace(tmp, self.index_path)
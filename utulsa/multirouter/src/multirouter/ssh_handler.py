@@ -8,78 +8,864 @@
 #
 ##################################################################
 
-from pssh.clients import ParallelSSHClient
+from pssh.clients import SSHClient
 from pssh.config import HostConfig
+from pssh.exceptions import (
+    AuthenticationError,
+    ConnectionErrorException,
+    SessionError,
+    Timeout,
+)
+from pssh.output import HostOutput
 
+import bisect
+import contextlib
 import copy
+import time
+
+import gevent
+import gevent.event
+import gevent.local
+import gevent.lock
+import gevent.pool
+import gevent.queue
+
+from .ratelimit import ConnectLimiter
+
+# Seconds between keepalive packets on idle pooled sessions
+KEEPALIVE_SECONDS = 30
+POOL_SIZE = 100
+# Lines buffered between the per-host readers and the consumer when streaming
+STREAM_QUEUE_SIZE = 1024
+# Seconds before a session's sudo timestamp is revalidated (sudo's default
+# timestamp_timeout is 5 minutes)
+SUDO_REFRESH = 240
+# Primes sudo's timestamp for the connection with the password on stdin
+SUDO_VALIDATE = "sudo -S -p '' -v"
 
 
 class HostConfigException(Exception):
     pass
 
 
+class SudoException(Exception):
+    pass
+
+
+class ShellException(Exception):
+    pass
+
+
+class ProbeException(Exception):
+    pass
+
+
+class HostTimeout(Exception):
+    """Set as a host's exception when a deadline cut its command short"""
+
+    pass
+
+
+class FanoutOutput(list):
+    """Host outputs of one command fanned out to several hosts"""
+
+    def __init__(self, outputs=(), started=None, timings=None):
+        """Initializes FanoutOutput
+
+        Args:
+            outputs ([HostOutput], optional): Host outputs. Defaults to ().
+            started (float, optional): When the command was sent. Defaults to now.
+            timings (Timings, optional): Per host phase timings. Defaults to empty.
+        """
+        super().__init__(outputs)
+        self.started = started if started is not None else time.time()
+        self.timings = timings if timings is not None else Timings()
+
+
+class Timings(object):
+    """Seconds each host spent in each phase of one command
+
+    Phases are connect (TCP), auth (key exchange and login), sudo (sudo -v
+    in session mode), channel (opening the channel and sending the command),
+    exec (from then until the command's output ended) and collect (from then
+    until multirouter was done with the output). connect and auth only show
+    up when a host's session had to be opened.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.sent = {}
+        self.finished = {}
+
+    def add(self, host, phase, seconds):
+        phases = self.phases.setdefault(host, {})
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timed(self, host, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(host, phase, time.time() - start)
+
+    def start(self, host):
+        self.sent[host] = time.time()
+
+    def finish(self, host):
+        # Every path that notices a host is done can call this; the first wins
+        if host in self.sent and host not in self.finished:
+            self.finished[host] = time.time()
+            self.add(host, "exec", self.finished[host] - self.sent[host])
+
+    def collect(self, host):
+        if host in self.finished and "collect" not in self.phases.get(host, {}):
+            self.add(host, "collect", time.time() - self.finished[host])
+
+
+def sudo_command(command, session=False):
+    """Wraps a command to run as root
+
+    Without a sudo session the password is written to stdin, so `-k` makes
+    sudo always read it. Otherwise a cached timestamp would skip the prompt
+    and leave the password for the command itself to read.
+
+    Args:
+        command (str): Command to run
+        session (bool, optional): Whether sudo was already validated for the session. Defaults to False.
+
+    Returns:
+        str: Wrapped command
+    """
+    if session:
+        return f"sudo -n $SHELL -c '{command}'"
+    return f"sudo -S -k -p '' $SHELL -c '{command}'"
+
+
+def shell_frame(command, marker):
+    """Builds the input that runs one command on a long lived shell
+
+    The command can't read the shell's own input, its stderr is merged into
+    stdout and it's followed by a line with the marker and its exit code.
+
+    Args:
+        command (str): Command to run
+        marker (str): Marker unique to this command
+
+    Returns:
+        str: Shell input
+    """
+    return f"{{ {command}\n}} </dev/null 2>&1\nprintf '\\n{marker} %s\\n' \"$?\"\n"
+
+
+def sudo_validate_command(password):
+    # The password goes in a here-document, so it never shows up in ps and
+    # the shell reading its script from stdin doesn't matter
+    return f"{SUDO_VALIDATE} <<'__MR_PASSWORD__'\n{password}\n__MR_PASSWORD__"
+
+
+def read_frame(line, marker, lines):
+    """Adds one line of a shell_frame's output to lines
+
+    Args:
+        line (str): Line read from the shell
+        marker (str): The frame's marker
+        lines ([str]): Lines so far
+
+    Returns:
+        int: Exit code once the marker line is read, otherwise None
+    """
+    if not line.startswith(marker + " "):
+        lines.append(line)
+        return None
+    # The marker's leading newline adds a blank line unless the output
+    # didn't end in one
+    if len(lines) != 0 and lines[-1] == "":
+        lines.pop()
+    return int(line[len(marker) + 1 :])
+
+
+class ShellOutput(object):
+    """Output of a command run on a RemoteShell, shaped like HostOutput"""
+
+    def __init__(self, host):
+        """Initializes ShellOutput
+
+        Args:
+            host (str): Host name
+        """
+        self.host = host
+        self.client = None
+        self.channel = None
+        self.stdin = None
+        self.lines = []
+        self.exit_code = None
+        self.exception = None
+        self.finished = None
+
+    @property
+    def stdout(self):
+        return iter(list(self.lines))
+
+    @property
+    def stderr(self):
+        return iter(())
+
+
+class RemoteShell(object):
+    """One long lived `sh` on a host, running commands one at a time
+
+    Each command costs one write and reading up to its marker, instead of a
+    new channel (and sudo prompt) per command.
+    """
+
+    def __init__(self, host, client):
+        """Initializes RemoteShell
+
+        Args:
+            host (str): Host name
+            client (SSHClient): Connected client to open the shell on
+        """
+        self.host = host
+        self.client = client
+        self.host_out = client.run_command("exec sh")
+        self.lines = self.host_out.stdout
+        self.count = 0
+        # When sudo was last validated in this shell
+        self.sudo = 0
+        self.lock = gevent.lock.Semaphore()
+
+    def run(self, command, lines):
+        """Runs a command, appending its output lines as they arrive
+
+        Args:
+            command (str): Command to run
+            lines ([str]): Gets the output lines
+
+        Returns:
+            int: Exit code
+        """
+        with self.lock:
+            self.count += 1
+            marker = f"__MR_{self.count}__"
+            data = shell_frame(command, marker).encode()
+            self.client._eagain_write(self.host_out.channel.write, data)
+            for line in self.lines:
+                exit_code = read_frame(line, marker, lines)
+                if exit_code is not None:
+                    return exit_code
+            raise ShellException(f"Shell on {self.host} exited")
+
+    def close(self):
+        try:
+            self.client.close_channel(self.host_out.channel)
+        except Exception:
+            pass
+
+
+def close_client(client):
+    """Disconnects a client and stops its keepalives
+
+    pssh's disconnect() forgets the keepalive greenlet without killing it,
+    and the orphan then fails on the closed session.
+
+    Args:
+        client (SSHClient): Client
+    """
+    if client._keepalive_greenlet is not None:
+        client._keepalive_greenlet.kill()
+    client.disconnect()
+
+
+class SessionClient(SSHClient):
+    """SSHClient that times its TCP connect apart from key exchange and auth"""
+
+    connect_seconds = 0.0
+
+    def _connect(self, host, port, retries=1):
+        # Retries recurse, so the outermost call's time covers all of them
+        start = time.time()
+        try:
+            return super()._connect(host, port, retries=retries)
+        finally:
+            self.connect_seconds = time.time() - start
+
+
+class SessionPool(object):
+    """Keeps one authenticated SSH session per host alive between commands"""
+
+    def __init__(self, host_configs, keepalive_seconds=KEEPALIVE_SECONDS):
+        """Initializes the session pool
+
+        Sessions are opened lazily the first time a host is used.
+
+        Args:
+            host_configs ({str: HostConfig}): Host config for each host name
+            keepalive_seconds (int, optional): Keepalive interval for sessions. Defaults to KEEPALIVE_SECONDS.
+        """
+        self.host_configs = dict(host_configs)
+        self.keepalive_seconds = keepalive_seconds
+        self.clients = {}
+        # When sudo was last validated on each host's session
+        self.sudo = {}
+        self.shells = {}
+        self.limiter = ConnectLimiter()
+
+    def __contains__(self, host):
+        return host in self.host_configs
+
+    def sudo_valid(self, host):
+        return time.time() - self.sudo.get(host, 0) < SUDO_REFRESH
+
+    def add(self, host, host_config):
+        """Adds (or replaces) a host without touching other sessions
+
+        Args:
+            host (str): Host name
+            host_config (HostConfig): Config to connect with
+        """
+        self.drop(host)
+        self.host_configs[host] = host_config
+
+    def remove(self, host):
+        """Disconnects and forgets a host
+
+        Args:
+            host (str): Host name
+        """
+        self.drop(host)
+        self.host_configs.pop(host, None)
+
+    def drop(self, host):
+        """Disconnects a host's session so the next use reconnects
+
+        Args:
+            host (str): Host name
+        """
+        self.sudo.pop(host, None)
+        self.close_shell(host)
+        client = self.clients.pop(host, None)
+        if client is not None:
+            close_client(client)
+
+    def shell(self, host, timings=None):
+        """Gets the host's long lived shell, opening it if needed
+
+        Args:
+            host (str): Host name
+            timings (Timings, optional): Gets connect and auth if a session is opened. Defaults to None.
+
+        Returns:
+            RemoteShell: Shell
+        """
+        shell = self.shells.get(host)
+        if shell is None:
+            shell = RemoteShell(host, self.get(host, timings))
+            self.shells[host] = shell
+        return shell
+
+    def close_shell(self, host):
+        """Closes a host's shell, e.g. after a command on it was cut off
+
+        Args:
+            host (str): Host name
+        """
+        shell = self.shells.pop(host, None)
+        if shell is not None:
+            shell.close()
+
+    def get(self, host, timings=None):
+        """Gets a connected client for a host, connecting if needed
+
+        Args:
+            host (str): Host name
+            timings (Timings, optional): Gets connect and auth if a session is opened. Defaults to None.
+
+        Returns:
+            SSHClient: Authenticated client
+        """
+        client = self.clients.get(host)
+        if client is None or client.session is None:
+            start = time.time()
+            client = self.connect(host)
+            self.clients[host] = client
+            if timings is not None:
+                timings.add(host, "connect", client.connect_seconds)
+                timings.add(host, "auth", time.time() - start - client.connect_seconds)
+        return client
+
+    def is_connected(self, host):
+        """Checks if a host has a live pooled session
+
+        Args:
+            host (str): Host name
+
+        Returns:
+            bool: Whether the host has a session
+        """
+        client = self.clients.get(host)
+        return client is not None and client.session is not None
+
+    def disconnect_all(self):
+        """Disconnects every pooled session"""
+        for host in list(self.clients.keys()):
+            self.drop(host)
+
+    def connect(self, host, keepalive_seconds=None):
+        """Opens a new session to a host, outside the pool
+
+        Connections are paced by self.limiter, and ones the host refuses or
+        drops are retried with backoff. Failed logins aren't retried (and
+        password hosts only try the password), since repeated failures are
+        what gets us banned.
+
+        Args:
+            host (str): Host name
+            keepalive_seconds (int, optional): Keepalive interval, 0 for none. Defaults to self.keepalive_seconds.
+
+        Returns:
+            SSHClient: Authenticated client
+        """
+        if keepalive_seconds is None:
+            keepalive_seconds = self.keepalive_seconds
+        config = self.host_configs[host]
+        password_only = config.private_key is None and config.password is not None
+        began = time.time()
+        attempt = 1
+        while True:
+            gevent.sleep(self.limiter.reserve())
+            tried = time.time()
+            try:
+                client = SessionClient(
+                    host,
+                    user=config.user,
+                    password=config.password,
+                    port=config.port,
+                    pkey=config.private_key,
+                    num_retries=1,
+                    allow_agent=not password_only,
+                    identity_auth=not password_only,
+                    keepalive_seconds=keepalive_seconds,
+                )
+            except AuthenticationError:
+                raise
+            except (ConnectionErrorException, SessionError, Timeout, OSError):
+                self.limiter.failure()
+                if attempt >= self.limiter.attempts:
+                    raise
+                gevent.sleep(self.limiter.delay(attempt))
+                attempt += 1
+                continue
+            self.limiter.success()
+            # Time spent waiting on the limiter and on earlier tries counts as connecting
+            client.connect_seconds += tried - began
+            return client
+
+
 class SSHManager(object):
-    context_changed = False
+    # Whether commands can be issued from several threads at once
+    concurrent = False
+    # Validate sudo once per session instead of sending the password with
+    # every sudo command
+    sudo_session = False
 
-    def __init__(self, hosts, host_config):
+    def __init__(self, hosts, host_config, pool_size=POOL_SIZE):
+        self.local = gevent.local.local()
         self.hosts = sorted(hosts)
         self.all_hosts = copy.deepcopy(self.hosts)
-        self.client = ParallelSSHClient(self.hosts, host_config=host_config)
+        self.context_changed = False
+        self.sessions = SessionPool(dict(zip(hosts, host_config)))
+        self.set_concurrency(pool_size)
+
+    def set_concurrency(self, size):
+        """Sets how many hosts are worked on at once
+
+        A host holds its slot from connecting until its command's output
+        ends (or its timeout), on both backends. Commands already running
+        keep the old limit.
+
+        Args:
+            size (int): Hosts at once
+        """
+        self.pool_size = size
+        self.pool = gevent.pool.Pool(size=size)
+
+    # A background job pins the context it was started with, so changing the
+    # context afterwards doesn't change which hosts the job runs on
+
+    @property
+    def hosts(self):
+        pinned = getattr(self.local, "context", None)
+        return self._hosts if pinned is None else pinned[0]
+
+    @hosts.setter
+    def hosts(self, hosts):
+        self._hosts = hosts
+
+    @property
+    def context_changed(self):
+        pinned = getattr(self.local, "context", None)
+        return self._context_changed if pinned is None else pinned[1]
+
+    @context_changed.setter
+    def context_changed(self, changed):
+        self._context_changed = changed
+
+    def pin_context(self, hosts, changed):
+        self.local.context = (list(hosts), changed)
+
+    def spawn(self, func, *args):
+        """Runs func(*args) as a background job
+
+        Args:
+            func (function): Job to run
+
+        Returns:
+            gevent.Greenlet: Job, with join()
+        """
+        return gevent.spawn(func, *args)
+
+    def sleep(self, seconds):
+        # Lets background jobs and keepalives run while waiting
+        gevent.sleep(seconds)
+
+    # Host lists stay sorted and membership checks go through sets, so
+    # changing hosts or the context is linear in the number of hosts
 
     def remove_hosts(self, hosts):
-        indices = []
-        new_hosts = []
-        for i in range(len(self.all_hosts)):
-            if self.all_hosts[i] in hosts:
-                indices.append(i)
-            else:
-                new_hosts.append(self.all_hosts[i])
-        self.all_hosts = new_hosts
+        hosts = set(hosts)
+        self.all_hosts = [h for h in self.all_hosts if h not in hosts]
         if self.context_changed:
-            self.hosts = list(filter(lambda h: h not in hosts, self.hosts))
+            self.hosts = [h for h in self.hosts if h not in hosts]
         else:
-            self.hosts = copy.deepcopy(self.all_hosts)
-        self.client.host_config = list(
-            map(
-                lambda x: x[1],
-                filter(
-                    lambda x: x[0] not in indices, enumerate(self.client.host_config)
-                ),
-            )
-        )
-        self.client.hosts = self.all_hosts
+            self.hosts = list(self.all_hosts)
+        for h in hosts:
+            self.sessions.remove(h)
 
     def add_host(self, host):
-        self.all_hosts.append(host.host)
-        self.all_hosts = sorted(list(set(self.all_hosts)))
-        host_configs = self.client.host_config
-        idx = self.all_hosts.index(host.host)
-        host_configs.insert(idx, host.build_host_config())
-        self.client.hosts = self.all_hosts
-        self.client.host_config = host_configs
+        if host.host not in self.sessions:
+            bisect.insort(self.all_hosts, host.host)
+        self.sessions.add(host.host, host.build_host_config())
         if not self.context_changed:
-            self.hosts = copy.deepcopy(self.all_hosts)
+            self.hosts = list(self.all_hosts)
 
-    def run_command(self, command, commands=None, sudo=False):
+    def connect(self):
+        greenlets = [
+            self.pool.spawn(self._connect_host, h)
+            for h in self.all_hosts
+            if not self.sessions.is_connected(h)
+        ]
+        gevent.joinall(greenlets)
+        return [g.value for g in greenlets if g.value is not None]
+
+    def _connect_host(self, host):
+        try:
+            self.sessions.get(host)
+        except Exception as e:
+            return (host, e)
+
+    def run_command(
+        self, command, commands=None, sudo=False, hosts=None, timeout=None, stdin=None
+    ):
+        # Only hosts being run on are touched, so a command restricted to a
+        # few hosts costs the same regardless of how many hosts are loaded.
+        # commands holds per host args for command, in the same order as hosts.
+        # timeout bounds each host's connect, sudo, channel open and reads,
+        # and this call as a whole. stdin maps hosts to their command's input.
+        # Returns once every host's command has started; with more hosts
+        # than pool slots, that's after the first ones have finished.
+        started = time.time()
+        if hosts is None:
+            hosts = self.all_hosts
         if commands is None:
-            return self.client.run_command(command, sudo=sudo)
+            cmds = [command] * len(hosts)
         else:
-            return self.client.run_command(command, host_args=commands, sudo=sudo)
+            cmds = [command % c for c in commands]
+        timings = Timings()
+        runs = [(h, c) for h, c in zip(hosts, cmds) if h in self.sessions]
+        results = [gevent.event.AsyncResult() for _ in runs]
+        greenlets = [
+            self.pool.spawn(
+                self._run_host,
+                h,
+                c,
+                sudo,
+                timeout,
+                timings,
+                self.stdin_data(h, sudo, stdin),
+                r,
+            )
+            for (h, c), r in zip(runs, results)
+        ]
+        left = None if timeout is None else max(0.0, timeout - (time.time() - started))
+        gevent.wait(results, timeout=left)
+        outputs = []
+        for (h, _), g, r in zip(runs, greenlets, results):
+            if r.ready():
+                outputs.append(r.value)
+                continue
+            g.kill()
+            e = HostTimeout(f"No channel after {timeout}s")
+            outputs.append(HostOutput(h, None, None, None, exception=e))
+        return FanoutOutput(outputs, started, timings)
+
+    def _run_host(self, host, command, sudo, timeout, timings, data, result):
+        # Sets result to the host's output once its command has started, then
+        # keeps the pool slot until the output ends, like the asyncio backend
+        timer = gevent.Timeout(timeout, HostTimeout(f"No channel after {timeout}s"))
+        timer.start()
+        try:
+            try:
+                host_out = self._exec(host, command, sudo, timeout, timings)
+                if data is not None:
+                    self.write_stdin(host_out, data)
+            except Exception as e:
+                host_out = HostOutput(host, None, None, None, exception=e)
+            result.set(host_out)
+            if host_out.buffers is not None:
+                readers = [
+                    host_out.buffers.stdout.reader,
+                    host_out.buffers.stderr.reader,
+                ]
+                gevent.joinall(readers)
+        except Exception:
+            # Cut off while holding the slot; join reports it
+            pass
+        finally:
+            timer.close()
+
+    def _exec(self, host, command, sudo, timeout, timings):
+        try:
+            return self._exec_session(host, command, sudo, timeout, timings)
+        except SessionError:
+            # The pooled session died (reboot, idle timeout, etc.), so
+            # reconnect just this host and try once more
+            self.sessions.drop(host)
+            return self._exec_session(host, command, sudo, timeout, timings)
+
+    def _exec_session(self, host, command, sudo, timeout, timings):
+        client = self.sessions.get(host, timings)
+        if sudo:
+            if self.sudo_session:
+                with timings.timed(host, "sudo"):
+                    self._validate_sudo(host, client, timeout)
+            command = sudo_command(command, self.sudo_session)
+        with timings.timed(host, "channel"):
+            host_out = client.run_command(command, read_timeout=timeout)
+        timings.start(host)
+        return host_out
+
+    def _validate_sudo(self, host, client, timeout):
+        # Commands on one connection share its sshd process as their parent,
+        # so the timestamp sudo -v leaves behind covers later sudo -n calls
+        if self.sessions.sudo_valid(host):
+            return
+        host_out = client.run_command(SUDO_VALIDATE, read_timeout=timeout)
+        self.write_stdin(host_out, f"{self.password(host)}\n")
+        # Bounded by _run_host's timeout, so a hung prompt is a HostTimeout
+        client.wait_finished(host_out)
+        if host_out.exit_code != 0:
+            raise SudoException(f"sudo -v failed on {host}")
+        self.sessions.sudo[host] = time.time()
+
+    def run_shell(self, command, sudo=False, hosts=None, timeout=None, deadline=None):
+        # Runs command on each host's long lived shell. timeout bounds each
+        # host and deadline the whole fan-out; a shell that's cut off is
+        # closed, since the rest of its output would confuse the next command.
+        started = time.time()
+        if hosts is None:
+            hosts = self.all_hosts
+        output = FanoutOutput([ShellOutput(h) for h in hosts if h in self.sessions])
+        output.started = started
+        greenlets = [
+            self.pool.spawn(
+                self._shell_host, host_out, command, sudo, timeout, output.timings
+            )
+            for host_out in output
+        ]
+        gevent.joinall(greenlets, timeout=deadline)
+        for host_out, g in zip(output, greenlets):
+            if not g.ready():
+                g.kill()
+                host_out.exception = HostTimeout(f"Cut off after {deadline}s")
+                self.sessions.close_shell(host_out.host)
+        return output
+
+    def _shell_host(self, host_out, command, sudo, timeout, timings):
+        host = host_out.host
+        try:
+            with gevent.Timeout(timeout, HostTimeout(f"Cut off after {timeout}s")):
+                try:
+                    shell = self.sessions.shell(host, timings)
+                except SessionError:
+                    self.sessions.drop(host)
+                    shell = self.sessions.shell(host, timings)
+                host_out.client = shell
+                if sudo:
+                    with timings.timed(host, "sudo"):
+                        self._validate_shell_sudo(shell, host_out)
+                    command = sudo_command(command, True)
+                timings.start(host)
+                host_out.exit_code = shell.run(command, host_out.lines)
+        except Exception as e:
+            host_out.exception = e
+            self.sessions.close_shell(host)
+        finally:
+            host_out.finished = time.time()
+            timings.finish(host)
+
+    def _validate_shell_sudo(self, shell, host_out):
+        # sudo's timestamp belongs to the shell (its parent), so it only
+        # has to be validated once per shell
+        if time.time() - shell.sudo < SUDO_REFRESH:
+            return
+        lines = []
+        password = self.password(shell.host)
+        if shell.run(sudo_validate_command(password), lines) != 0:
+            host_out.lines += lines
+            raise SudoException(f"sudo -v failed on {shell.host}")
+        shell.sudo = time.time()
+
+    def password(self, host):
+        password = self.sessions.host_configs[host].password
+        return password if password is not None else ""
+
+    def stdin_data(self, host, sudo, stdin):
+        """Builds the input a host's command gets
+
+        Without a sudo session, sudo reads the password first.
+
+        Args:
+            host (str): Host name
+            sudo (bool): Whether the command runs as root
+            stdin ({str: str}): Input for each host, or None
+
+        Returns:
+            str: Input, or None for none
+        """
+        data = stdin.get(host) if stdin is not None else None
+        if sudo and not self.sudo_session:
+            data = f"{self.password(host)}\n" + (data if data is not None else "")
+        return data
+
+    def join(self, output, timeout=None):
+        # Waits up to timeout, then cancels the stragglers by closing their
+        # channels. Whatever they printed so far can still be read.
+        # Returns the hosts that were cut off.
+        pending = [host_out for host_out in output if host_out.client is not None]
+
+        def wait(host_out):
+            host_out.client.wait_finished(host_out)
+            output.timings.finish(host_out.host)
+
+        greenlets = [gevent.spawn(wait, h) for h in pending]
+        gevent.joinall(greenlets, timeout=timeout)
+        timed_out = []
+        for host_out, g in zip(pending, greenlets):
+            if not g.ready():
+                g.kill()
+                self.cancel_host(host_out, timeout)
+                timed_out.append(host_out.host)
+        return timed_out
+
+    def probe(self, hosts, timeout=None, command="true", sudo=False):
+        # Logs in over a brand new session and runs command (by default
+        # `true`), which is what would fail if a rule change locked us out.
+        # Returns the errors.
+        greenlets = [
+            self.pool.spawn(self._probe_host, h, timeout, command, sudo) for h in hosts
+        ]
+        gevent.joinall(greenlets)
+        return {h: g.value for h, g in zip(hosts, greenlets) if g.value is not None}
+
+    def _probe_host(self, host, timeout, command, sudo):
+        try:
+            with gevent.Timeout(timeout, HostTimeout(f"No login after {timeout}s")):
+                # One command and gone, so no keepalive greenlet to outlive it
+                client = self.sessions.connect(host, keepalive_seconds=0)
+                try:
+                    if sudo:
+                        command = sudo_command(command)
+                    host_out = client.run_command(command)
+                    if sudo:
+                        self.write_stdin(host_out, f"{self.password(host)}\n")
+                    client.wait_finished(host_out)
+                    if host_out.exit_code != 0:
+                        return ProbeException(f"Exit code {host_out.exit_code}")
+                finally:
+                    close_client(client)
+        except Exception as e:
+            return e
+
+    def wait_host(self, host_out):
+        # Waits for one host's command to exit, so its exit code is known
+        if host_out.client is not None and host_out.exception is None:
+            host_out.client.wait_finished(host_out)
+
+    def cancel_host(self, host_out, timeout):
+        try:
+            host_out.client.close_channel(host_out.channel)
+        except Exception:
+            pass
+        host_out.exception = HostTimeout(f"Cut off after {timeout}s")
+
+    def write_stdin(self, host_out, data):
+        # Stdin.write is a single channel write, so large payloads have to go
+        # through the client's partial write handling. The EOF lets the remote
+        # command (e.g. iptables-restore) know the input is complete.
+        client = host_out.client
+        if client is None:
+            return
+        client._eagain_write(host_out.channel.write, data.encode())
+        client._eagain(host_out.channel.send_eof)
+
+    def iter_lines(self, output, stderr=False, timeout=None):
+        # Each host gets a reader greenlet feeding a shared bounded queue.
+        # Yields (host_out, line) as lines arrive and (host_out, None) once a
+        # host is done. Hosts still going after timeout are cancelled.
+        queue = gevent.queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+        def reader(host_out):
+            try:
+                if host_out.exception is None:
+                    for line in host_out.stdout:
+                        queue.put((host_out, line))
+                    if stderr:
+                        for line in host_out.stderr:
+                            queue.put((host_out, line))
+            except Timeout as e:
+                host_out.exception = HostTimeout(str(e))
+            finally:
+                output.timings.finish(host_out.host)
+                queue.put((host_out, None))
 
-    def join(self, output):
-        self.client.join(output)
+        readers = {host_out: gevent.spawn(reader, host_out) for host_out in output}
+        deadline = None if timeout is None else time.time() + timeout
+        while len(readers) != 0:
+            try:
+                wait = None if deadline is None else max(0, deadline - time.time())
+                host_out, line = queue.get(timeout=wait)
+            except gevent.queue.Empty:
+                for host_out, g in readers.items():
+                    g.kill()
+                    self.cancel_host(host_out, timeout)
+                    yield (host_out, None)
+                return
+            if line is None:
+                readers.pop(host_out, None)
+            yield (host_out, line)
 
     def change_context_hosts_all(self):
         self.change_context_hosts(self.all_hosts)
 
     def change_context_hosts(self, new_hosts):
-        new_hosts = sorted(list(set(new_hosts)))
+        new_hosts = set(new_hosts)
 
         for h in new_hosts:
-            if h not in self.all_hosts:
+            if h not in self.sessions:
                 raise SSHManager.ContextException(f"Host {h} not in host list")
 
-        self.hosts = list(filter(lambda h: h in new_hosts, self.all_hosts))
+        self.hosts = [h for h in self.all_hosts if h in new_hosts]
         self.context_changed = True
 
     def change_context_indices(self, indices):
@@ -92,7 +878,7 @@ class SSHManager(object):
         self.change_context_hosts(new_hosts)
 
     def reset_context(self):
-        self.hosts = copy.deepcopy(self.all_hosts)
+        self.hosts = list(self.all_hosts)
         self.context_changed = False
 
     @staticmethod
@@ -9,34 +9,91 @@
 ##################################################################
 
 from multirouter.ssh_handler import *
+from multirouter.async_ssh_handler import AsyncSSHManager
 from multirouter.host import *
 from multirouter.shell import *
 from multirouter.iptables_manager import *
+from multirouter.backend import FIREWALLS
+from multirouter.metrics import MetricsException
+from multirouter.records import FORMATS
+from multirouter.snapshot import SnapshotStore
 from colorama import Fore, Back, Style, init as cinit
 
 import json, sys, os
 
 
 def usage(arg):
-    print(f"\nUsage:\n{arg} [load file (json)]\n-h, --help\t\tHelp\n")
+    print(
+        f"\nUsage:\n{arg} [load file (json)]\n-h, --help\t\tHelp\n--backend gevent|asyncio\tSSH backend (default: gevent, or the load file's \"backend\")\n--script file|-\t\tRun commands from a file (- for stdin) instead of the prompt\n--yes\t\t\tAnswer `yes` to load's warning in a script\n--commit\t\tAnswer `COMMIT` to load's confirmation in a script\n--status file|-\t\tWrite each host's status as JSON after a script (- for stdout)\n--format text|json|ndjson\tOutput format (default: text)\n--timings\t\tPrint per phase timings after each command\n--metrics kind:path\tSend timings to prometheus:file or ndjson:file\n"
+    )
+
+
+def pop_option(args, option, has_value=False):
+    # Removes an option (and its value) from args, returning the value, True
+    # for a flag that was given, or None if it wasn't
+    if option not in args:
+        return None
+    i = args.index(option)
+    if not has_value:
+        del args[i]
+        return True
+    if i + 1 >= len(args):
+        print(f"{option} needs a value\n")
+        usage(sys.argv[0])
+        sys.exit(2)
+    value = args[i + 1]
+    del args[i : i + 2]
+    return value
+
+
+def write_status(fn, status, errors):
+    report = json.dumps({"hosts": status, "errors": errors}, indent=1, sort_keys=True)
+    if fn == "-":
+        print(report)
+    else:
+        with open(fn, "w") as f:
+            f.write(report + "\n")
 
 
 if __name__ == "__main__":
     try:
         cinit()
 
-        if len(sys.argv) > 2:
+        args = sys.argv[1:]
+        backend = pop_option(args, "--backend", True)
+        if backend is not None and backend not in ("gevent", "asyncio"):
+            print("Backend must be gevent or asyncio\n")
+            usage(sys.argv[0])
+            sys.exit(1)
+        fmt = pop_option(args, "--format", True)
+        if fmt is not None and fmt not in FORMATS:
+            print("Format must be text, json or ndjson\n")
+            usage(sys.argv[0])
+            sys.exit(1)
+        script = pop_option(args, "--script", True)
+        timings = pop_option(args, "--timings")
+        metrics = pop_option(args, "--metrics", True)
+        status_file = pop_option(args, "--status", True)
+        answers = set()
+        if pop_option(args, "--yes"):
+            answers.add("yes")
+        if pop_option(args, "--commit"):
+            answers.add("COMMIT")
+
+        if len(args) > 1:
             print("Too many args\n")
             usage(sys.argv[0])
             sys.exit(1)
 
-        if len(sys.argv) == 2:
-            if sys.argv[1] == "-h" or sys.argv[1] == "--help":
+        if len(args) == 1:
+            if args[0] == "-h" or args[0] == "--help":
                 usage(sys.argv[0])
                 sys.exit(0)
-            elif os.path.exists(sys.argv[1]):
-                f = open(sys.argv[1], "r")
+            elif os.path.exists(args[0]):
+                f = open(args[0], "r")
                 data = json.load(f)
+                if backend is None:
+                    backend = data.get("backend", "gevent")
                 hs = sorted(data["hosts"], key=lambda h: h["host"])
                 hostnames = list(map(lambda h: h["host"], hs))
                 creds = list(
@@ -54,15 +111,75 @@ if __name__ == "__main__":
                         hostnames[i],
                         creds[i],
                         port=hs[i]["port"] if "port" in hs[i] else 22,
+                        groups=hs[i].get("groups"),
+                        tags=hs[i].get("tags"),
                     )
                     for i in range(len(hostnames))
                 ]
                 host_config = [h.build_host_config() for h in hosts]
                 host_map = HostMap(hostnames, hosts)
-                ssh_manager = SSHManager(hostnames, host_config)
+                if backend == "asyncio":
+                    ssh_manager = AsyncSSHManager(hostnames, host_config)
+                else:
+                    ssh_manager = SSHManager(hostnames, host_config)
+                ssh_manager.sudo_session = data.get("sudo_session", False)
+                if "concurrency" in data:
+                    ssh_manager.set_concurrency(data["concurrency"])
+                limiter = ssh_manager.sessions.limiter
+                limiter.set_rate(data.get("connect_rate", limiter.rate))
+                limiter.attempts = data.get("connect_attempts", limiter.attempts)
+                limiter.backoff = data.get("backoff", limiter.backoff)
+                for h, e in ssh_manager.connect():
+                    print(f"Couldn't connect to {h}: {e!r}")
 
                 iptables_manager = IPTablesManager(ssh_manager, host_map)
-                MultirouterShell(iptables_manager).cmdloop()
+                firewalls = [data.get("firewall", "auto")]
+                firewalls += [h["firewall"] for h in hs if "firewall" in h]
+                if any(fw not in FIREWALLS for fw in firewalls):
+                    print("Firewall must be auto, iptables or nftables")
+                    sys.exit(1)
+                iptables_manager.firewall = data.get("firewall", "auto")
+                iptables_manager.firewalls = {
+                    h["host"]: h["firewall"] for h in hs if "firewall" in h
+                }
+                iptables_manager.detect_backends()
+                if "snapshots" in data:
+                    iptables_manager.store = SnapshotStore(data["snapshots"])
+                if fmt is not None:
+                    iptables_manager.format = fmt
+                iptables_manager.show_timings = bool(timings)
+                if metrics is None:
+                    metrics = data.get("metrics")
+                if metrics is not None:
+                    try:
+                        iptables_manager.set_metrics(metrics)
+                    except (MetricsException, OSError) as e:
+                        print(e)
+                        sys.exit(1)
+                if script is None:
+                    MultirouterShell(iptables_manager).cmdloop()
+                    sys.exit(0)
+
+                # Batch mode: exit 0 if every host succeeded, 1 if any host
+                # failed or timed out, 2 if the script itself had errors
+                if script == "-":
+                    lines = sys.stdin.read().split("\n")
+                else:
+                    with open(script, "r") as f:
+                        lines = f.read().split("\n")
+                iptables_manager.answers = answers
+                shell = MultirouterShell(iptables_manager, batch=True)
+                try:
+                    shell.run_script(lines)
+                except SystemExit:
+                    shell.wait_jobs()
+                status = iptables_manager.status
+                if status_file is not None:
+                    write_status(status_file, status, shell.errors)
+                if shell.errors != 0:
+                    sys.exit(2)
+                failed = [h for h, s in status.items() if s["status"] != "ok"]
+                sys.exit(1 if len(failed) != 0 else 0)
             else:
                 print("File doesn't exist")
                 sys.exit(1)
@@ -0,0 +1,86 @@
+import itertools
+import os
+import sys
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from multirouter.async_ssh_handler import AsyncSSHManager  # noqa: E402
+from multirouter.harness import FLEET_PORT, FakeFleet  # noqa: E402
+from multirouter.host import HostMap  # noqa: E402
+from multirouter.iptables_manager import IPTablesManager  # noqa: E402
+from multirouter.snapshot import SnapshotStore  # noqa: E402
+from multirouter.ssh_handler import SSHManager  # noqa: E402
+
+# Each fleet gets its own port, so a fleet that's still shutting down
+# never collides with the next test's
+PORTS = itertools.count(FLEET_PORT + 100)
+
+
+@pytest.fixture
+def make_fleet():
+    """Starts fake routers, stopping them after the test
+
+    Takes FakeFleet's arguments (other than port).
+    """
+    fleets = []
+
+    def make(count=2, **kwargs):
+        fleet = FakeFleet(count, port=next(PORTS), **kwargs)
+        fleet.start()
+        fleets.append(fleet)
+        return fleet
+
+    yield make
+    for fleet in fleets:
+        fleet.stop()
+
+
+@pytest.fixture(params=["gevent", "asyncio"])
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def make_manager(backend, tmp_path):
+    """Builds an IPTablesManager connected to a fleet on the backend under test"""
+    managers = []
+
+    def make(fleet, **settings):
+        hosts = fleet.hosts()
+        hostnames = [h.host for h in hosts]
+        config = [h.build_host_config() for h in hosts]
+        if backend == "asyncio":
+            ssh_manager = AsyncSSHManager(hostnames, config)
+        else:
+            ssh_manager = SSHManager(hostnames, config)
+        m = IPTablesManager(ssh_manager, HostMap(hostnames, hosts))
+        m.store = SnapshotStore(str(tmp_path / "snapshots"))
+        m.answers = {"yes", "COMMIT"}
+        for name, value in settings.items():
+            setattr(m, name, value)
+        managers.append(m)
+        assert ssh_manager.connect() == []
+        return m
+
+    yield make
+    for m in managers:
+        if isinstance(m.ssh_manager, AsyncSSHManager):
+            m.ssh_manager.close()
+        else:
+            m.ssh_manager.sessions.disconnect_all()
+
+
+@pytest.fixture
+def live_rules():
+    """Fetches a host's rules as `iptables -S` lines, bypassing the cache"""
+
+    def fetch(m, host, table="filter"):
+        rulesets = [r for r in m.fetch_rules([host], force=True) if r.host == host]
+        assert len(rulesets) == 1
+        return rulesets[0].tables[table].to_lines()
+
+    return fetch
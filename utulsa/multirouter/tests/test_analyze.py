@@ -0,0 +1,50 @@
+from multirouter.analyze import analyze_tables
+from multirouter.ruleset import parse_save
+
+
+def analyzed(rules):
+    lines = ["*filter", ":INPUT ACCEPT [0:0]"] + rules + ["COMMIT"]
+    findings, cleaned = analyze_tables(parse_save(lines), ["filter"])
+    return [f.record() for f in findings], cleaned["filter"].to_lines()
+
+
+def test_covered_rules_are_found():
+    findings, cleaned = analyzed(
+        [
+            "-A INPUT -s 10.0.0.0/8 -j DROP",
+            "-A INPUT -s 10.1.2.3/32 -j DROP",
+            "-A INPUT -s 10.1.2.4/32 -j ACCEPT",
+            "-A INPUT -p tcp --dport 22 -j ACCEPT",
+            "-A INPUT -p tcp --dport 22 -j ACCEPT",
+        ]
+    )
+    kinds = [(f["kind"], f["positions"], f["by"]) for f in findings]
+    assert kinds == [("redundant", [2], 1), ("shadowed", [3], 1), ("duplicate", [5], 4)]
+    assert cleaned == [
+        "-P INPUT ACCEPT",
+        "-A INPUT -s 10.0.0.0/8 -j DROP",
+        "-A INPUT -p tcp --dport 22 -j ACCEPT",
+    ]
+
+
+def test_adjacent_rules_merge():
+    findings, cleaned = analyzed(
+        [
+            "-A INPUT -s 172.16.0.0/32 -j DROP",
+            "-A INPUT -s 172.16.0.1/32 -j DROP",
+            "-A INPUT -p tcp -m tcp --dport 22 -j ACCEPT",
+            "-A INPUT -p tcp -m tcp --dport 23 -j ACCEPT",
+        ]
+    )
+    assert [f["kind"] for f in findings] == ["mergeable", "mergeable"]
+    assert cleaned[1:] == [
+        "-A INPUT -s 172.16.0.0/31 -j DROP",
+        "-A INPUT -p tcp -m tcp --dport 22:23 -j ACCEPT",
+    ]
+
+
+def test_negated_matches_cover_nothing():
+    findings, _ = analyzed(
+        ["-A INPUT ! -s 10.0.0.0/8 -j DROP", "-A INPUT -s 192.168.1.1/32 -j ACCEPT"]
+    )
+    assert findings == []
@@ -0,0 +1,12 @@
+import argparse
+
+from benchmark import fleet_bench
+from multirouter.harness import FLEET_PORT
+
+
+def test_fleet_bench_runs_on_one_host():
+    a = argparse.Namespace(
+        port=FLEET_PORT + 50, rules=5, latency=0.0, backend="gevent", repeat=1
+    )
+    results = fleet_bench(1, a)
+    assert set(results) >= {"connect", "list", "save", "load", "context x100"}
@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+RULE = "-A INPUT -s 192.0.2.1/32 -j DROP"
+
+
+def test_confirmed_change_stays(make_fleet, make_manager, live_rules):
+    fleet = make_fleet(2)
+    m = make_manager(fleet, confirm_timeout=1)
+    m.run_iptables(RULE)
+    time.sleep(1.5)
+    for h in fleet.addresses():
+        assert m.status[h]["confirm"] == "confirmed"
+        assert RULE in live_rules(m, h)
+
+
+@pytest.mark.parametrize("backend", ["gevent"])
+def test_failed_change_rolls_back(make_fleet, make_manager):
+    fleet = make_fleet(1, rules=3)
+    m = make_manager(fleet, confirm_timeout=30)
+    m.run_iptables("-D INPUT 9")
+    h = fleet.addresses()[0]
+    assert m.status[h]["confirm"] == "rolled back"
+    assert m.status[h]["status"] == "failed"
+
+
+@pytest.mark.parametrize("backend", ["gevent"])
+def test_unconfirmed_change_reverts(make_fleet, make_manager, live_rules):
+    fleet = make_fleet(1, rules=3)
+    m = make_manager(fleet, confirm_timeout=1)
+    h = fleet.addresses()[0]
+    before = live_rules(m, h)
+    # As if the change locked us out: the confirming login fails
+    m.ssh_manager.probe = lambda hosts, *args, **kwargs: {
+        h: ConnectionError("locked out") for h in hosts
+    }
+    m.run_iptables(RULE)
+    assert m.status[h]["confirm"] == "reverting"
+    assert RULE in live_rules(m, h)
+    time.sleep(1.5)
+    assert live_rules(m, h) == before
+
+
+@pytest.mark.parametrize("backend", ["gevent"])
+def test_probe_leaves_no_keepalive(make_fleet, make_manager):
+    fleet = make_fleet(1)
+    m = make_manager(fleet)
+    h = fleet.addresses()[0]
+    sessions = m.ssh_manager.sessions
+    clients = []
+    connect = sessions.connect
+
+    def kept(host, **kwargs):
+        clients.append(connect(host, **kwargs))
+        return clients[-1]
+
+    sessions.connect = kept
+    assert m.ssh_manager.probe([h], 5) == {}
+    assert len(clients) == 1
+    assert clients[0].keepalive_seconds == 0
+    assert clients[0]._keepalive_greenlet is None
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from multirouter.harness import FakeRouter, synthetic_save
+
+
+def test_list_shows_every_host(make_fleet, make_manager, capsys):
+    fleet = make_fleet(2, rules=3)
+    m = make_manager(fleet)
+    m.list_rules(False)
+    out = capsys.readouterr().out
+    for h in fleet.addresses():
+        assert h in out
+    assert "Chain INPUT" in out
+
+
+def test_iptables_changes_every_host(make_fleet, make_manager, live_rules):
+    fleet = make_fleet(2)
+    m = make_manager(fleet)
+    m.run_iptables("-A INPUT -s 192.0.2.1/32 -j DROP")
+    for h in fleet.addresses():
+        assert "-A INPUT -s 192.0.2.1/32 -j DROP" in live_rules(m, h)
+        assert m.status[h]["status"] == "ok"
+
+
+def test_iptables_error_fails_host(make_fleet, make_manager):
+    fleet = make_fleet(1)
+    m = make_manager(fleet)
+    m.run_iptables("-D INPUT 5")
+    h = fleet.addresses()[0]
+    assert m.status[h]["status"] == "failed"
+    assert m.status[h]["failed"] == 1
+
+
+def test_save_and_load_round_trip(make_fleet, make_manager, live_rules):
+    fleet = make_fleet(2, rules=5)
+    m = make_manager(fleet)
+    m.save_snapshot("before")
+    before = {h: live_rules(m, h) for h in fleet.addresses()}
+    m.run_iptables("-F INPUT")
+    assert all(live_rules(m, h) != before[h] for h in fleet.addresses())
+    m.load(m.store.load("before"))
+    for h in fleet.addresses():
+        assert live_rules(m, h) == before[h]
+
+
+@pytest.mark.parametrize("delta", [False, True])
+def test_load_synthetic_rules(make_fleet, make_manager, live_rules, delta):
+    fleet = make_fleet(1, rules=10)
+    m = make_manager(fleet)
+    h = fleet.addresses()[0]
+    m.load({h: synthetic_save(20, seed=1)}, delta=delta)
+    lines = live_rules(m, h)
+    assert len([l for l in lines if l.startswith("-A INPUT")]) == 20
+
+
+def test_context_limits_hosts(make_fleet, make_manager, live_rules):
+    fleet = make_fleet(3)
+    m = make_manager(fleet)
+    first, second, third = fleet.addresses()
+    m.change_context_select(["group:g1"])
+    m.run_iptables("-A INPUT -j ACCEPT")
+    assert "-A INPUT -j ACCEPT" in live_rules(m, second)
+    assert "-A INPUT -j ACCEPT" not in live_rules(m, first)
+    assert "-A INPUT -j ACCEPT" not in live_rules(m, third)
+
+
+def test_iptables_needs_root():
+    router = FakeRouter("admin", "password", exec_delay=0)
+    out = []
+    err = []
+    code = asyncio.run(router.shell("iptables -S", None, False, out, err))
+    assert code == 4
+    assert "must be root" in err[0]
+
+
+def test_numbers_are_host_ids(make_fleet, make_manager, capsys):
+    fleet = make_fleet(3)
+    m = make_manager(fleet)
+    first, second, third = fleet.addresses()
+    m.change_context_indices([2])
+    m.print_context()
+    assert f"2\t{third}" in capsys.readouterr().out
+    # IDs stay put when the context (or the host list) changes
+    m.list_rules_indices([1], False)
+    out = capsys.readouterr().out
+    assert second in out
+    assert third not in out
@@ -0,0 +1,45 @@
+from multirouter.ipsets import consolidate_tables, restore_payload
+from multirouter.ruleset import parse_save
+
+
+def blocklist(prefix, count=8):
+    return [
+        f"-A INPUT -s {prefix}.{i}/32 -p tcp --dport 22 -j DROP" for i in range(count)
+    ]
+
+
+def consolidated(rules):
+    lines = ["*filter", ":INPUT ACCEPT [0:0]"] + rules + ["COMMIT"]
+    runs, tables = consolidate_tables(parse_save(lines), ["filter"])
+    return runs, tables["filter"].to_lines()
+
+
+def test_run_becomes_one_set_rule():
+    runs, lines = consolidated(blocklist("10.9.8"))
+    assert len(runs) == 1
+    assert runs[0].elements == [f"10.9.8.{i}" for i in range(8)]
+    assert lines == ["-P INPUT ACCEPT", str(runs[0].rule)]
+    assert f"--match-set {runs[0].name} src" in str(runs[0].rule)
+
+
+def test_short_runs_are_left_alone():
+    runs, lines = consolidated(blocklist("10.9.8", 7))
+    assert runs == []
+    assert len(lines) == 8
+
+
+def test_runs_of_the_same_rule_get_their_own_sets():
+    rules = blocklist("10.9.8") + ["-A INPUT -j LOG"] + blocklist("10.9.9")
+    runs, _ = consolidated(rules)
+    assert len(runs) == 2
+    assert runs[0].name != runs[1].name
+    payload = restore_payload(runs)
+    for i in range(8):
+        assert f"10.9.8.{i}\n" in payload
+        assert f"10.9.9.{i}\n" in payload
+
+
+def test_same_run_same_name_across_hosts():
+    first, _ = consolidated(blocklist("10.9.8"))
+    second, _ = consolidated(["-A INPUT -j LOG"] + blocklist("10.9.8"))
+    assert first[0].name == second[0].name
@@ -0,0 +1,37 @@
+from multirouter.monitor import HitMonitor, parse_counters
+from multirouter.ruleset import Ruleset, parse_save
+
+SAVE = """*filter
+:INPUT ACCEPT [0:0]
+[10:1000] -A INPUT -p tcp --dport 22 -j ACCEPT
+[0:0] -A INPUT -p tcp --dport 80 -j ACCEPT
+COMMIT"""
+
+
+def watched(fetched=100.0):
+    monitor = HitMonitor(["filter"])
+    monitor.set_ruleset(Ruleset("h", parse_save(SAVE.splitlines()), fetched))
+    return monitor
+
+
+def test_rates_from_polls():
+    monitor = watched()
+    poll = parse_counters(["*filter", "30 3000 INPUT", "5 500 INPUT"])
+    assert monitor.matches("h", poll)
+    monitor.poll("h", 110.0, poll)
+    host, table, rule, packets, bytes, _, _ = monitor.hottest(["h"], 1)[0]
+    assert (host, table, rule.spec) == ("h", "filter", "-p tcp --dport 22 -j ACCEPT")
+    assert (packets, bytes) == (2.0, 200.0)
+    assert monitor.totals(["h"]) == (2.5, 250.0, 2)
+
+
+def test_zeroed_counters_count_from_zero():
+    monitor = watched()
+    monitor.poll("h", 110.0, parse_counters(["*filter", "4 400 INPUT", "0 0 INPUT"]))
+    assert monitor.rates["h"][0] == (0.4, 40.0)
+
+
+def test_changed_rules_need_a_fetch():
+    monitor = watched()
+    assert not monitor.matches("h", parse_counters(["*filter", "1 1 INPUT"]))
+    assert not monitor.matches("other", parse_counters(["*filter"]))
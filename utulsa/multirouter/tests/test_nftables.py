@@ -0,0 +1,146 @@
+import pytest
+
+from multirouter.backend import DETECT_COMMAND
+from multirouter.nftables import (
+    NftablesException,
+    command_script,
+    parse_ruleset,
+    parse_spec,
+    restore_script,
+)
+
+RULESET = {
+    "nftables": [
+        {"table": {"family": "ip", "name": "filter", "handle": 1}},
+        {
+            "chain": {
+                "family": "ip",
+                "table": "filter",
+                "name": "INPUT",
+                "handle": 1,
+                "type": "filter",
+                "hook": "input",
+                "prio": 0,
+                "policy": "drop",
+            }
+        },
+        {
+            "rule": {
+                "family": "ip",
+                "table": "filter",
+                "chain": "INPUT",
+                "handle": 5,
+                "comment": "ssh in",
+                "expr": [
+                    {
+                        "match": {
+                            "op": "==",
+                            "left": {"payload": {"protocol": "ip", "field": "saddr"}},
+                            "right": {"prefix": {"addr": "10.0.0.0", "len": 8}},
+                        }
+                    },
+                    {
+                        "match": {
+                            "op": "==",
+                            "left": {"payload": {"protocol": "tcp", "field": "dport"}},
+                            "right": 22,
+                        }
+                    },
+                    {"counter": {"packets": 5, "bytes": 300}},
+                    {"accept": None},
+                ],
+            }
+        },
+    ]
+}
+
+
+@pytest.mark.parametrize(
+    "spec, statements",
+    [
+        ("-s 10.0.0.0/8 -j DROP", "ip saddr 10.0.0.0/8 counter drop"),
+        (
+            "-p tcp -m multiport --dports 80,443,8000:8080 -m conntrack --ctstate NEW -j ACCEPT",
+            "meta l4proto tcp tcp dport { 80, 443, 8000-8080 } ct state new counter accept",
+        ),
+        ("-o eth0 -j MASQUERADE", 'oifname "eth0" counter masquerade'),
+    ],
+)
+def test_specs_translate(spec, statements):
+    r = parse_spec(spec)
+    assert r.statements() == statements
+    assert parse_spec(r.spec()).spec() == r.spec()
+
+
+@pytest.mark.parametrize("spec", ["-m recent --set", "-j MARK --set-mark 1"])
+def test_untranslatable_specs_fail(spec):
+    with pytest.raises(NftablesException):
+        parse_spec(spec).statements()
+
+
+def test_ruleset_from_json():
+    tables = parse_ruleset(RULESET, ["filter"])
+    assert tables["filter"].to_lines() == [
+        "-P INPUT DROP",
+        '-A INPUT -s 10.0.0.0/8 -p tcp -m tcp --dport 22 -m comment --comment "ssh in" -j ACCEPT',
+    ]
+    r = tables["filter"].all_rules()[0]
+    assert (r.packets, r.bytes, r.handle) == (5, 300, 5)
+
+
+def test_restore_script_replaces_tables():
+    script = restore_script(parse_ruleset(RULESET, ["filter"])).splitlines()
+    assert script[:3] == [
+        "add table ip filter",
+        "delete table ip filter",
+        "add table ip filter",
+    ]
+    assert "policy drop;" in script[3]
+    assert script[4].endswith('tcp dport 22 counter accept comment "ssh in"')
+
+
+def test_commands_use_handles():
+    tables = parse_ruleset(RULESET, ["filter"])
+    assert (
+        command_script(tables, "-D INPUT 1") == "delete rule ip filter INPUT handle 5\n"
+    )
+    assert (
+        command_script(tables, "-A INPUT -s 1.2.3.4 -j DROP")
+        == "add rule ip filter INPUT ip saddr 1.2.3.4/32 counter drop\n"
+    )
+    with pytest.raises(NftablesException):
+        command_script(tables, "-D INPUT 9")
+
+
+def test_firewall_detected_on_first_command(make_fleet, make_manager):
+    fleet = make_fleet(2)
+    m = make_manager(fleet)
+    asked = []
+    detect = m.detect_backends
+    m.detect_backends = lambda hosts=None: asked.append(sorted(hosts)) or detect(hosts)
+    m.run_iptables("-S")
+    m.run_iptables("-S")
+    assert asked == [fleet.addresses()]
+    assert all(m.backends[h].name == "iptables" for h in fleet.addresses())
+
+
+@pytest.mark.parametrize("backend", ["gevent"])
+def test_unreachable_host_is_asked_again(make_fleet, make_manager):
+    fleet = make_fleet(1)
+    m = make_manager(fleet)
+    h = fleet.addresses()[0]
+    run = m.run
+    failed = []
+
+    def first_detect_fails(cmd, hosts, *args, **kwargs):
+        if cmd == DETECT_COMMAND and len(failed) == 0:
+            failed.append(h)
+            cmd = "false"
+        return run(cmd, hosts, *args, **kwargs)
+
+    m.run = first_detect_fails
+    m.detect_backends()
+    assert h not in m.backends
+    m.run_iptables("-S")
+    assert m.backends[h].name == "iptables"
+    assert m.status[h]["status"] == "ok"
@@ -0,0 +1,66 @@
+from multirouter.optimize import depth, optimize_tables, reorder
+from multirouter.ruleset import Rule, Table
+
+
+def rules(*specs):
+    return [Rule("INPUT", spec) for spec in specs]
+
+
+def test_hot_rule_moves_past_disjoint_rules():
+    chain = rules(
+        "-p udp --dport 53 -j ACCEPT",
+        "-s 10.0.0.0/8 -p tcp --dport 80 -j DROP",
+        "-p tcp --dport 22 -j ACCEPT",
+    )
+    assert reorder(chain, [1, 0, 100]) == [2, 0, 1]
+
+
+def test_overlapping_rules_keep_their_order():
+    # Every packet to port 22 from 10/8 would change verdict
+    chain = rules("-s 10.0.0.0/8 -j DROP", "-p tcp --dport 22 -j ACCEPT")
+    assert reorder(chain, [0, 100]) == [0, 1]
+
+
+def test_same_target_rules_commute():
+    chain = rules("-s 10.0.0.0/8 -j ACCEPT", "-p tcp --dport 22 -j ACCEPT")
+    assert reorder(chain, [0, 100]) == [1, 0]
+
+
+def test_exclusive_states_commute():
+    chain = rules(
+        "-m conntrack --ctstate NEW -j DROP",
+        "-m conntrack --ctstate ESTABLISHED,RELATED -j ACCEPT",
+    )
+    assert reorder(chain, [0, 100]) == [1, 0]
+
+
+def test_nat_states_overlap_connection_states():
+    # A DNATed packet is NEW or ESTABLISHED as well
+    chain = rules(
+        "-m conntrack --ctstate NEW -j DROP",
+        "-m conntrack --ctstate DNAT -j ACCEPT",
+    )
+    assert reorder(chain, [0, 100]) == [0, 1]
+
+
+def test_stateful_rules_are_barriers():
+    chain = rules(
+        "-p udp --dport 53 -j ACCEPT",
+        "-p tcp --dport 80 -m limit --limit 5/sec -j ACCEPT",
+        "-p tcp --dport 22 -j ACCEPT",
+    )
+    assert reorder(chain, [0, 0, 100]) == [0, 1, 2]
+
+
+def test_optimize_tables_reports_depth():
+    table = "filter"
+    chain = rules("-p udp --dport 53 -j ACCEPT", "-p tcp --dport 22 -j ACCEPT")
+    t = Table(table)
+    t.add_chain("INPUT", "ACCEPT")
+    for r in chain:
+        t.add_rule(r)
+    weights = {id(chain[0]): 1.0, id(chain[1]): 3.0}
+    changes, optimized = optimize_tables({table: t}, [table], weights)
+    assert len(changes) == 1
+    assert (changes[0].before, changes[0].after) == (depth([1, 3]), depth([3, 1]))
+    assert optimized[table].rules["INPUT"] == [chain[1], chain[0]]
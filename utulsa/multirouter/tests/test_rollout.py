@@ -0,0 +1,71 @@
+import pytest
+
+from multirouter.rollout import RolloutPlan
+
+RULE = "-A INPUT -s 192.0.2.1/32 -j DROP"
+
+
+def plan():
+    return RolloutPlan(canary=1, batch_size=2, concurrency=1)
+
+
+def test_rollout_changes_every_batch(make_fleet, make_manager, live_rules):
+    fleet = make_fleet(3)
+    m = make_manager(fleet)
+    assert m.rollout_iptables(RULE, plan())
+    for h in fleet.addresses():
+        assert RULE in live_rules(m, h)
+
+
+@pytest.mark.parametrize("backend", ["gevent"])
+def test_failed_batch_rolls_back(make_fleet, make_manager, live_rules):
+    fleet = make_fleet(3, rules=3)
+    m = make_manager(fleet)
+    canary, second, third = fleet.addresses()
+    before = {h: live_rules(m, h) for h in fleet.addresses()}
+
+    def apply(batch):
+        # The canary takes the change, the next batch fails it
+        arg = RULE if canary in batch else "-D INPUT 9"
+        return m.iptables_output(arg, batch)
+
+    assert not m.rollout(fleet.addresses(), apply, plan())
+    for h in fleet.addresses():
+        assert live_rules(m, h) == before[h]
+
+
+@pytest.mark.parametrize("backend", ["gevent"])
+def test_batch_not_changed_without_backups(make_fleet, make_manager, live_rules):
+    fleet = make_fleet(3)
+    m = make_manager(fleet)
+    canary, second, third = fleet.addresses()
+    backup = m.backup
+
+    def unbacked(hosts):
+        saved = backup(hosts)
+        saved.pop(second, None)
+        return saved
+
+    m.backup = unbacked
+    applied = []
+
+    def apply(batch):
+        applied.extend(batch)
+        return m.iptables_output(RULE, batch)
+
+    assert not m.rollout(fleet.addresses(), apply, plan())
+    assert applied == [canary]
+    for h in fleet.addresses():
+        assert RULE not in live_rules(m, h)
+
+
+@pytest.mark.parametrize("backend", ["gevent"])
+def test_rollout_command_passes_iptables_args(make_fleet, make_manager, live_rules):
+    from multirouter.shell import MultirouterShell
+
+    fleet = make_fleet(2)
+    m = make_manager(fleet)
+    m.rollout_plan = plan()
+    MultirouterShell(m).onecmd(f"rollout iptables {RULE}")
+    for h in fleet.addresses():
+        assert RULE in live_rules(m, h)
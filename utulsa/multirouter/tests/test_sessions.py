@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+from multirouter.harness import synthetic_save
+
+
+@pytest.mark.parametrize("backend", ["gevent"])
+def test_drop_stops_keepalives(make_fleet, make_manager):
+    fleet = make_fleet(1)
+    m = make_manager(fleet)
+    h = fleet.addresses()[0]
+    keepalive = m.ssh_manager.sessions.clients[h]._keepalive_greenlet
+    assert keepalive is not None
+    m.ssh_manager.sessions.drop(h)
+    assert keepalive.dead
+    # The host reconnects on its next use
+    m.run_iptables("-S")
+    assert m.status[h]["status"] == "ok"
+
+
+@pytest.mark.parametrize("backend", ["asyncio"])
+def test_concurrent_commands_share_a_connection(make_fleet, make_manager):
+    fleet = make_fleet(1)
+    m = make_manager(fleet)
+    h = fleet.addresses()[0]
+    sessions = m.ssh_manager.sessions
+    sessions.drop(h)
+    opened = []
+    connect = sessions.connect
+
+    async def counted(host, *args, **kwargs):
+        opened.append(host)
+        return await connect(host, *args, **kwargs)
+
+    sessions.connect = counted
+    outputs = [m.ssh_manager.run_command("echo hi", hosts=[h]) for _ in range(5)]
+    for output in outputs:
+        m.ssh_manager.join(output)
+        assert output[0].exception is None
+        assert "hi" in list(output[0].stdout)
+    assert opened == [h]
+
+
+def test_concurrency_bounds_whole_commands(make_fleet, make_manager):
+    fleet = make_fleet(3, latency=0.3)
+    m = make_manager(fleet)
+    m.ssh_manager.set_concurrency(1)
+    start = time.time()
+    output = m.run("echo hi", fleet.addresses())
+    m.join(output)
+    assert time.time() - start >= 0.9
+    assert all(host_out.exit_code == 0 for host_out in output)
+
+
+@pytest.mark.parametrize("sudo_session", [False, True])
+def test_payloads_past_the_pool_size(
+    make_fleet, make_manager, live_rules, sudo_session
+):
+    fleet = make_fleet(3, rules=3)
+    m = make_manager(fleet)
+    m.ssh_manager.sudo_session = sudo_session
+    m.ssh_manager.set_concurrency(1)
+    m.load({h: synthetic_save(5, seed=1) for h in fleet.addresses()})
+    for h in fleet.addresses():
+        assert m.status[h]["status"] == "ok"
+        assert len([l for l in live_rules(m, h) if l.startswith("-A INPUT")]) == 5
@@ -0,0 +1,51 @@
+import types
+
+import pytest
+
+from multirouter.shell import MultirouterShell
+
+
+def shell(batch=False):
+    spawned = []
+    ssh_manager = types.SimpleNamespace(
+        concurrent=True,
+        hosts=[],
+        context_changed=False,
+        spawn=lambda func, *args: spawned.append(args),
+    )
+    sh = MultirouterShell(types.SimpleNamespace(ssh_manager=ssh_manager), batch)
+    return sh, spawned
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "load before",
+        "rollout load before",
+        "analyze --apply",
+        "consolidate --apply",
+        "optimize --apply",
+    ],
+)
+def test_prompting_jobs_are_refused(line, capsys):
+    sh, spawned = shell()
+    sh.start_job(line)
+    assert spawned == []
+    assert "can't run in the background" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize(
+    "line",
+    ["load before", "analyze --apply", "consolidate --apply", "optimize --apply"],
+)
+def test_batch_jobs_can_prompt(line):
+    sh, spawned = shell(batch=True)
+    sh.start_job(line)
+    assert len(spawned) == 1
+
+
+@pytest.mark.parametrize("line", ["list", "analyze", "consolidate --plan", "optimize"])
+def test_other_jobs_run(line):
+    sh, spawned = shell()
+    sh.start_job(line)
+    assert len(spawned) == 1
@@ -0,0 +1,15 @@
+import time
+
+import pytest
+
+
+@pytest.mark.parametrize("sudo_session", [False, True])
+def test_deadline_cuts_off_hung_sudo(make_fleet, make_manager, sudo_session):
+    fleet = make_fleet(1, sudo_delay=30)
+    m = make_manager(fleet, deadline=1)
+    m.ssh_manager.sudo_session = sudo_session
+    h = fleet.addresses()[0]
+    start = time.time()
+    m.run_iptables("-S")
+    assert time.time() - start < 10
+    assert m.status[h]["status"] == "timeout"